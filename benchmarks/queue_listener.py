@@ -0,0 +1,74 @@
+"""Throughput of the QueueListenerThread of the MultiprocessHandler.
+
+Fills a queue with log records and measures how fast the listener forwards
+them to the sink logger, one record per ``get()`` (``batch_size=1``) versus
+draining in batches.
+
+Usage::
+
+    python benchmarks/queue_listener.py [number of records]
+"""
+import logging
+import multiprocessing
+import sys
+import time
+
+from starlog.handlers.base_handler import BaseMultiprocessHandler
+from starlog.handlers.multiprocess_handler import QueueListenerThread
+from starlog.handlers.ring_buffer import RingBufferQueue
+from starlog.serializer import binary_encode_log_record
+
+
+def make_records(count):
+    return [logging.LogRecord('app.module%d' % (i % 10), logging.INFO,
+                              __file__, 42, 'request %d done in %.3fs',
+                              (i, 0.25), None)
+            for i in range(count)]
+
+
+def run(queue, items, serializer, batch_size):
+    for item in items:
+        queue.put(item)
+    queue.put(None)
+
+    if hasattr(queue, 'join_thread'):
+        # wait until the feeder thread wrote all items
+        time.sleep(0.5)
+
+    handler = BaseMultiprocessHandler('starlog.logsink')
+    listener = QueueListenerThread(queue, handler, serializer=serializer,
+                                   batch_size=batch_size)
+    start = time.time()
+    listener.run()
+    return len(items) / (time.time() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    sink = logging.getLogger('starlog.logsink')
+    sink.addHandler(logging.NullHandler())
+    sink.propagate = False
+
+    records = make_records(count)
+    frames = [binary_encode_log_record(record) for record in records]
+
+    queues = [
+        ('manager queue', lambda: multiprocessing.Manager().Queue(),
+         records, None),
+        ('multiprocessing.Queue', multiprocessing.Queue, records, None),
+        ('RingBufferQueue, binary', lambda: RingBufferQueue(64 * 1024 * 1024),
+         frames, 'binary'),
+    ]
+
+    print('%-26s %14s %14s' % ('queue', 'batch_size=1', 'batch_size=100'))
+    for name, create_queue, items, serializer in queues:
+        # best of 3 runs
+        results = [max(run(create_queue(), items, serializer, batch_size)
+                       for _ in range(3))
+                   for batch_size in (1, 100)]
+        print('%-26s %10d r/s %10d r/s' % ((name, ) + tuple(results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Cost of forwarding received log records to the sink loggers by the number
+of distinct logger names.
+
+Forwards records of mixed levels, half of them below the level of the sink
+logger, to a NullHandler. One record per call, like the main process and a
+listener with ``batch_size=1``, and in batches of 100.
+
+Usage::
+
+    python benchmarks/routing.py [number of records]
+"""
+import logging
+import sys
+import time
+
+from starlog.handlers.base_handler import BaseMultiprocessHandler
+
+
+def make_records(count, names):
+    levels = (logging.DEBUG, logging.INFO)
+    return [logging.makeLogRecord({'name': 'app.module%d' % (i % names),
+                                   'levelno': levels[i % 2],
+                                   'msg': 'request done'})
+            for i in range(count)]
+
+
+def run(records, batch_size):
+    handler = BaseMultiprocessHandler('starlog.logsink')
+    batches = [records[i:i + batch_size]
+               for i in range(0, len(records), batch_size)]
+
+    start = time.time()
+    for batch in batches:
+        handler.forward_batch_to_sink(batch)
+    return (time.time() - start) / len(records) * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    sink = logging.getLogger('starlog.logsink')
+    sink.addHandler(logging.NullHandler())
+    sink.setLevel(logging.INFO)
+    sink.propagate = False
+
+    print('%-8s %16s %16s' % ('names', 'batch_size=1', 'batch_size=100'))
+    for names in (1, 20, 200, 1000):
+        records = make_records(count, names)
+        # best of 3 runs
+        results = [min(run(records, batch_size) for _ in range(3))
+                   for batch_size in (1, 100)]
+        print('%-8d %13.2f us %13.2f us' % ((names, ) + tuple(results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Throughput of the receiving side of the ZmqHandler with listener shards.
+
+Child processes send log records as fast as they can. The time is measured
+until the handler is closed, i.e. until every record was forwarded to the
+sink logger, which formats it. Compares a single listener thread with
+shards received by threads of the main process and by sink processes.
+The sink processes only add throughput on a machine with several cores.
+
+Usage::
+
+    python benchmarks/zmq_shards.py [children] [records per child] [shards]
+"""
+import logging
+import logging.config
+import multiprocessing
+import sys
+import time
+
+from starlog import ZmqHandler
+
+
+class FormattingNullHandler(logging.Handler):
+    def emit(self, record):
+        self.format(record)
+
+
+SINK_CONFIG = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'null': {'()': FormattingNullHandler},
+    },
+    'loggers': {
+        'starlog.logsink': {
+            'handlers': ['null'],
+            'level': 'DEBUG',
+            'propagate': False,
+        },
+    },
+}
+
+
+def emit(handler, count):
+    logger = logging.getLogger('app')
+    for i in range(count):
+        logger.info('request %d done in %.3fs', i, 0.25)
+    handler.close()
+
+
+def run(children, count, **kwargs):
+    handler = ZmqHandler('tcp://127.0.0.1', serializer='binary',
+                         nonblocking=True, batch_size=100, **kwargs)
+    logger = logging.getLogger('app')
+    logger.addHandler(handler)
+
+    start = time.time()
+    processes = [multiprocessing.Process(target=emit, args=(handler, count))
+                 for _ in range(children)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    handler.close()
+    elapsed = time.time() - start
+
+    logger.removeHandler(handler)
+    assert handler.dropped_records == 0
+    return children * count / elapsed
+
+
+def main():
+    children = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    shards = int(sys.argv[3]) if len(sys.argv) > 3 \
+        else min(children, multiprocessing.cpu_count())
+
+    logging.getLogger('app').setLevel(logging.INFO)
+    logging.getLogger('app').propagate = False
+    logging.config.dictConfig(SINK_CONFIG)
+
+    setups = [
+        ('1 listener thread', {}),
+        ('%d shard threads' % shards, {'shards': shards}),
+        ('1 sink process', {'sink_config': SINK_CONFIG}),
+        ('%d shard processes' % shards,
+         {'shards': shards, 'sink_config': SINK_CONFIG}),
+    ]
+
+    print('%d cores, %d children, %d records each' % (
+        multiprocessing.cpu_count(), children, count))
+    for name, kwargs in setups:
+        print('%-22s %10d r/s' % (name, run(children, count, **kwargs)))
+
+
+if __name__ == '__main__':
+    main()
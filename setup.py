@@ -17,6 +17,13 @@ setup(name='starlog',
       keywords=['logging', 'log handler', 'status logging',
                 'multiprocessing', 'zmq'],
       packages=find_packages(),
+      entry_points={
+          'console_scripts': [
+              'starlog-collector = starlog.collector:main',
+              'starlog-tail = starlog.tail:main',
+              'starlog-replay = starlog.replay:main',
+          ],
+      },
       install_requires=[
           'six',
       ],
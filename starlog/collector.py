@@ -0,0 +1,239 @@
+"""A standalone process which receives the log records of many applications
+on a host and forwards them to the sink logger.
+
+The applications log with a :py:class:`starlog.ZmqHandler` in client only
+mode::
+
+    handler = starlog.ZmqHandler('tcp://127.0.0.1:5557', client_only=True)
+
+The collector is started with the console script ``starlog-collector``::
+
+    starlog-collector --bind tcp://127.0.0.1:5557 --config logging.json
+
+The configuration file is a :py:func:`logging.config.dictConfig` in json
+format. Without a configuration the records are written to stderr.
+
+With ``--publish`` the collector republishes the received records for
+``starlog-tail``. Give one publish address for each bound address.
+"""
+import argparse
+import json
+import logging
+import logging.config
+import signal
+import sys
+import threading
+
+from .debug import get_debug_logger
+from .handlers.zmq_handler import ZmqHandler
+
+
+_log = get_debug_logger('starlog.debug.collector')
+
+
+DEFAULT_ADDRESS = 'tcp://127.0.0.1:5557'
+DEFAULT_FORMAT = '%(asctime)s [%(name)s-%(process)d] %(levelname)s: ' \
+    '%(message)s'
+
+
+class Collector(object):
+    """Binds the addresses and forwards the received log records to the
+    ``logger``.
+
+    :param list addresses: the zmq addresses to bind
+    :param str logger: name of the sink logger
+    :param str serializer: decodes the received log records. ``auto``
+        accepts records of the ``binary`` and the ``json`` serializer.
+        Don't use ``pickle`` unless only trusted processes can connect, since
+        unpickling executes code of the sender.
+    :param int dispatch_threads: see :py:class:`starlog.ZmqHandler`
+    :param list publish_addresses: if set, the records received on each of
+        the ``addresses`` are republished on the publish address at the same
+        position. See :py:class:`starlog.ZmqHandler`.
+    :param float close_timeout: seconds :py:meth:`close` waits for the
+        applications to end their streams and forwards their records
+        meanwhile. Usually the applications outlive the collector, so the
+        timeout is short.
+    :param float reorder_window: see :py:class:`starlog.ZmqHandler`. The
+        records of each address are reordered separately.
+    :param int shards: the number of sockets and receiving threads per
+        address, see :py:class:`starlog.ZmqHandler`
+    """
+    def __init__(self, addresses, logger='starlog.logsink',
+                 serializer='auto', dispatch_threads=0,
+                 publish_addresses=None, close_timeout=1.0,
+                 reorder_window=None, shards=1):
+        if publish_addresses and len(publish_addresses) != len(addresses):
+            raise ValueError('one publish address for each address required')
+
+        publish_addresses = publish_addresses or [None] * len(addresses)
+
+        self._handlers = []
+        try:
+            for address, publish_address in zip(addresses,
+                                                publish_addresses):
+                self._handlers.append(ZmqHandler(
+                    address, logger=logger, serializer=serializer,
+                    dispatch_threads=dispatch_threads,
+                    publish_address=publish_address,
+                    close_timeout=close_timeout,
+                    reorder_window=reorder_window, shards=shards))
+        except Exception:
+            self.close()
+            raise
+
+    @property
+    def addresses(self):
+        """The bound addresses, including the addresses of the shards.
+        """
+        return [address for handler in self._handlers
+                for address in handler.addresses]
+
+    @property
+    def publish_addresses(self):
+        return [handler.publish_address for handler in self._handlers]
+
+    @property
+    def left_over_records(self):
+        """The number of log records which were not forwarded on close.
+        """
+        return sum(handler.left_over_records for handler in self._handlers)
+
+    @property
+    def late_records(self):
+        """The number of log records which arrived after the reorder window.
+        """
+        return sum(handler.late_records for handler in self._handlers)
+
+    @property
+    def dropped_records(self):
+        """The number of log records the applications dropped.
+        """
+        return sum(handler.dropped_records for handler in self._handlers)
+
+    def delivery_stats(self):
+        """Returns the delivery statistics by pid of the applications which
+        log with ``track_delivery``, see
+        :py:meth:`starlog.ZmqHandler.delivery_stats`.
+        """
+        stats = {}
+        for handler in self._handlers:
+            stats.update(handler.delivery_stats())
+        return stats
+
+    def close(self):
+        """Stops receiving log records.
+        """
+        handlers = self._handlers
+        self._handlers = []
+        for handler in handlers:
+            handler.close()
+
+
+def load_config(path):
+    with open(path) as stream:
+        return json.load(stream)
+
+
+def _configure_logging(config, logger):
+    if config is not None:
+        logging.config.dictConfig(config)
+        return
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(DEFAULT_FORMAT))
+    sink_logger = logging.getLogger(logger)
+    sink_logger.addHandler(handler)
+    sink_logger.setLevel(logging.DEBUG)
+    sink_logger.propagate = False
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='starlog-collector',
+        description='Receives log records of applications which log with a '
+                    'starlog.ZmqHandler in client only mode.')
+    parser.add_argument(
+        '--bind', metavar='ADDRESS', action='append', dest='addresses',
+        help='zmq address to bind, can be given multiple times '
+             '(default: %s)' % DEFAULT_ADDRESS)
+    parser.add_argument(
+        '--publish', metavar='ADDRESS', action='append',
+        dest='publish_addresses',
+        help='republish the records received on the --bind address at the '
+             'same position on this address for starlog-tail')
+    parser.add_argument(
+        '--config', metavar='FILE',
+        help='logging.config.dictConfig configuration in json format')
+    parser.add_argument(
+        '--logger', default='starlog.logsink',
+        help='name of the sink logger (default: %(default)s)')
+    parser.add_argument(
+        '--serializer', default='auto',
+        # unpickling the records of any process which can connect would
+        # execute its code
+        choices=['auto', 'binary', 'json'],
+        help='serializer of the applications (default: %(default)s)')
+    parser.add_argument(
+        '--dispatch-threads', type=int, default=0,
+        help='number of threads which forward the log records to the sink '
+             'logger (default: %(default)s)')
+    parser.add_argument(
+        '--close-timeout', type=float, default=1.0,
+        help='seconds to forward the received log records on shutdown '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--reorder-window', type=float, default=None, metavar='SECONDS',
+        help='forward the log records in the order of their creation time, '
+             'holding each record back for this time, e.g. 0.05')
+    parser.add_argument(
+        '--shards', type=int, default=1,
+        help='number of sockets and receiving threads per bind address. '
+             'Shard n binds the port of the address + n '
+             '(default: %(default)s)')
+
+    args = parser.parse_args(argv)
+    if not args.addresses:
+        args.addresses = [DEFAULT_ADDRESS]
+    if args.publish_addresses \
+            and len(args.publish_addresses) != len(args.addresses):
+        parser.error('give one --publish for each --bind address')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    config = load_config(args.config) if args.config else None
+    _configure_logging(config, args.logger)
+
+    collector = Collector(args.addresses, logger=args.logger,
+                          serializer=args.serializer,
+                          dispatch_threads=args.dispatch_threads,
+                          publish_addresses=args.publish_addresses,
+                          close_timeout=args.close_timeout,
+                          reorder_window=args.reorder_window,
+                          shards=args.shards)
+    _log.info('collector listens on %s', ', '.join(collector.addresses))
+
+    stopped = threading.Event()
+
+    def stop(_signum, _frame):
+        stopped.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    try:
+        # wait with a timeout, so signals are handled on python 2 as well
+        while not stopped.wait(1.0):
+            pass
+    finally:
+        collector.close()
+        logging.shutdown()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
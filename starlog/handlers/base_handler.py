@@ -1,15 +1,238 @@
+import atexit
 import logging
-import os
+import multiprocessing.util
+import time
 import warnings
 
+from ..debug import get_debug_logger
+from ..process import current_pid, register_after_fork
+from ..serializer import CallSiteTable
+from .delivery import DeliveryTracker
+from .dispatcher import SinkDispatcher
+from .level_table import LevelTable
+from .reorder import ReorderStage
+from .sink_process import SinkProcess
+from .status_handler import metric_collection
+
+
+_log = get_debug_logger('starlog.debug.base_handler')
+
+
+def _handler_after_fork(handler):
+    handler._after_fork()
+
+
+# runs before the finalizer of a multiprocessing.Queue closes the queue
+_END_STREAM_PRIORITY = 20
+
 
 class BaseMultiprocessHandler(logging.Handler):
-    def __init__(self, logger):
+    def __init__(self, logger, dispatch_threads=0, dispatch_queue_size=10000,
+                 sink_process=False, sink_config=None, level_pushdown=True,
+                 track_delivery=False, close_timeout=10.0,
+                 reorder_window=None, reorder_max_records=10000,
+                 sink_processes=1):
         logging.Handler.__init__(self)
 
-        self._parent_pid = os.getpid()
+        # the process which receives the log records. With a sink process
+        # the main process sends its log records like a child process.
+        self._parent_pid = current_pid()
         self._sink_logger = logger
 
+        # number of log records the children processes dropped
+        self.dropped_records = 0
+        # number of log records not forwarded at the close deadline
+        self.left_over_records = 0
+        # log records which arrived after the reorder window of a closed
+        # reorder stage
+        self._late_records = 0
+        self._close_timeout = close_timeout
+
+        # routing cache: record name -> (sink logger, level threshold)
+        self._routes = {}
+        # the loggers the routes depend on by name: (logger, level, parent)
+        # when the routes were resolved
+        self._route_loggers = {}
+        self._route_disable = None
+        # seconds between the checks of the levels of the loggers
+        self._route_check_interval = 1.0
+        self._route_check_time = 0
+
+        # call sites of the serialized log records of this process
+        self._call_sites = None
+
+        # levels of the sink loggers for the children processes
+        self._level_table = LevelTable(logger) if level_pushdown else None
+
+        # the process which sends log records, see _begin_stream()
+        self._stream_pid = None
+        # set once the main process sent log records to the sink processes
+        self._sent_to_sink = False
+
+        # sequence numbers of the log records sent by this process
+        self._track_delivery = track_delivery
+        self._sequence_pid = None
+        self._sequence = 0
+        # gaps, reorders and latency of the received log records
+        self._delivery = DeliveryTracker()
+
+        self._dispatch_threads = dispatch_threads
+        self._dispatch_queue_size = dispatch_queue_size
+        self._dispatcher = None
+
+        self._reorder_window = reorder_window
+        self._reorder_max_records = reorder_max_records
+        self._reorder = None
+
+        # one sink process per listener shard
+        self._sink_owner_pid = None
+        if sink_process or sink_config is not None:
+            self._sink_processes = [
+                SinkProcess(self, sink_config, stop_timeout=close_timeout + 5,
+                            shard=shard)
+                for shard in range(sink_processes)]
+        else:
+            self._sink_processes = []
+
+        # set once the listener or the sink process runs
+        self._receiving = False
+        register_after_fork(self, _handler_after_fork)
+
+    def _start_receiving(self):
+        """Starts the listener in this process or the sink process.
+        Subclasses call this at the end of ``__init__``.
+        """
+        sink_processes = self._sink_processes
+        if sink_processes:
+            try:
+                for shard, sink_process in enumerate(sink_processes):
+                    self._set_listener_address(sink_process.start(), shard)
+            except Exception:
+                for sink_process in sink_processes:
+                    sink_process.stop()
+                raise
+            self._sink_owner_pid = self._parent_pid
+            # log records of the main process go to the sink process, too
+            self._parent_pid = None
+            self._receiving = True
+            atexit.register(self.close)
+            return
+
+        if self._level_table is not None:
+            self._level_table.start_updates()
+
+        if self._dispatch_threads:
+            self._dispatcher = SinkDispatcher(
+                self.forward_to_sink, self._dispatch_threads,
+                self._dispatch_queue_size)
+
+        if self._reorder_window:
+            forward = self.forward_to_sink if self._dispatcher is None \
+                else self._dispatcher.dispatch
+            self._reorder = ReorderStage(
+                forward, self._reorder_window, self._reorder_max_records,
+                on_dropped=self.count_dropped)
+
+        self._start_listener()
+        self._receiving = True
+
+    def _become_sink_process(self, shard=0):
+        # called in the sink process of the listener shard after the fork
+        self._parent_pid = current_pid()
+        self._sink_processes = []
+        if shard:
+            # the sink process of the first shard writes the level table
+            self._level_table = None
+
+    def _after_fork(self):
+        """Called in a child process right after the fork. Resets the state
+        inherited from the parent process.
+        """
+        pass
+
+    def _start_listener(self):
+        raise NotImplementedError()
+
+    def _stop_receiving(self, timeout=None):
+        """Stops the listener. Waits up to ``timeout`` seconds (default:
+        ``close_timeout``) until the processes which sent log records ended
+        their streams, forwarding their records meanwhile. The records still
+        queued at the deadline are counted as left over.
+        """
+        raise NotImplementedError()
+
+    def _wait_for_senders(self, timeout):
+        """Waits until the processes which sent log records ended their
+        streams.
+
+        :return: the deadline of the shutdown
+        """
+        if timeout is None:
+            timeout = self._close_timeout
+        deadline = time.time() + timeout
+
+        pending = self._delivery.wait_for_senders(deadline)
+        if pending:
+            _log.warning('processes %s did not end their log streams within '
+                         '%s seconds', ', '.join(map(str, sorted(pending))),
+                         timeout)
+        return deadline
+
+    def count_left_over(self, count):
+        """Counts log records which were not forwarded to the sink logger
+        because the close deadline passed.
+        """
+        if count:
+            _log.warning('%d log records left over at the close deadline',
+                         count)
+            self.left_over_records += count
+
+    def _get_listener_address(self):
+        return None
+
+    def _set_listener_address(self, address, shard=0):
+        pass
+
+    @property
+    def sink_pid(self):
+        """The pid of the process which forwards the log records to the sink
+        logger, of the first listener shard.
+        """
+        return self.sink_pids[0]
+
+    @property
+    def sink_pids(self):
+        """The pids of the sink processes, one per listener shard, or the
+        pid of the main process.
+        """
+        if self._sink_processes:
+            return [sink_process.pid for sink_process in self._sink_processes]
+        return [self._parent_pid]
+
+    def _stop_sink_process(self):
+        """Stops the sink processes after the pending log records of this
+        process are sent. Does nothing if not called by the main process.
+        """
+        sink_processes = self._sink_processes
+        if not sink_processes or self._sink_owner_pid != current_pid():
+            return
+
+        self._sink_processes = []
+        self._flush_to_sink_process()
+        sender_shard = self._get_sender_shard() if self._sent_to_sink \
+            else None
+        for shard, sink_process in enumerate(sink_processes):
+            sink_process.stop(sender=shard == sender_shard)
+
+    def _flush_to_sink_process(self):
+        pass
+
+    def _get_sender_shard(self):
+        """Returns the listener shard which receives the log records of
+        this process.
+        """
+        return 0
+
     def emit(self, record):
         """If called by a subprocess, then the log record is send to the queue.
 
@@ -19,27 +242,257 @@ class BaseMultiprocessHandler(logging.Handler):
         """
         if self._is_main_process():
             self.forward_to_sink(record)
-        else:
-            self.forward_to_main(record)
+            return
+
+        # don't send a log record the sink logger rejects anyway
+        level_table = self._level_table
+        if level_table is not None \
+                and not level_table.is_enabled(record.name, record.levelno):
+            return
+
+        if self._stream_pid != current_pid():
+            self._begin_stream()
+
+        if self._track_delivery:
+            self._stamp(record)
+
+        self.forward_to_main(record)
+
+    def _stamp(self, record):
+        """Adds the sequence number of the process and the send time to the
+        record. The handler lock serializes the calls.
+        """
+        pid = current_pid()
+        if self._sequence_pid != pid:
+            # the counter of the parent process
+            self._sequence_pid = pid
+            self._sequence = 0
+
+        self._sequence += 1
+        record.starlog_seq = self._sequence
+        record.starlog_sent = time.time()
+
+    def _begin_stream(self):
+        """Called before the first log record a process sends. Ends the
+        stream when a process of :py:mod:`multiprocessing` exits, which
+        doesn't run :py:mod:`atexit` handlers after a fork.
+        """
+        self._stream_pid = current_pid()
+        if self._sink_owner_pid == self._stream_pid:
+            self._sent_to_sink = True
+        multiprocessing.util.Finalize(
+            None, self._end_stream_at_exit,
+            exitpriority=_END_STREAM_PRIORITY)
+
+    def _end_stream_at_exit(self):
+        try:
+            self.acquire()
+            try:
+                self._close_stream()
+            finally:
+                self.release()
+        except Exception:
+            _log.warning('cannot end the log stream of process %d',
+                         current_pid())
+
+    def _close_stream(self):
+        """Ends the stream when the process exits. Subclasses release the
+        transport of the process as well.
+        """
+        self._end_stream()
+
+    def _end_stream(self):
+        """Sends the buffered log records and the end of stream marker of
+        this process. Does nothing if this process didn't send log records or
+        ended its stream already.
+        """
+        if self._stream_pid != current_pid():
+            return
+
+        self._stream_pid = None
+        self._send_end_of_stream()
+
+    def _send_end_of_stream(self):
+        raise NotImplementedError()
+
+    def _end_of_stream(self, dropped=0):
+        """Returns the control message which ends the stream of this
+        process. It reports the last sequence number and the dropped log
+        records.
+        """
+        message = {'pid': current_pid(), 'eos': True}
+        if self._track_delivery and self._sequence_pid == current_pid():
+            message['sequence'] = self._sequence
+        if dropped:
+            message['dropped'] = dropped
+        return message
 
     def _is_main_process(self):
-        return self._parent_pid == os.getpid()
+        return self._parent_pid == current_pid()
 
     def forward_to_sink(self, record):
+        self.forward_batch_to_sink([record])
+
+    def forward_batch_to_sink(self, records):
+        """Forwards log records to the sink loggers.
+
+        The sink logger and its effective level are cached per logger name.
+        Records below the level are rejected without further work.
+        """
+        routes = self._get_routes()
+
+        for record in records:
+            route = routes.get(record.name)
+            if route is None:
+                route = self._resolve_route(record.name)
+                routes[record.name] = route
+
+            sink_logger, threshold = route
+            if record.levelno >= threshold:
+                sink_logger.handle(record)
+
+    def _get_routes(self):
+        """Returns the routing cache. It is emptied when the logging
+        configuration changed: at once for ``logging.disable()``, within
+        ``_route_check_interval`` seconds for the levels of the loggers the
+        routes depend on and the hierarchy of the loggers.
+        """
+        disable = logging.root.manager.disable
+        now = time.time()
+        if disable != self._route_disable:
+            self._clear_routes(disable, now)
+        elif now - self._route_check_time >= self._route_check_interval:
+            self._route_check_time = now
+            if self._routes_changed():
+                self._clear_routes(disable, now)
+
+        return self._routes
+
+    def _routes_changed(self):
+        for logger, level, parent in self._route_loggers.values():
+            # a new logger may become the parent of a logger of the routes
+            if logger.level != level or logger.parent is not parent:
+                return True
+        return False
+
+    def _clear_routes(self, disable, now):
+        self._routes = {}
+        self._route_loggers = {}
+        self._route_disable = disable
+        self._route_check_time = now
+
+    def _resolve_route(self, name):
         sink_root_logger = logging.getLogger(self._sink_logger)
         if not sink_root_logger.handlers:
             msg = 'The logger %s does not have any handlers configured' % (
                 self._sink_logger)
             warnings.warn(msg, UserWarning)
 
-        name = record.name
         if name:
             sink_logger = logging.getLogger(self._sink_logger + '.' + name)
         else:
             sink_logger = sink_root_logger
 
-        if sink_logger.isEnabledFor(record.levelno):
-            sink_logger.handle(record)
+        # the effective level depends on the levels of the parents
+        route_loggers = self._route_loggers
+        logger = sink_logger
+        while logger is not None and logger.name not in route_loggers:
+            route_loggers[logger.name] = (logger, logger.level, logger.parent)
+            logger = logger.parent
+
+        # Logger.handle() checks whether the logger is disabled
+        threshold = max(sink_logger.getEffectiveLevel(),
+                        sink_logger.manager.disable + 1)
+        return sink_logger, threshold
 
     def forward_to_main(self, record):
         raise NotImplementedError()
+
+    @property
+    def late_records(self):
+        """The number of log records which arrived after the reorder window
+        and were forwarded out of order.
+        """
+        late = self._late_records
+        reorder = self._reorder
+        if reorder is not None:
+            late += reorder.late
+        return late
+
+    def _get_dispatcher(self):
+        """Returns the stage the listener passes the received log records
+        to, or None if the listener forwards them to the sink itself.
+        """
+        if self._reorder is not None:
+            return self._reorder
+        return self._dispatcher
+
+    def dispatch_queue_depth(self):
+        """Returns the number of received log records waiting for the
+        dispatcher threads or held back for reordering.
+        """
+        depth = 0
+        if self._reorder is not None:
+            depth += self._reorder.depth
+        if self._dispatcher is not None:
+            depth += self._dispatcher.depth
+        return depth
+
+    def _stop_level_updates(self):
+        if self._level_table is not None:
+            self._level_table.stop_updates()
+
+    def _stop_dispatcher(self, deadline=None):
+        reorder = self._reorder
+        if reorder is not None:
+            self._reorder = None
+            self.count_left_over(reorder.close(deadline))
+            self._late_records += reorder.late
+
+        dispatcher = self._dispatcher
+        if dispatcher is not None:
+            self._dispatcher = None
+            self.count_left_over(dispatcher.close(deadline))
+
+    def handle_control(self, message):
+        """Handles a control message of a child process in the main process.
+
+        The number of dropped log records is added to the metric
+        ``starlog-dropped`` of the :py:class:`starlog.StatusHandler`.
+        """
+        dropped = message.get('dropped')
+        if dropped:
+            _log.warning('process %s dropped %d log records',
+                         message.get('pid'), dropped)
+            self.count_dropped(dropped)
+
+        self._delivery.handle_control(message)
+
+    def delivery_stats(self):
+        """Returns the delivery statistics of the received log records by pid
+        of the sending process, see
+        :py:class:`starlog.handlers.delivery.DeliveryTracker`. Only the records
+        of processes with ``track_delivery`` are tracked.
+        """
+        self._delivery.sweep()
+        return self._delivery.stats()
+
+    def count_dropped(self, count):
+        """Counts log records which were lost on their way to the main
+        process.
+        """
+        self.dropped_records += count
+        metric_collection.inc('starlog-dropped', count)
+
+    def _create_call_site_table(self, serializer):
+        if serializer not in ('auto', 'binary'):
+            raise ValueError('a call site table requires the binary '
+                             'serializer')
+        self._call_sites = CallSiteTable()
+
+    def _reset_call_sites(self):
+        """Starts a new session of the call site table after log records
+        were dropped, which may include the definition of a call site.
+        """
+        if self._call_sites is not None:
+            self._call_sites.reset()
@@ -0,0 +1,134 @@
+import threading
+import time
+import traceback
+
+from ..debug import get_debug_logger
+
+
+_log = get_debug_logger('starlog.debug.batching')
+
+
+class BatchSender(object):
+    """Collects serialized log records of a process and sends them in
+    batches.
+
+    A batch is sent as soon as it holds ``max_records`` records or
+    ``max_bytes`` bytes, or when its oldest record is ``interval`` seconds
+    old. The background thread for the time based flush is started lazily
+    with the first record. So a BatchSender must be created after a fork.
+
+    :param callable send: called with the list of frames of a batch
+    :param int max_records: maximum number of records of a batch
+    :param int max_bytes: maximum size of a batch in bytes
+    :param float interval: maximum number of seconds a record is buffered
+    """
+    def __init__(self, send, max_records=100, max_bytes=65536,
+                 interval=0.05):
+        assert max_records > 0
+        assert max_bytes > 0
+        assert interval > 0
+
+        self._send = send
+        self._max_records = max_records
+        self._max_bytes = max_bytes
+        self._interval = interval
+
+        # serializes the sending of batches to keep the order of records
+        self._lock = threading.RLock()
+        self._frames = []
+        self._size = 0
+        self._first_added = None
+
+        self._flusher = None
+
+    def add(self, frame):
+        """Adds a serialized record to the batch. Sends the batch if it is
+        full.
+        """
+        with self._lock:
+            if self._flusher is None:
+                self._start_flusher()
+
+            self._frames.append(frame)
+            self._size += len(frame)
+            if self._first_added is None:
+                self._first_added = time.time()
+
+            if len(self._frames) >= self._max_records \
+                    or self._size >= self._max_bytes:
+                self.flush()
+
+    def flush(self):
+        """Sends all buffered records.
+        """
+        with self._lock:
+            frames = self._frames
+            if not frames:
+                return
+
+            self._frames = []
+            self._size = 0
+            self._first_added = None
+
+            self._send(frames)
+
+    def flush_expired(self):
+        """Sends the buffered records if the oldest one is older than
+        ``interval`` seconds.
+
+        :return: the number of seconds until the next batch expires
+        """
+        with self._lock:
+            first_added = self._first_added
+            if first_added is None:
+                return self._interval
+
+            age = time.time() - first_added
+            if age < self._interval:
+                return self._interval - age
+
+            self.flush()
+            return self._interval
+
+    def _start_flusher(self):
+        _log.info('BatchSender._start_flusher')
+        self._flusher = BatchFlusherThread(self)
+        self._flusher.start()
+
+    def close(self):
+        """Stops the background thread and sends the remaining records.
+        """
+        flusher = self._flusher
+        if flusher is not None:
+            flusher.shutdown()
+            if flusher is not threading.current_thread():
+                flusher.join()
+
+        self.flush()
+
+
+class BatchFlusherThread(threading.Thread):
+    """Sends the batch of a :py:class:`BatchSender` when it expires.
+    """
+    def __init__(self, sender, *args, **kwargs):
+        super(BatchFlusherThread, self).__init__(*args, **kwargs)
+        self.setDaemon(True)
+
+        self._sender = sender
+        self._shutdown_event = threading.Event()
+
+    def run(self):
+        try:
+            timeout = self._sender.flush_expired()
+            while not self._shutdown_event.wait(timeout):
+                timeout = self._sender.flush_expired()
+        except Exception:
+            _log.warning('exception in %s.run: %s',
+                         self.__class__.__name__, traceback.format_exc())
+
+        _log.info('%s stopped', self.__class__.__name__)
+
+    def shutdown(self):
+        """Graceful shutdown.
+        """
+        self._shutdown_event.set()
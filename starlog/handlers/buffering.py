@@ -0,0 +1,293 @@
+import collections
+import threading
+import time
+import traceback
+
+from ..debug import get_debug_logger
+from ..process import current_pid
+from ..serializer import encode_control, is_control
+
+
+_log = get_debug_logger('starlog.debug.buffering')
+
+
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+DROP_LOWEST_LEVEL = 'drop_lowest_level'
+
+OVERFLOW_POLICIES = (DROP_NEWEST, DROP_OLDEST, DROP_LOWEST_LEVEL)
+
+
+def check_overflow_policy(overflow):
+    if overflow not in OVERFLOW_POLICIES:
+        raise ValueError('unknown overflow policy %r. Choose one of: %s' % (
+            overflow, ', '.join(OVERFLOW_POLICIES)))
+
+
+class TransportBusy(Exception):
+    """Raised by the ``send`` function of an :py:class:`AsyncSender` if the
+    transport can't take a message without blocking.
+    """
+
+
+class BoundedBuffer(object):
+    """A thread safe FIFO buffer of serialized log records with a fixed
+    capacity.
+
+    If the buffer is full, then a record is dropped according to the overflow
+    policy:
+
+    - ``drop_newest``: the new record is dropped
+    - ``drop_oldest``: the oldest buffered record is dropped
+    - ``drop_lowest_level``: the oldest record of the lowest buffered log
+      level is dropped. If the new record has the lowest level, then the new
+      record is dropped. So ERROR records survive while DEBUG and INFO records
+      get shed.
+
+    :param int capacity: maximum number of buffered records
+    :param str overflow: the overflow policy
+    """
+    def __init__(self, capacity=10000, overflow=DROP_NEWEST):
+        assert capacity > 0
+        check_overflow_policy(overflow)
+
+        self._capacity = capacity
+        self._overflow = overflow
+        self._lock = threading.Lock()
+
+        # sequence number -> (levelno, item)
+        self._items = collections.OrderedDict()
+        # levelno -> deque of sequence numbers
+        self._by_level = {}
+        self._sequence = 0
+        self._dropped = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, levelno, item):
+        """Adds the item to the buffer.
+
+        :return: True if the buffer was empty before
+        """
+        with self._lock:
+            was_empty = not self._items
+
+            if len(self._items) >= self._capacity:
+                self._dropped += 1
+                if not self._make_room(levelno):
+                    return was_empty
+
+            sequence = self._sequence
+            self._sequence += 1
+
+            self._items[sequence] = (levelno, item)
+            level_queue = self._by_level.get(levelno)
+            if level_queue is None:
+                level_queue = self._by_level[levelno] = collections.deque()
+            level_queue.append(sequence)
+
+            return was_empty
+
+    def _make_room(self, levelno):
+        """Removes a buffered item according to the overflow policy.
+
+        :return: False if the new item must be dropped instead
+        """
+        if self._overflow == DROP_NEWEST:
+            return False
+
+        if self._overflow == DROP_OLDEST:
+            sequence = next(iter(self._items))
+            victim_level = self._items[sequence][0]
+        else:
+            victim_level = min(self._by_level)
+            if levelno <= victim_level:
+                return False
+
+        sequence = self._by_level[victim_level].popleft()
+        if not self._by_level[victim_level]:
+            del self._by_level[victim_level]
+        del self._items[sequence]
+        return True
+
+    def take(self, max_items):
+        """Removes and returns up to ``max_items`` items in FIFO order.
+        """
+        items = []
+        with self._lock:
+            while self._items and len(items) < max_items:
+                sequence, (levelno, item) = self._items.popitem(last=False)
+                level_queue = self._by_level[levelno]
+                level_queue.popleft()
+                if not level_queue:
+                    del self._by_level[levelno]
+                items.append(item)
+        return items
+
+    def pop_dropped(self):
+        """Returns and resets the number of dropped items.
+        """
+        with self._lock:
+            dropped = self._dropped
+            self._dropped = 0
+        return dropped
+
+
+class AsyncSender(object):
+    """Sends the records of a :py:class:`BoundedBuffer` from a background
+    thread. So a log call never waits for the transport.
+
+    The number of dropped records is sent to the main process as a control
+    message together with the next successfully sent records.
+
+    :param callable send: called with a list of up to ``max_records``
+        serialized records. Must raise :py:exc:`TransportBusy` if the
+        records can't be sent without blocking.
+    :param BoundedBuffer buffer: the buffer of records to send
+    :param int max_records: maximum number of records passed to ``send``
+    :param float retry_interval: seconds to wait after the transport was busy
+    :param callable on_dropped: called in the background thread after the
+        buffer dropped records
+    """
+    def __init__(self, send, buffer, max_records=1, retry_interval=0.01,
+                 on_dropped=None):
+        self._send = send
+        self._on_dropped = on_dropped
+        self._buffer = buffer
+        self._max_records = max_records
+        self._retry_interval = retry_interval
+
+        self._wakeup = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._pending = []
+
+        self._thread = None
+
+    def add(self, levelno, item):
+        """Adds a serialized record. Never blocks.
+        """
+        if self._thread is None:
+            self._start_thread()
+
+        if self._buffer.put(levelno, item):
+            self._idle.clear()
+            self._wakeup.set()
+
+    def _start_thread(self):
+        _log.info('AsyncSender._start_thread')
+        self._thread = AsyncSenderThread(self)
+        self._thread.start()
+
+    def send_pending(self):
+        """Sends all buffered records until the transport gets busy.
+
+        :return: False if the transport was busy
+        """
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                self._collect_pending()
+                if not self._pending:
+                    self._idle.set()
+                    return True
+
+            try:
+                while self._pending:
+                    self._send(self._pending[0])
+                    self._pending.pop(0)
+            except TransportBusy:
+                return False
+
+    def _collect_pending(self):
+        dropped = self._buffer.pop_dropped()
+        if dropped:
+            _log.warning('dropped %d log records', dropped)
+            control = encode_control(
+                {'pid': current_pid(), 'dropped': dropped})
+            self._pending.append([control])
+            if self._on_dropped is not None:
+                self._on_dropped()
+
+        items = self._buffer.take(self._max_records)
+        if items:
+            self._pending.append(items)
+
+    def wait(self, busy):
+        """Waits for new records or until the transport should be retried.
+        """
+        if busy:
+            time.sleep(self._retry_interval)
+        else:
+            self._wakeup.wait(1.0)
+
+    def flush(self, timeout=5.0):
+        """Waits until all buffered records are sent.
+
+        :return: False if the records were not sent within ``timeout`` seconds
+        """
+        if self._thread is None:
+            return True
+
+        deadline = time.time() + timeout
+        while True:
+            self._wakeup.set()
+            if self._idle.wait(max(deadline - time.time(), 0)) \
+                    and not self._pending and not len(self._buffer):
+                return True
+
+            if time.time() >= deadline:
+                return False
+
+            time.sleep(self._retry_interval)
+
+    def close(self, timeout=5.0):
+        """Sends the remaining records and stops the background thread.
+
+        :return: the number of records which were not sent
+        """
+        thread = self._thread
+        if thread is None:
+            return 0
+
+        unsent = 0
+        if not self.flush(timeout):
+            unsent = len(self._buffer) + sum(
+                len(items) for items in list(self._pending)
+                if not is_control(items[0]))
+            _log.warning('AsyncSender.close: %d log records not sent',
+                         unsent)
+
+        thread.shutdown()
+        self._wakeup.set()
+        if thread is not threading.current_thread():
+            thread.join(timeout)
+
+        return unsent
+
+
+class AsyncSenderThread(threading.Thread):
+    def __init__(self, sender, *args, **kwargs):
+        super(AsyncSenderThread, self).__init__(*args, **kwargs)
+        self.setDaemon(True)
+
+        self._sender = sender
+        self._running = True
+
+    def run(self):
+        try:
+            while self._running:
+                busy = not self._sender.send_pending()
+                if self._running:
+                    self._sender.wait(busy)
+        except Exception:
+            _log.warning('exception in %s.run: %s',
+                         self.__class__.__name__, traceback.format_exc())
+
+        _log.info('%s stopped', self.__class__.__name__)
+
+    def shutdown(self):
+        """Graceful shutdown.
+        """
+        self._running = False
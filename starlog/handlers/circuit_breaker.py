@@ -0,0 +1,152 @@
+import random
+import threading
+import time
+import traceback
+
+from ..debug import get_debug_logger
+
+
+_log = get_debug_logger('starlog.debug.circuit_breaker')
+
+
+class ConnectionSupervisor(object):
+    """A circuit breaker for the connection of a child process to the main
+    process.
+
+    As long as the connection works, the circuit is closed and log records are
+    sent. After a connection error the circuit opens and a background thread
+    reconnects with a jittered exponential backoff. While the circuit is open
+    log records are not sent, but buffered or dropped by the caller. A log call
+    never waits for a reconnect.
+
+    The background thread gives up after ``deadline`` seconds. Another
+    reconnect is started at the earliest ``retry_after`` seconds later.
+
+    :param callable connect: attempts to connect once. Raises an exception if
+        the connect fails.
+    :param float backoff_factor: the sleep between reconnect attempts is a
+        random value up to ``backoff_factor * 2 ** attempt`` seconds
+    :param float max_backoff: upper limit of the sleep between attempts
+    :param float deadline: seconds after which the reconnecting gives up
+    :param float retry_after: seconds after giving up until the next
+        reconnect is started
+    """
+    def __init__(self, connect, backoff_factor=0.1, max_backoff=5.0,
+                 deadline=60.0, retry_after=30.0):
+        self._connect = connect
+        self._backoff_factor = backoff_factor
+        self._max_backoff = max_backoff
+        self._deadline = deadline
+        self._retry_after = retry_after
+
+        # seeded from os.urandom, so children forked at the same time don't
+        # reconnect in lockstep
+        self._random = random.Random()
+
+        self._lock = threading.Lock()
+        self._open = False
+        self._gave_up_at = None
+        self._thread = None
+        self._closed = threading.Event()
+
+    @property
+    def is_open(self):
+        return self._open
+
+    def connect(self):
+        """Connects once. Opens the circuit if that fails.
+
+        :return: True if connected
+        """
+        try:
+            self._connect()
+        except Exception as error:
+            self.trip(error)
+            return False
+        return True
+
+    def allow(self):
+        """Returns True if the circuit is closed and records can be sent.
+        """
+        if not self._open:
+            return True
+
+        gave_up_at = self._gave_up_at
+        if gave_up_at is not None \
+                and time.time() - gave_up_at >= self._retry_after:
+            with self._lock:
+                if self._thread is None and self._gave_up_at is not None:
+                    self._gave_up_at = None
+                    self._start_reconnect()
+
+        return False
+
+    def trip(self, error):
+        """Opens the circuit because of a connection error and starts to
+        reconnect in the background.
+        """
+        with self._lock:
+            if self._open:
+                return
+
+            _log.warning('connection failed: %s. Opening circuit.', error)
+            self._open = True
+            self._gave_up_at = None
+            self._start_reconnect()
+
+    def _start_reconnect(self):
+        if self._closed.is_set():
+            return
+
+        self._thread = threading.Thread(target=self._reconnect)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _backoff(self, attempt):
+        limit = min(self._max_backoff, self._backoff_factor * 2 ** attempt)
+        return self._random.uniform(0, limit)
+
+    def _reconnect(self):
+        end = time.time() + self._deadline
+        attempt = 0
+
+        try:
+            while not self._closed.is_set():
+                try:
+                    self._connect()
+                except Exception as error:
+                    _log.warning('reconnect attempt %d failed: %s',
+                                 attempt, error)
+                else:
+                    _log.info('reconnected. Closing circuit.')
+                    with self._lock:
+                        self._open = False
+                        self._thread = None
+                    return
+
+                rest = end - time.time()
+                if rest <= 0:
+                    break
+
+                self._closed.wait(min(self._backoff(attempt), rest))
+                attempt += 1
+        except Exception:
+            _log.warning('exception in ConnectionSupervisor._reconnect: %s',
+                         traceback.format_exc())
+
+        with self._lock:
+            self._thread = None
+            if self._closed.is_set():
+                return
+            self._gave_up_at = time.time()
+
+        _log.error('giving up to reconnect for %s seconds', self._retry_after)
+
+    def close(self):
+        """Stops reconnecting.
+        """
+        self._closed.set()
+
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
@@ -0,0 +1,316 @@
+import collections
+import errno
+import os
+import threading
+import time
+
+from ..debug import get_debug_logger
+from ..metrics import HistogramMetric
+from ..process import current_pid
+from .status_handler import metric_collection
+
+
+_log = get_debug_logger('starlog.debug.delivery')
+
+
+# attributes a sending process adds to its log records
+SEQUENCE_ATTRIBUTE = 'starlog_seq'
+SENT_ATTRIBUTE = 'starlog_sent'
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno != errno.ESRCH
+    return True
+
+
+class _ProcessState(object):
+    """The delivery state of the log records of one sending process.
+    """
+    __slots__ = ('expected', 'missing', 'dropped', 'received', 'lost',
+                 'reordered', 'duplicates', 'latency', 'closed')
+
+    def __init__(self):
+        # the next expected sequence number
+        self.expected = 1
+        # ranges of sequence numbers which didn't arrive yet:
+        # [first, end, time the gap was noticed]
+        self.missing = []
+        # dropped records the process reported, which aren't matched with a
+        # gap yet
+        self.dropped = 0
+
+        self.received = 0
+        self.lost = 0
+        self.reordered = 0
+        self.duplicates = 0
+        # milliseconds between sending and receiving
+        self.latency = HistogramMetric()
+        self.closed = False
+
+    def pending(self):
+        return sum(end - first for first, end, _noticed in self.missing)
+
+
+class DeliveryTracker(object):
+    """Tracks the delivery of the log records of the sending processes by
+    the sequence number and the send time stamped on each record, see the
+    ``track_delivery`` parameter of the handlers.
+
+    Per sending process it counts:
+
+    - lost records: a gap in the sequence numbers which wasn't filled within
+      ``reorder_window`` seconds. Records the process reported as dropped
+      aren't counted again.
+    - reordered records: a record which filled a gap
+    - duplicates: a record with a sequence number which was received before
+    - the latency between sending and receiving in milliseconds
+
+    The counters are added to the metrics ``starlog-lost``,
+    ``starlog-reordered`` and ``starlog-duplicates`` and the latency to the
+    histogram ``starlog-latency-ms`` of the
+    :py:class:`starlog.StatusHandler`.
+
+    A process reports its last sequence number when its handler is closed,
+    which reveals the loss of its final records. The records lost before a
+    process crashed are not detected. Processes are identified by their pid,
+    a sequence restarting at 1 is taken as a new process with a reused pid.
+
+    The tracker also knows the processes which sent log records, stamped or
+    not, and didn't end their stream yet. See :py:meth:`wait_for_senders`.
+
+    :param float reorder_window: seconds a gap may be filled by a late record
+    :param int max_processes: the number of processes which are tracked. The
+        least recently active process is forgotten first.
+    :param int max_gaps: the number of gaps tracked per process. Older gaps
+        are counted as lost early.
+    """
+    def __init__(self, reorder_window=2.0, max_processes=10000, max_gaps=64):
+        self._reorder_window = reorder_window
+        self._max_processes = max_processes
+        self._max_gaps = max_gaps
+
+        self._lock = threading.Lock()
+        self._processes = collections.OrderedDict()
+        self._next_sweep = 0
+
+        # pids of the processes which didn't end their stream
+        self._senders = set()
+        self._senders_changed = threading.Condition(threading.Lock())
+
+    def _get_state(self, pid):
+        processes = self._processes
+        state = processes.pop(pid, None)
+        if state is None:
+            state = _ProcessState()
+            if len(processes) >= self._max_processes:
+                _old_pid, old_state = processes.popitem(last=False)
+                self._expire(old_state, None)
+        # the most recently active process goes last
+        processes[pid] = state
+        return state
+
+    def received(self, record, now=None):
+        """Tracks a received log record. Only the sender is tracked if the
+        record doesn't carry a sequence number.
+        """
+        pid = record.process
+        if pid not in self._senders and pid is not None:
+            with self._senders_changed:
+                self._senders.add(pid)
+
+        sequence = getattr(record, SEQUENCE_ATTRIBUTE, None)
+        if sequence is None:
+            return
+
+        if now is None:
+            now = time.time()
+
+        sent = getattr(record, SENT_ATTRIBUTE, None)
+        if sent is not None:
+            latency = max(0.0, (now - sent) * 1000.0)
+            metric_collection.observe('starlog-latency-ms', latency)
+        else:
+            latency = None
+
+        with self._lock:
+            state = self._get_state(record.process)
+            if sequence == 1 and state.expected > 1 \
+                    and not (state.missing and state.missing[0][0] == 1):
+                # the pid was reused by a new process
+                self._expire(state, None)
+                state = self._processes[record.process] = _ProcessState()
+
+            self._track(state, sequence, now)
+            if latency is not None:
+                state.latency.observe(latency)
+
+            if now >= self._next_sweep:
+                self._sweep(now)
+
+    def _track(self, state, sequence, now):
+        state.received += 1
+        state.closed = False
+
+        if sequence == state.expected:
+            state.expected += 1
+        elif sequence > state.expected:
+            state.missing.append([state.expected, sequence, now])
+            state.expected = sequence + 1
+            if len(state.missing) > self._max_gaps:
+                self._expire_gap(state, state.missing.pop(0))
+        elif self._fill(state, sequence):
+            state.reordered += 1
+            metric_collection.inc('starlog-reordered')
+        else:
+            state.duplicates += 1
+            metric_collection.inc('starlog-duplicates')
+
+    def _fill(self, state, sequence):
+        """Removes the sequence number from the gaps.
+
+        :return: False if it isn't missing
+        """
+        missing = state.missing
+        for index, gap in enumerate(missing):
+            first, end, noticed = gap
+            if not first <= sequence < end:
+                continue
+
+            if end - first == 1:
+                del missing[index]
+            elif sequence == first:
+                gap[0] += 1
+            elif sequence == end - 1:
+                gap[1] -= 1
+            else:
+                gap[1] = sequence
+                missing.insert(index + 1, [sequence + 1, end, noticed])
+            return True
+
+        return False
+
+    def _expire(self, state, now):
+        """Counts the gaps noticed before the reorder window as lost, or all
+        gaps if ``now`` is None.
+        """
+        missing = state.missing
+        while missing and (now is None
+                           or missing[0][2] <= now - self._reorder_window):
+            self._expire_gap(state, missing.pop(0))
+
+    def _expire_gap(self, state, gap):
+        first, end, _noticed = gap
+        count = end - first
+
+        # the process reported these records as dropped already
+        dropped = min(count, state.dropped)
+        state.dropped -= dropped
+        count -= dropped
+        if count:
+            _log.warning('lost %d log records', count)
+            state.lost += count
+            metric_collection.inc('starlog-lost', count)
+
+    def _sweep(self, now):
+        # gaps of processes which went quiet
+        self._next_sweep = now + self._reorder_window
+        for state in self._processes.values():
+            if state.missing:
+                self._expire(state, now)
+
+    def handle_control(self, message, now=None):
+        """Handles the ``dropped`` count, the final ``sequence`` number and
+        the end of stream marker ``eos`` a process reports.
+        """
+        pid = message.get('pid')
+        if message.get('eos'):
+            with self._senders_changed:
+                self._senders.discard(pid)
+                self._senders_changed.notify_all()
+
+        dropped = message.get('dropped')
+        sequence = message.get('sequence')
+        if pid is None or not (dropped or sequence is not None):
+            return
+
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            state = self._get_state(pid)
+            if dropped:
+                state.dropped += dropped
+
+            if sequence is not None:
+                # no more records of this process are on their way
+                if sequence >= state.expected:
+                    state.missing.append([state.expected, sequence + 1, now])
+                    state.expected = sequence + 1
+                self._expire(state, None)
+                state.dropped = 0
+                state.closed = True
+
+    def expect_sender(self, pid):
+        """Makes :py:meth:`wait_for_senders` wait for the end of the stream
+        of a process, which may not have arrived yet.
+        """
+        with self._senders_changed:
+            self._senders.add(pid)
+
+    def forget_sender(self, pid):
+        """Doesn't wait for the end of the stream of a process anymore.
+        """
+        with self._senders_changed:
+            self._senders.discard(pid)
+            self._senders_changed.notify_all()
+
+    def wait_for_senders(self, deadline, interval=0.1):
+        """Waits until every process which sent log records ended its stream
+        or exited. A process which exited without ending its stream is
+        forgotten.
+
+        :param float deadline: the :py:func:`time.time` to give up
+        :return: the pids of the processes which didn't end their streams
+        """
+        own_pid = current_pid()
+        with self._senders_changed:
+            while True:
+                for pid in list(self._senders):
+                    if pid == own_pid or not _is_alive(pid):
+                        self._senders.discard(pid)
+
+                remaining = deadline - time.time()
+                if not self._senders or remaining <= 0:
+                    return set(self._senders)
+
+                self._senders_changed.wait(min(remaining, interval))
+
+    def sweep(self, now=None):
+        """Counts the gaps which weren't filled within the reorder window as
+        lost.
+        """
+        with self._lock:
+            self._sweep(time.time() if now is None else now)
+
+    def stats(self):
+        """Returns the delivery statistics by pid of the sending process.
+        """
+        result = {}
+        with self._lock:
+            for pid, state in self._processes.items():
+                latency = state.latency
+                result[pid] = {
+                    'received': state.received,
+                    'lost': state.lost,
+                    'pending': state.pending(),
+                    'reordered': state.reordered,
+                    'duplicates': state.duplicates,
+                    'latency_p50': latency.percentile(50),
+                    'latency_p99': latency.percentile(99),
+                    'latency_max': latency.max(),
+                    'closed': state.closed,
+                }
+        return result
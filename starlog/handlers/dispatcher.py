@@ -0,0 +1,135 @@
+import threading
+import time
+import traceback
+
+from six.moves import queue as Queue
+
+from ..debug import get_debug_logger
+
+
+_log = get_debug_logger('starlog.debug.dispatcher')
+
+
+class SinkDispatcher(object):
+    """Forwards received log records to the sink in a pool of threads. So a
+    slow sink handler doesn't slow down the thread that receives the records
+    of the child processes.
+
+    Every thread has its own bounded queue. The records are sharded by the
+    logger name, so the records of a logger keep their order.
+
+    :param callable forward: called with every record in a dispatcher thread,
+        e.g. :py:meth:`BaseMultiprocessHandler.forward_to_sink`
+    :param int threads: number of dispatcher threads
+    :param int queue_size: capacity of the queue of each thread. If a queue is
+        full, then :py:meth:`dispatch` blocks.
+    """
+    def __init__(self, forward, threads=1, queue_size=10000):
+        assert threads > 0
+
+        self._queues = [Queue.Queue(queue_size) for _ in range(threads)]
+        self._threads = [DispatcherThread(queue, forward)
+                         for queue in self._queues]
+
+        for thread in self._threads:
+            thread.start()
+
+    def dispatch(self, record):
+        """Puts the record in the queue of the shard of its logger name.
+        """
+        queues = self._queues
+        queues[hash(record.name) % len(queues)].put(record)
+
+    @property
+    def depth(self):
+        """The number of records waiting to be forwarded.
+        """
+        return sum(queue.qsize() for queue in self._queues)
+
+    def close(self, deadline=None):
+        """Forwards the queued records and stops the threads.
+
+        :param float deadline: the :py:func:`time.time` after which the
+            queued records are only counted, not forwarded
+        :return: the number of records which were not forwarded
+        """
+        for thread in self._threads:
+            thread.deadline = deadline
+
+        left_over = 0
+        for queue in self._queues:
+            if deadline is None:
+                queue.put(None)
+            else:
+                left_over += self._stop_shard(queue, deadline)
+
+        for thread in self._threads:
+            if deadline is None:
+                thread.join()
+            else:
+                # a forward call may block in a handler of the sink
+                thread.join(max(deadline - time.time(), 0) + 1.0)
+                if thread.is_alive():
+                    _log.warning('%s did not stop', thread.name)
+
+        return left_over + sum(thread.left_over for thread in self._threads)
+
+    def _stop_shard(self, queue, deadline):
+        """Puts the stop item into the queue of a shard before the deadline.
+        If the queue stays full, e.g. the thread is stuck in a slow sink
+        handler, then the queued records are taken out and counted.
+
+        :return: the number of records which were taken out
+        """
+        try:
+            queue.put(None, True, max(deadline - time.time(), 0))
+            return 0
+        except Queue.Full:
+            pass
+
+        left_over = 0
+        while True:
+            try:
+                queue.get_nowait()
+            except Queue.Empty:
+                break
+            left_over += 1
+
+        # the thread stops once the sink handler returns
+        try:
+            queue.put_nowait(None)
+        except Queue.Full:
+            _log.warning('cannot stop a %s', DispatcherThread.__name__)
+        return left_over
+
+
+class DispatcherThread(threading.Thread):
+    def __init__(self, queue, forward, *args, **kwargs):
+        super(DispatcherThread, self).__init__(*args, **kwargs)
+        self.setDaemon(True)
+
+        self._queue = queue
+        self._forward = forward
+
+        # set on close
+        self.deadline = None
+        self.left_over = 0
+
+    def run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+
+            deadline = self.deadline
+            if deadline is not None and time.time() > deadline:
+                self.left_over += 1
+                continue
+
+            try:
+                self._forward(record)
+            except Exception:
+                _log.warning('exception in %s.run: %s',
+                             self.__class__.__name__, traceback.format_exc())
+
+        _log.info('%s stopped', self.__class__.__name__)
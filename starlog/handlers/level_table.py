@@ -0,0 +1,194 @@
+import json
+import logging
+import mmap
+import struct
+import threading
+import traceback
+
+from ..debug import get_debug_logger
+from ..process import current_pid, register_after_fork
+
+
+_log = get_debug_logger('starlog.debug.level_table')
+
+
+# version of the table, length of the payload
+_HEADER = struct.Struct('=QI')
+_VERSION = struct.Struct('=Q')
+
+
+class LevelTable(object):
+    """Shares the levels of the sink loggers with the child processes in
+    shared memory. A child process discards a log record which the sink
+    logger would reject before the record is serialized and sent.
+
+    The process which forwards the records to the sink logger writes the
+    table: the level of every sink logger with an explicitly set level, by
+    logger name relative to the sink logger. A child process looks up the
+    nearest level of a record name like
+    :py:meth:`logging.Logger.getEffectiveLevel` does. A table which was never
+    written doesn't discard any record.
+
+    Updates are published with a version number which is odd while the table
+    is written, i.e. the readers don't need a lock.
+
+    The shared memory is inherited by forked processes only. Other processes,
+    e.g. of the ``spawn`` start method, never discard a record.
+
+    :param str sink_logger: name of the sink logger
+    :param int size: size of the shared memory in bytes
+    """
+    def __init__(self, sink_logger, size=65536):
+        self._sink_logger = sink_logger
+        self._size = size
+        # an anonymous mapping is shared with forked children
+        self._buffer = mmap.mmap(-1, _HEADER.size + size)
+
+        # reader: version of the loaded table, record name -> threshold
+        self._version = 0
+        self._levels = None
+        self._thresholds = {}
+
+        # writer
+        self._written = None
+        self._updater = None
+        self._updater_pid = None
+
+        register_after_fork(self, LevelTable._after_fork)
+
+    def _after_fork(self):
+        # the updater thread runs in the parent process only
+        self._updater = None
+        self._updater_pid = None
+
+    def collect(self):
+        """Returns the levels of the sink loggers of this process.
+        """
+        sink_logger = logging.getLogger(self._sink_logger)
+        manager = sink_logger.manager
+        prefix = self._sink_logger + '.'
+
+        levels = {'': sink_logger.getEffectiveLevel()}
+        for name, logger in list(manager.loggerDict.items()):
+            if not name.startswith(prefix) \
+                    or not isinstance(logger, logging.Logger):
+                continue
+            if logger.level != logging.NOTSET:
+                levels[name[len(prefix):]] = logger.level
+
+        return {'levels': levels, 'disable': manager.disable}
+
+    def update(self):
+        """Writes the levels of the sink loggers if they changed.
+        """
+        table = self.collect()
+        if table == self._written:
+            return
+
+        data = json.dumps(table).encode('utf-8')
+        if len(data) > self._size:
+            _log.warning('levels of %d sink loggers exceed the level table',
+                         len(table['levels']))
+            # an empty table doesn't discard any record
+            data = b''
+
+        buffer = self._buffer
+        version = _VERSION.unpack_from(buffer, 0)[0]
+        _VERSION.pack_into(buffer, 0, version + 1)
+        buffer[_HEADER.size:_HEADER.size + len(data)] = data
+        _HEADER.pack_into(buffer, 0, version + 2, len(data))
+
+        self._written = table
+
+    def _load(self):
+        buffer = self._buffer
+        for _ in range(100):
+            version, length = _HEADER.unpack_from(buffer, 0)
+            if version % 2:
+                # the writer is updating the table
+                continue
+
+            data = buffer[_HEADER.size:_HEADER.size + length]
+            if _VERSION.unpack_from(buffer, 0)[0] != version:
+                continue
+
+            self._version = version
+            self._levels = json.loads(data.decode('utf-8')) if data else None
+            self._thresholds = {}
+            return
+
+        _log.warning('cannot read the level table')
+
+    def threshold(self, name):
+        """Returns the minimum level of a record of the logger ``name`` or
+        None if records aren't discarded.
+        """
+        version = _VERSION.unpack_from(self._buffer, 0)[0]
+        if version != self._version:
+            self._load()
+
+        table = self._levels
+        if table is None:
+            return None
+
+        thresholds = self._thresholds
+        threshold = thresholds.get(name)
+        if threshold is None:
+            levels = table['levels']
+            key = name
+            while key not in levels:
+                index = key.rfind('.')
+                key = key[:index] if index > 0 else ''
+            # Logger.handle() checks whether logging is disabled
+            threshold = max(levels[key], table['disable'] + 1)
+            thresholds[name] = threshold
+
+        return threshold
+
+    def is_enabled(self, name, level):
+        """Returns False if the sink logger rejects a record of the logger
+        ``name`` with the ``level``.
+        """
+        threshold = self.threshold(name)
+        return threshold is None or level >= threshold
+
+    def start_updates(self, interval=1.0):
+        """Writes the table and starts a thread which writes the changes of
+        the logging configuration every ``interval`` seconds.
+        """
+        self.update()
+        self._updater = LevelTableUpdater(self, interval)
+        self._updater_pid = current_pid()
+        self._updater.start()
+
+    def stop_updates(self):
+        updater = self._updater
+        if updater is None or self._updater_pid != current_pid():
+            return
+
+        self._updater = None
+        updater.shutdown()
+        updater.join()
+
+
+class LevelTableUpdater(threading.Thread):
+    def __init__(self, table, interval, *args, **kwargs):
+        super(LevelTableUpdater, self).__init__(*args, **kwargs)
+        self.setDaemon(True)
+
+        self._table = table
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self._table.update()
+            except Exception:
+                _log.warning('exception in %s.run: %s',
+                             self.__class__.__name__, traceback.format_exc())
+
+        _log.info('%s stopped', self.__class__.__name__)
+
+    def shutdown(self):
+        self._stopped.set()
@@ -1,11 +1,28 @@
+import logging
 import multiprocessing
 import threading
+import time
 import traceback
 
+from six.moves import queue as Queue
+
 from ..compat import QueueHandler
 from ..debug import get_debug_logger
-from ..utils import sleep
+from ..process import current_pid
+from ..serializer import (
+    UnknownCallSite,
+    decode_control,
+    encode_control,
+    get_decoder,
+    get_serializer,
+    is_control)
 from .base_handler import BaseMultiprocessHandler
+from .buffering import (
+    AsyncSender,
+    BoundedBuffer,
+    DROP_NEWEST,
+    TransportBusy,
+    check_overflow_policy)
 
 
 _log = get_debug_logger('starlog.debug.queue_handler')
@@ -23,17 +40,118 @@ class MultiprocessHandler(BaseMultiprocessHandler):
     The MultiprocessHandler is expected to be set up by the main process.
 
     :param queue: A multiprocessing capable queue. If not set, then a new
-        multiprocessing queue is created.
+        multiprocessing queue is created. For processes forked from the main
+        process a :py:class:`starlog.handlers.ring_buffer.RingBufferQueue`
+        is considerably faster than a manager queue.
     :param bool manager_queue: If `queue` is `None` and this argument is set
         to `True`, then a new queue is created by calling
         :py:meth:`multiprocessing.managers.SyncManager.Queue`.
     :param str logger: name of the logger where log records are send to in the
         main process.
+    :param str serializer: subprocesses put the log records serialized with
+        this format into the queue: ``binary`` (default), ``json`` or
+        ``pickle``. See :py:func:`starlog.serializer.get_serializer`. The
+        queue then only transports bytes, which doesn't depend on the
+        LogRecord class of the processes. A record with an attribute the
+        serializer doesn't support is put as a LogRecord instance. If set to
+        ``None``, then subprocesses put LogRecord instances.
+    :param bool nonblocking: if set, subprocesses put their log records in a
+        bounded buffer which is sent to the queue by a background thread. A log
+        call never waits for the queue then.
+    :param int buffer_size: capacity of the buffer in non-blocking mode.
+    :param str overflow: what to drop in non-blocking mode if the buffer is
+        full: ``drop_newest`` (default), ``drop_oldest`` or
+        ``drop_lowest_level``. The main process counts the dropped records in
+        the metric ``starlog-dropped`` of the
+        :py:class:`starlog.StatusHandler`.
+    :param int dispatch_threads: if set, received log records are forwarded
+        to the ``logger`` by this number of threads instead of the receiving
+        thread. The records of a logger keep their order.
+    :param int dispatch_queue_size: capacity of the queue of each dispatcher
+        thread.
+    :param bool sink_process: if set, a dedicated sink process is forked
+        which receives the log records and forwards them to the ``logger``.
+        The main process sends its own log records to the sink process, too.
+        See :py:class:`starlog.handlers.sink_process.SinkProcess`.
+    :param dict sink_config: a :py:func:`logging.config.dictConfig`
+        configuration applied in the sink process. Implies ``sink_process``.
+    :param bool level_pushdown: if set, subprocesses discard log records
+        which the ``logger`` rejects because of its level, before they are
+        serialized. A changed level reaches the subprocesses within a second.
+        See :py:class:`starlog.handlers.level_table.LevelTable`.
+    :param bool defer_rendering: if set, subprocesses send the message
+        template and its args instead of the rendered message if the args are
+        primitive values. The message is rendered in the main process, and
+        only if a handler of the ``logger`` formats it. Requires a
+        ``serializer``. Rendering a few primitive values is about as cheap as
+        serializing them, so this pays off if the handlers of the ``logger``
+        discard many records, e.g. by their levels or filters.
+    :param bool call_site_table: if set, subprocesses send the fixed
+        attributes of a call site, like the logger name, the pathname and the
+        line number, only with the first log record of the call site.
+        Requires the ``binary`` serializer. See
+        :py:class:`starlog.serializer.CallSiteTable`.
+    :param bool track_delivery: if set, subprocesses stamp their log records
+        with a sequence number and the send time (the attributes
+        ``starlog_seq`` and ``starlog_sent``). The main process counts lost
+        and reordered records and the latency per subprocess in the metrics
+        of the :py:class:`starlog.StatusHandler`, see
+        :py:class:`starlog.handlers.delivery.DeliveryTracker`.
+    :param float close_timeout: :py:meth:`close` of the main process waits
+        up to this number of seconds until the subprocesses which sent log
+        records ended their streams, i.e. sent their buffered records and an
+        end of stream marker. A subprocess ends its stream in
+        :py:meth:`close` and when a :py:mod:`multiprocessing` process exits.
+        The records not forwarded to the ``logger`` at the deadline are
+        counted in ``left_over_records``. Subprocesses wait up to this
+        number of seconds to send their buffered records.
+    :param float reorder_window: if set, the received log records are
+        forwarded in the order of their creation time. Each record is held
+        back for this number of seconds, e.g. ``0.05``, so the records of
+        other processes created before it can overtake it. Records which
+        arrive later are forwarded immediately and counted in
+        ``late_records`` and in the metric ``starlog-late``. With
+        ``dispatch_threads`` the order is kept per logger. See
+        :py:class:`starlog.handlers.reorder.ReorderStage`.
+    :param int reorder_max_records: the number of records held back per
+        sending process. Further records of the process are dropped and
+        counted in ``dropped_records``.
     """
 
     def __init__(self, queue=None, manager_queue=True,
-                 logger='starlog.logsink'):
-        BaseMultiprocessHandler.__init__(self, logger)
+                 logger='starlog.logsink', serializer='binary',
+                 nonblocking=False, buffer_size=10000, overflow=DROP_NEWEST,
+                 dispatch_threads=0, dispatch_queue_size=10000,
+                 sink_process=False, sink_config=None, level_pushdown=True,
+                 defer_rendering=False, call_site_table=False,
+                 track_delivery=False, close_timeout=10.0,
+                 reorder_window=None, reorder_max_records=10000):
+        BaseMultiprocessHandler.__init__(
+            self, logger, dispatch_threads, dispatch_queue_size,
+            sink_process, sink_config, level_pushdown, track_delivery,
+            close_timeout, reorder_window, reorder_max_records)
+        check_overflow_policy(overflow)
+
+        self._nonblocking = nonblocking
+        self._buffer_size = buffer_size
+        self._overflow = overflow
+
+        # for children processes in non-blocking mode
+        self._pid = None
+        self._async_sender = None
+
+        # records dropped because the queue was full
+        self._dropped_pid = None
+        self._dropped = 0
+
+        self._serializer = serializer
+        if serializer is None:
+            self._encode = None
+        else:
+            if call_site_table:
+                self._create_call_site_table(serializer)
+            self._encode, _decode = get_serializer(
+                serializer, defer_rendering, self._call_sites)
 
         if queue is None:
             if manager_queue:
@@ -47,7 +165,34 @@ class MultiprocessHandler(BaseMultiprocessHandler):
         self._queue = queue
         self._qhandler = QueueHandler(queue)
 
-        self._async_listener = self._start_listener_thread(queue)
+        self._async_listener = None
+        self._start_receiving()
+
+    def _start_listener(self):
+        self._async_listener = self._start_listener_thread(self._queue)
+
+    def _stop_receiving(self, timeout=None):
+        # the listener receives all queued log records before the shutdown
+        # item anyway
+        deadline = self._wait_for_senders(timeout)
+        self._shutdown_listener(deadline)
+        self._stop_dispatcher(deadline)
+        self._stop_level_updates()
+
+    def _after_fork(self):
+        # the buffer and the drop counter belong to the parent process
+        self._pid = None
+        self._async_sender = None
+        self._dropped_pid = None
+        self._dropped = 0
+
+    def _flush_to_sink_process(self):
+        # the feeder thread of a multiprocessing.Queue puts the log records
+        # of the main process into the pipe asynchronously
+        queue = self._queue
+        if queue is not None and hasattr(queue, 'join_thread'):
+            queue.close()
+            queue.join_thread()
 
     def _check_queue(self, queue):
         """Check if ``queue`` has methods .get and .put
@@ -61,23 +206,121 @@ class MultiprocessHandler(BaseMultiprocessHandler):
 
     def _start_listener_thread(self, queue):
         _log.info('MultiprocessHandler._start_listener_thread')
-        listener = QueueListenerThread(queue, self)
+        listener = QueueListenerThread(queue, self,
+                                       serializer=self._serializer,
+                                       dispatcher=self._get_dispatcher(),
+                                       delivery=self._delivery)
         listener.start()
         return listener
 
     def forward_to_main(self, record):
-        self._qhandler.handle(record)
+        if self._nonblocking:
+            self._forward_nowait(record)
+            return
+
+        try:
+            self._put_or_drop(self._prepare_item(record))
+        except Exception:
+            self.handleError(record)
+
+    def _prepare_item(self, record):
+        """Returns the serialized record or the prepared LogRecord.
+        """
+        if self._encode is not None:
+            try:
+                return self._encode(record, self)
+            except TypeError as error:
+                # e.g. an extra attribute of an unsupported type. The
+                # listener accepts LogRecord instances, too.
+                _log.info('cannot serialize record: %s', error)
+
+        return self._qhandler.prepare(record)
+
+    def _put_or_drop(self, item):
+        """Puts the item into the queue. If a bounded queue is full, then the
+        item is dropped and the number of dropped items is sent to the main
+        process with the next item.
+        """
+        pid = current_pid()
+        if self._dropped_pid != pid:
+            # counter inherited from the parent process
+            self._dropped_pid = pid
+            self._dropped = 0
+
+        try:
+            if self._dropped:
+                self._queue.put_nowait(
+                    encode_control({'pid': pid, 'dropped': self._dropped}))
+                self._dropped = 0
+
+            self._queue.put_nowait(item)
+        except Queue.Full:
+            self._dropped += 1
+            self._reset_call_sites()
+
+    def _send_end_of_stream(self):
+        unsent = 0
+        if self._pid == current_pid() and self._async_sender is not None:
+            unsent = self._async_sender.close(self._close_timeout)
+            self._async_sender = None
+
+        dropped = self._dropped if self._dropped_pid == current_pid() else 0
+        message = self._end_of_stream(dropped + unsent)
+        try:
+            self._queue.put(encode_control(message), True,
+                            self._close_timeout)
+            self._dropped = 0
+        except Queue.Full:
+            _log.warning('cannot end the log stream, dropped %d log records',
+                         dropped + unsent)
+
+    def _forward_nowait(self, record):
+        try:
+            item = self._prepare_item(record)
+            self._get_async_sender().add(record.levelno, item)
+        except Exception:
+            self.handleError(record)
+
+    def _get_async_sender(self):
+        pid = current_pid()
+
+        if self._pid != pid:
+            # a buffer inherited from the parent process holds records of the
+            # parent. The parent sends them by itself.
+            self._async_sender = AsyncSender(
+                self._put_nowait,
+                BoundedBuffer(self._buffer_size, self._overflow),
+                on_dropped=self._reset_call_sites)
+            self._pid = pid
+
+        return self._async_sender
+
+    def _put_nowait(self, items):
+        for item in items:
+            try:
+                self._queue.put_nowait(item)
+            except Queue.Full:
+                raise TransportBusy()
+
+    def flush(self):
+        """Sends the buffered log records of a subprocess in non-blocking
+        mode.
+        """
+        if self._pid == current_pid() and self._async_sender is not None:
+            self._async_sender.flush()
 
     def close(self):
         _log.info('MultiprocessHandler.close for %s', self)
         BaseMultiprocessHandler.close(self)
 
         if not self._is_main_process():
+            self._end_stream()
+            self._stop_sink_process()
             return
 
-        self._shutdown_listener()
+        self._stop_receiving()
 
-    def _shutdown_listener(self):
+    def _shutdown_listener(self, deadline):
         listener_thread = self._async_listener
         if listener_thread is None:
             return
@@ -86,20 +329,29 @@ class MultiprocessHandler(BaseMultiprocessHandler):
         if queue is None:
             return
 
-        # send signal to shutdown the QueueListenerThread
+        # records received after the deadline are counted, not forwarded
+        listener_thread.set_deadline(deadline)
+
+        # send signal to shutdown the QueueListenerThread. A full or a dead
+        # locked queue must not block the shutdown.
         try:
-            queue.put(None)
+            queue.put(None, True, max(deadline - time.time(), 0) + 1.0)
+        except Queue.Full:
+            _log.warning('cannot put the shutdown item into the queue')
         except (IOError, EOFError) as error:
             # probably the queue is already closed
             _log.warning('error while closing QueueListenerThread: %s', error)
             raise
 
-        # wait until the thread consumed the shutdown item
-        if not sleep(10, check=listener_thread.is_alive):
+        # wait until the thread consumed the shutdown item. After the
+        # deadline the remaining records are only counted.
+        listener_thread.join(max(deadline - time.time(), 0) + 1.0)
+        if listener_thread.is_alive():
             _log.warning('QueueListenerThread did not shut down')
 
+        # no queue.join(): items a child put after the shutdown item are
+        # never consumed, it would wait forever
         _close_queue(queue)
-        _join_queue(queue)
         self._queue = None
         self._async_listener = None
 
@@ -115,40 +367,42 @@ def _close_queue(queue):
         _log.info('queue closed')
 
 
-def _join_queue(queue):
-    try:
-        queue.join
-    except AttributeError:
-        pass
-    else:
-        _log.info('calling queue.join()')
-        queue.join()
-        _log.info('queue joined')
-
-
-def _task_done(queue):
-    try:
-        queue.task_done
-    except AttributeError:
-        pass
-    else:
-        _log.info('QueueListenerThread: calling queue.task_done()')
-        try:
-            queue.task_done()
-        except IOError:
-            pass
-
-
 class QueueListenerThread(threading.Thread):
     """Listens for incoming queue messages and forwards them back to the
     corresponding logger, i.e. in the main process.
+
+    After a blocking get, the thread takes up to ``batch_size`` log records
+    which are already queued and forwards them in one go. A queue with a
+    ``get_many(max_items)`` method, e.g.
+    :py:class:`starlog.handlers.ring_buffer.RingBufferQueue`, hands out a
+    batch in a single call. Other queues hand out one record per call, so
+    they are not batched by default: a :py:class:`multiprocessing.Queue` got
+    slower with batches, a manager queue only a few percent faster. See
+    ``benchmarks/queue_listener.py``.
+
+    With a ``delivery`` tracker the thread tracks the sequence numbers of the
+    received records.
     """
-    def __init__(self, queue, handler, *args, **kwargs):
+    def __init__(self, queue, handler, serializer=None, dispatcher=None,
+                 batch_size=None, delivery=None, *args, **kwargs):
         super(QueueListenerThread, self).__init__(*args, **kwargs)
         self.setDaemon(True)
 
+        if batch_size is None:
+            batch_size = 100 if hasattr(queue, 'get_many') else 1
+        assert batch_size > 0
+
         self._queue = queue
         self._handler = handler
+        self._dispatcher = dispatcher
+        self._batch_size = batch_size
+        self._delivery = delivery
+        self._deadline = None
+
+        if serializer is None:
+            self._decode = None
+        else:
+            self._decode = get_decoder(serializer)
 
     def run(self):
         """Start the main loop. Wait for incoming log records in the queue.
@@ -156,28 +410,104 @@ class QueueListenerThread(threading.Thread):
         main process.
         """
         try:
-            while True:
+            running = True
+            while running:
                 try:
                     # A closed queue results in an IOError in the get() request
                     # only if no timeout is set. A None value in the queue is
                     # a signal to stop the thread.
-                    record = self._queue.get()
-                    if record is None:
-                        _log.info('shutting down QueueListenerThread')
-                        break
-                    self._process_record(record)
+                    items = self._get_batch()
                 except (IOError, EOFError):
                     # multiprocessing.managers.Queue returns an EOFError
                     _log.info('exception in QueueListenerThread.run: %s',
                               traceback.format_exc())
                     break
+
+                if None in items:
+                    _log.info('shutting down QueueListenerThread')
+                    items = items[:items.index(None)]
+                    running = False
+
+                self._process_batch(items)
         except Exception:
             _log.warning('exception in QueueListenerThread.run: %s',
                          traceback.format_exc())
 
         _log.info('QueueListenerThread stopped')
 
-        _task_done(self._queue)
+    def _get_batch(self):
+        queue = self._queue
 
-    def _process_record(self, record):
-        self._handler.forward_to_sink(record)
+        get_many = getattr(queue, 'get_many', None)
+        if get_many is not None:
+            return get_many(self._batch_size)
+
+        items = [queue.get()]
+        while len(items) < self._batch_size and items[-1] is not None:
+            try:
+                items.append(queue.get_nowait())
+            except Queue.Empty:
+                break
+        return items
+
+    def set_deadline(self, deadline):
+        """The records received after the :py:func:`time.time`
+        ``deadline`` are counted as left over instead of being forwarded.
+        """
+        self._deadline = deadline
+
+    def _process_batch(self, items):
+        deadline = self._deadline
+        if deadline is not None and time.time() > deadline:
+            self._discard_batch(items)
+            return
+
+        records = []
+        for item in items:
+            record = self._decode_record(item)
+            if record is not None:
+                records.append(record)
+
+        if not records:
+            return
+
+        if self._dispatcher is not None:
+            for record in records:
+                self._dispatcher.dispatch(record)
+        else:
+            self._handler.forward_batch_to_sink(records)
+
+    def _discard_batch(self, items):
+        left_over = 0
+        for item in items:
+            if is_control(item):
+                self._handler.handle_control(decode_control(item))
+            else:
+                left_over += 1
+        self._handler.count_left_over(left_over)
+
+    def _decode_record(self, record):
+        """Returns the decoded log record or None for a control message.
+        """
+        if is_control(record):
+            self._handler.handle_control(decode_control(record))
+            return None
+
+        if self._decode is not None \
+                and not isinstance(record, logging.LogRecord):
+            try:
+                record = self._decode(record)
+            except UnknownCallSite as error:
+                _log.info('%s', error)
+                self._handler.count_dropped(1)
+                return None
+            except Exception as error:
+                # e.g. a truncated item or one of another serializer
+                _log.warning('cannot decode a queue item: %s', error)
+                self._handler.count_dropped(1)
+                return None
+
+        if self._delivery is not None:
+            self._delivery.received(record)
+
+        return record
@@ -0,0 +1,205 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+from ..debug import get_debug_logger
+from .status_handler import metric_collection
+
+
+_log = get_debug_logger('starlog.debug.reorder')
+
+
+class ReorderStage(object):
+    """Forwards the received log records in the order of their creation
+    time, ``record.created``, instead of the order they arrived from the
+    sending processes.
+
+    A record is held back until ``window`` seconds passed since it was
+    created, so the records of other processes which were created before it
+    can overtake it. The held records of all senders are merged in a heap,
+    which also sorts the records of the threads of a sender. A record which
+    arrives after a younger record was forwarded, i.e. later than the window,
+    is forwarded immediately. These stragglers are counted in ``late`` and in
+    the metric ``starlog-late`` of the :py:class:`starlog.StatusHandler`.
+
+    The records are held ``window`` seconds after they arrived at most, and
+    the progress of the forwarded creation times is limited by the local
+    clock. So a sending process whose clock runs ahead neither delays its
+    records any further nor turns the records of the other processes into
+    stragglers.
+
+    :param callable forward: called with every record in the order of their
+        creation time, in the thread of the stage
+    :param float window: the delay in seconds
+    :param int max_records: the number of records held per sending process.
+        Further records of the sender are dropped until its held records
+        are forwarded.
+    :param callable on_dropped: called with the number of dropped records
+    """
+    def __init__(self, forward, window=0.05, max_records=10000,
+                 on_dropped=None):
+        self._forward = forward
+        self._window = window
+        self._max_records = max_records
+        self._on_dropped = on_dropped
+
+        self._condition = threading.Condition(threading.Lock())
+        # (created, arrival order, release time, record)
+        self._heap = []
+        self._order = itertools.count()
+        # held records by pid of the sending process
+        self._held = {}
+        # creation time of the last forwarded record, at most the local time
+        # minus the window
+        self._watermark = None
+
+        # set on close
+        self._closing = False
+        self._deadline = None
+
+        self.late = 0
+        self.dropped = 0
+        self.left_over = 0
+
+        self._thread = ReorderThread(self)
+        self._thread.start()
+
+    def dispatch(self, record):
+        """Holds the record back until it is forwarded in order. Drops the
+        record if ``max_records`` records of its sender are held back.
+        """
+        created = record.created
+        now = time.time()
+        pid = record.process
+
+        with self._condition:
+            held = self._held.get(pid, 0)
+            if held >= self._max_records:
+                # the sender outruns the window
+                self.dropped += 1
+                dropped = True
+            else:
+                dropped = False
+                self._held[pid] = held + 1
+                self._hold(record, created, now)
+
+        if dropped and self._on_dropped is not None:
+            self._on_dropped(1)
+
+    def _hold(self, record, created, now):
+        watermark = self._watermark
+        if watermark is not None and created < watermark:
+            # a straggler goes out with the next due records
+            self.late += 1
+            metric_collection.inc('starlog-late')
+            release = now
+        else:
+            release = min(created, now) + self._window
+
+        entry = (created, next(self._order), release, record)
+        heap = self._heap
+        if not heap or entry < heap[0]:
+            self._condition.notify()
+        heapq.heappush(heap, entry)
+
+    @property
+    def depth(self):
+        """The number of records held back.
+        """
+        return len(self._heap)
+
+    def _take(self, now):
+        """Removes the records which are due from the heap.
+
+        :return: the records in order and the seconds until the next record
+            is due
+        """
+        heap = self._heap
+        due = []
+        while heap:
+            created, _order, release, record = heap[0]
+            if release > now and not self._closing:
+                return due, release - now
+
+            heapq.heappop(heap)
+            # a clock ahead of the local one doesn't advance the watermark
+            watermark = min(created, now - self._window)
+            if self._watermark is None or watermark > self._watermark:
+                self._watermark = watermark
+            self._release(record.process)
+            due.append(record)
+
+        return due, None
+
+    def _release(self, pid):
+        held = self._held
+        count = held[pid]
+        if count > 1:
+            held[pid] = count - 1
+        else:
+            del held[pid]
+
+    def _forward_record(self, record):
+        deadline = self._deadline
+        if deadline is not None and time.time() > deadline:
+            self.left_over += 1
+            return
+
+        try:
+            self._forward(record)
+        except Exception:
+            _log.warning('exception in %s: %s', self.__class__.__name__,
+                         traceback.format_exc())
+
+    def run(self):
+        """Forwards the records when they are due. Runs in the thread of the
+        stage until it is closed.
+        """
+        condition = self._condition
+        while True:
+            with condition:
+                due, timeout = self._take(time.time())
+                if not due:
+                    if self._closing:
+                        break
+                    condition.wait(timeout)
+                    continue
+
+            for record in due:
+                self._forward_record(record)
+
+        _log.info('%s stopped', self.__class__.__name__)
+
+    def close(self, deadline=None):
+        """Forwards the held records in order and stops the thread.
+
+        :param float deadline: the :py:func:`time.time` after which the held
+            records are only counted, not forwarded
+        :return: the number of records which were not forwarded
+        """
+        with self._condition:
+            self._deadline = deadline
+            self._closing = True
+            self._condition.notify()
+
+        thread = self._thread
+        if deadline is None:
+            thread.join()
+        else:
+            thread.join(max(deadline - time.time(), 0) + 1.0)
+            if thread.is_alive():
+                _log.warning('%s did not stop', thread.name)
+
+        return self.left_over
+
+
+class ReorderThread(threading.Thread):
+    def __init__(self, stage, *args, **kwargs):
+        super(ReorderThread, self).__init__(*args, **kwargs)
+        self.setDaemon(True)
+        self._stage = stage
+
+    def run(self):
+        self._stage.run()
@@ -0,0 +1,269 @@
+import errno
+import fcntl
+import mmap
+import os
+import select
+import struct
+import tempfile
+import threading
+import time
+
+from six.moves import cPickle as pickle
+from six.moves import queue as Queue
+
+from ..debug import get_debug_logger
+from ..process import current_pid
+
+
+_log = get_debug_logger('starlog.debug.ring_buffer')
+
+
+# head, tail, number of frames, listener waits for the wakeup pipe
+_HEADER = struct.Struct('=QQQQ')
+# length of the payload, kind of the payload
+_FRAME = struct.Struct('=IB')
+
+_KIND_BYTES = 0
+_KIND_PICKLE = 1
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class RingBufferQueue(object):
+    """A multi-producer queue in a ring buffer of shared memory. It is a
+    drop-in replacement for the ``queue`` of the
+    :py:class:`starlog.MultiprocessHandler` for processes forked from the
+    process which created the queue.
+
+    Serialized log records (:py:class:`bytes`) are copied into the shared
+    memory as they are. Any other item, e.g. a :py:class:`logging.LogRecord`,
+    is pickled. Compared to
+    :py:meth:`multiprocessing.managers.SyncManager.Queue` a record is neither
+    sent to a manager process nor pickled twice.
+
+    The producers and the consumer synchronize with a :py:func:`fcntl.lockf`
+    lock on an anonymous file, the threads of a process with a
+    :py:class:`threading.Lock`. The kernel releases the lock of a process
+    which dies while it holds the lock, e.g. by SIGKILL or a segfault, so the
+    other processes carry on. The ring buffer may hold a partly written
+    record then. A waiting consumer is woken up through a pipe.
+
+    If the ring buffer is full, then :py:meth:`put_nowait` raises
+    :py:exc:`queue.Full` and the MultiprocessHandler counts the record as
+    dropped.
+
+    :param int size: size of the ring buffer in bytes
+    """
+    def __init__(self, size=4 * 1024 * 1024):
+        assert size > _FRAME.size
+
+        self._size = size
+        # an anonymous mapping is shared with forked children
+        self._buffer = mmap.mmap(-1, _HEADER.size + size)
+
+        # the lock belongs to a process, not to a file descriptor. So forked
+        # children share the file but don't inherit a held lock.
+        self._lock_file = tempfile.TemporaryFile()
+        self._lock_fd = self._lock_file.fileno()
+        self._thread_lock = threading.Lock()
+        self._thread_lock_pid = current_pid()
+
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        _set_nonblocking(self._wakeup_read)
+        _set_nonblocking(self._wakeup_write)
+
+        self._closed = False
+
+    def _acquire(self):
+        if self._thread_lock_pid != current_pid():
+            # another thread may have held the lock during the fork
+            self._thread_lock = threading.Lock()
+            self._thread_lock_pid = current_pid()
+
+        self._thread_lock.acquire()
+        try:
+            while True:
+                try:
+                    fcntl.lockf(self._lock_fd, fcntl.LOCK_EX)
+                    return
+                except IOError as error:
+                    # python 2 doesn't retry after a signal
+                    if error.errno != errno.EINTR:
+                        raise
+        except Exception:
+            self._thread_lock.release()
+            raise
+
+    def _release(self):
+        try:
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_UN)
+        finally:
+            self._thread_lock.release()
+
+    def _read_header(self):
+        return _HEADER.unpack_from(self._buffer, 0)
+
+    def _write(self, position, data):
+        buffer = self._buffer
+        start = position % self._size
+        first = min(len(data), self._size - start)
+
+        offset = _HEADER.size + start
+        buffer[offset:offset + first] = data[:first]
+        if first < len(data):
+            rest = len(data) - first
+            buffer[_HEADER.size:_HEADER.size + rest] = data[first:]
+
+    def _read(self, position, length):
+        buffer = self._buffer
+        start = position % self._size
+        first = min(length, self._size - start)
+
+        offset = _HEADER.size + start
+        data = buffer[offset:offset + first]
+        if first < length:
+            rest = length - first
+            data += buffer[_HEADER.size:_HEADER.size + rest]
+        return data
+
+    def put_nowait(self, item):
+        """Copies the item into the ring buffer. Raises :py:exc:`queue.Full`
+        if there is not enough space left.
+        """
+        if isinstance(item, bytes):
+            kind = _KIND_BYTES
+        else:
+            kind = _KIND_PICKLE
+            item = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+
+        frame = _FRAME.pack(len(item), kind) + item
+        if len(frame) > self._size:
+            raise ValueError('item of %d bytes exceeds the ring buffer size' %
+                             len(item))
+
+        self._acquire()
+        try:
+            head, tail, count, waiting = self._read_header()
+            if tail - head + len(frame) > self._size:
+                raise Queue.Full()
+
+            self._write(tail, frame)
+            _HEADER.pack_into(self._buffer, 0, head, tail + len(frame),
+                              count + 1, 0)
+        finally:
+            self._release()
+
+        if waiting:
+            self._wake_up()
+
+    def put(self, item, block=True, timeout=None):
+        """Copies the item into the ring buffer. Waits for space if
+        ``block`` is set.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            try:
+                return self.put_nowait(item)
+            except Queue.Full:
+                if not block or (deadline is not None
+                                 and time.time() >= deadline):
+                    raise
+            time.sleep(0.001)
+
+    def _wake_up(self):
+        try:
+            os.write(self._wakeup_write, b'\0')
+        except OSError as error:
+            # a full pipe wakes up the consumer anyway
+            if error.errno != errno.EAGAIN:
+                raise
+
+    def _take(self, max_items, block):
+        frames = []
+        self._acquire()
+        try:
+            head, tail, count, waiting = self._read_header()
+            if head == tail:
+                if block:
+                    _HEADER.pack_into(self._buffer, 0, head, tail, count, 1)
+                return frames
+
+            while head != tail and len(frames) < max_items:
+                length, kind = _FRAME.unpack(self._read(head, _FRAME.size))
+                frames.append((kind, self._read(head + _FRAME.size, length)))
+                head += _FRAME.size + length
+
+            _HEADER.pack_into(self._buffer, 0, head, tail,
+                              count - len(frames), 0)
+        finally:
+            self._release()
+
+        return [pickle.loads(data) if kind == _KIND_PICKLE else data
+                for kind, data in frames]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def get(self, block=True, timeout=None):
+        """Removes and returns the oldest item. Raises :py:exc:`queue.Empty`
+        if no item is available within ``timeout`` seconds.
+        """
+        return self.get_many(1, block, timeout)[0]
+
+    def get_many(self, max_items, block=True, timeout=None):
+        """Removes and returns up to ``max_items`` of the oldest items. Waits
+        for at least one item if ``block`` is set.
+        """
+        if self._closed:
+            raise IOError('queue is closed')
+
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            items = self._take(max_items, block)
+            if items:
+                return items
+
+            if not block:
+                raise Queue.Empty()
+
+            wait = 1.0
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    raise Queue.Empty()
+
+            self._wait(wait)
+
+    def _wait(self, timeout):
+        readable, _, _ = select.select([self._wakeup_read], [], [], timeout)
+        if readable:
+            try:
+                os.read(self._wakeup_read, 4096)
+            except OSError as error:
+                if error.errno != errno.EAGAIN:
+                    raise
+
+    def qsize(self):
+        return self._read_header()[2]
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        head, tail, _count, _waiting = self._read_header()
+        return tail - head + _FRAME.size >= self._size
+
+    def close(self):
+        """Releases the shared memory and the wakeup pipe in this process.
+        """
+        if self._closed:
+            return
+
+        self._closed = True
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+        self._lock_file.close()
+        self._buffer.close()
@@ -0,0 +1,165 @@
+import logging
+import logging.config
+import multiprocessing
+import os
+import signal
+import traceback
+
+from ..debug import get_debug_logger
+
+
+_log = get_debug_logger('starlog.debug.sink_process')
+
+
+def _fork_context():
+    # the sink process inherits the handler, which can't be pickled for the
+    # spawn or forkserver start method. Python 2 always forks.
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is None:
+        return multiprocessing
+    return get_context('fork')
+
+
+class SinkProcessError(Exception):
+    pass
+
+
+class SinkProcess(object):
+    """A dedicated process which receives the log records of all other
+    processes and forwards them to the sink logger. So decoding and
+    formatting log records doesn't compete with the main process for the GIL.
+
+    The sink process is forked from the main process, whatever the start
+    method of :py:mod:`multiprocessing` is. It applies the
+    ``config`` with :py:func:`logging.config.dictConfig` and starts the
+    listener of the handler. The main process and its children send their log
+    records to the sink process then.
+
+    :param handler: the :py:class:`BaseMultiprocessHandler` whose listener
+        runs in the sink process
+    :param dict config: a :py:func:`logging.config.dictConfig` configuration
+        of the sink process. If not set, then the sink process uses the
+        logging configuration inherited from the main process.
+    :param float timeout: seconds to wait for the start of the sink process
+    :param float stop_timeout: seconds to wait for the exit of the sink
+        process, which forwards the pending log records first
+    :param int shard: the listener shard of the handler which the sink
+        process receives
+    """
+    def __init__(self, handler, config=None, timeout=60, stop_timeout=10,
+                 shard=0):
+        self._handler = handler
+        self._shard = shard
+        self._config = config
+        self._timeout = timeout
+        self._stop_timeout = stop_timeout
+
+        self._connection = None
+        self._process = None
+
+    @property
+    def pid(self):
+        if self._process is None:
+            return None
+        return self._process.pid
+
+    def start(self):
+        """Starts the sink process and waits until its listener runs.
+
+        :return: the address of the listener in the sink process
+        """
+        context = _fork_context()
+        connection, child_connection = context.Pipe()
+        process = context.Process(
+            target=self._run, args=(child_connection, ),
+            name='starlog-sink')
+        process.daemon = True
+        process.start()
+        child_connection.close()
+
+        self._connection = connection
+        self._process = process
+
+        if not connection.poll(self._timeout):
+            self.stop()
+            raise SinkProcessError('sink process did not start within %s '
+                                   'seconds' % self._timeout)
+
+        try:
+            status, info = connection.recv()
+        except EOFError:
+            status, info = 'error', 'sink process died'
+
+        if status != 'started':
+            self.stop()
+            raise SinkProcessError(info)
+
+        _log.info('sink process %d started', process.pid)
+        return info
+
+    def _run(self, connection):
+        # the main process controls the lifetime of the sink process
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        handler = self._handler
+        main_pid = os.getppid()
+        try:
+            handler._become_sink_process(self._shard)
+            if self._config is not None:
+                logging.config.dictConfig(self._config)
+            handler._start_receiving()
+        except Exception:
+            connection.send(('error', traceback.format_exc()))
+            return
+
+        # the log records of the main process may still be on their way when
+        # it stops the sink process
+        handler._delivery.expect_sender(main_pid)
+        connection.send(('started', handler._get_listener_address()))
+
+        try:
+            # blocks until the main process stops the sink process or dies
+            sender = connection.recv()
+        except (EOFError, IOError):
+            _log.warning('lost connection to the main process %d', main_pid)
+            sender = False
+
+        if not sender:
+            handler._delivery.forget_sender(main_pid)
+
+        try:
+            handler._stop_receiving()
+        finally:
+            logging.shutdown()
+
+    def stop(self, timeout=None, sender=False):
+        """Stops the listener in the sink process after it received the
+        pending log records and waits for the sink process to exit.
+
+        :param bool sender: whether the main process sent log records to the
+            sink process. The sink process waits for the end of their stream.
+        """
+        if timeout is None:
+            timeout = self._stop_timeout
+
+        connection = self._connection
+        process = self._process
+        if process is None:
+            return
+
+        self._connection = None
+        self._process = None
+
+        try:
+            connection.send(sender)
+        except (IOError, OSError, EOFError) as error:
+            _log.warning('cannot stop sink process: %s', error)
+        finally:
+            connection.close()
+
+        process.join(timeout)
+        if process.is_alive():
+            _log.warning('sink process %d did not stop. Terminating it.',
+                         process.pid)
+            process.terminate()
+            process.join()
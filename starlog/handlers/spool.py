@@ -0,0 +1,274 @@
+import collections
+import os
+import threading
+import traceback
+
+from ..debug import get_debug_logger
+from ..serializer import decode_messages, encode_message
+from .buffering import TransportBusy
+
+
+_log = get_debug_logger('starlog.debug.spool')
+
+
+SEGMENT_SUFFIX = '.spool'
+
+
+def list_segments(directory):
+    """Returns the paths of the segment files of a spool in the order of
+    their messages.
+    """
+    names = [name for name in os.listdir(directory)
+             if name.endswith(SEGMENT_SUFFIX)]
+    return [os.path.join(directory, name) for name in sorted(names)]
+
+
+def iter_spool(directory):
+    """Yields ``(segment path, frames)`` for each message of a spool in
+    order, e.g. of a process which exited before its spool was replayed.
+    """
+    for path in list_segments(directory):
+        with open(path, 'rb') as stream:
+            data = stream.read()
+        for frames, _end in decode_messages(data):
+            yield path, frames
+
+
+class Spool(object):
+    """An append-only store of the messages a process couldn't send, in
+    segment files of a directory. The messages are stored with
+    :py:func:`starlog.serializer.encode_message`, i.e. the serialized log
+    records as they are sent.
+
+    Once a message is spooled, the following messages are spooled as well
+    until the spool is replayed, so the messages keep their order. A segment
+    is deleted as soon as its messages are replayed. The messages of a spool
+    which is closed before it is replayed stay in the directory, see
+    ``starlog-replay``.
+
+    The spool is thread safe.
+
+    :param str directory: the directory of the segment files. It is created
+        with the first spooled message.
+    :param int max_bytes: the disk budget. Messages which don't fit are
+        dropped.
+    :param int segment_bytes: a new segment file is started when the current
+        one reaches this size
+    """
+    def __init__(self, directory, max_bytes=100 * 1024 * 1024,
+                 segment_bytes=4 * 1024 * 1024):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._segment_bytes = segment_bytes
+
+        self._lock = threading.RLock()
+        # [path, size] of the segment files, oldest first
+        self._segments = collections.deque()
+        self._segment_index = 0
+        self._size = 0
+        self._writer = None
+        # number of messages which weren't replayed
+        self._pending = 0
+
+        # the segment which is replayed: path, position of the next message
+        # and the messages read ahead as (frames, end position)
+        self._read_path = None
+        self._read_position = 0
+        self._read_ahead = collections.deque()
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def __len__(self):
+        return self._pending
+
+    def send_or_spool(self, frames, send):
+        """Sends a message with ``send`` if no messages are spooled.
+        Otherwise, or if ``send`` raises :py:exc:`TransportBusy`, the message
+        is spooled.
+
+        :return: False if the message doesn't fit into the disk budget and
+            was dropped
+        """
+        with self._lock:
+            if not self._pending:
+                try:
+                    send(frames)
+                    return True
+                except TransportBusy:
+                    pass
+
+            return self.append(frames)
+
+    def append(self, frames):
+        """Spools a message.
+
+        :return: False if the message doesn't fit into the disk budget
+        """
+        data = encode_message(frames)
+        with self._lock:
+            if self._size + len(data) > self._max_bytes:
+                return False
+
+            segment = self._segments[-1] if self._segments else None
+            try:
+                if segment is None or segment[1] >= self._segment_bytes:
+                    segment = self._start_segment()
+
+                self._writer.write(data)
+                self._writer.flush()
+            except (IOError, OSError) as error:
+                _log.warning('cannot spool a message: %s', error)
+                return False
+
+            segment[1] += len(data)
+            self._size += len(data)
+            self._pending += 1
+            return True
+
+    def _start_segment(self):
+        if self._writer is not None:
+            self._writer.close()
+
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+
+        self._segment_index += 1
+        path = os.path.join(self._directory, '%08d%s' % (
+            self._segment_index, SEGMENT_SUFFIX))
+        self._writer = open(path, 'ab')
+
+        segment = [path, 0]
+        self._segments.append(segment)
+        return segment
+
+    def replay(self, send):
+        """Sends the spooled messages in order with ``send`` until the spool
+        is empty or ``send`` raises :py:exc:`TransportBusy`.
+
+        :return: True if the spool is empty
+        """
+        with self._lock:
+            while self._pending:
+                frames = self._peek()
+                if frames is None:
+                    break
+                try:
+                    send(frames)
+                except TransportBusy:
+                    return False
+                self._commit()
+            return True
+
+    def _peek(self):
+        if not self._read_ahead:
+            self._read_segment()
+        if not self._read_ahead:
+            return None
+        return self._read_ahead[0][0]
+
+    def _read_segment(self):
+        while self._segments:
+            path, size = self._segments[0]
+            if path != self._read_path:
+                self._read_path = path
+                self._read_position = 0
+
+            if self._read_position < size:
+                with open(path, 'rb') as stream:
+                    stream.seek(self._read_position)
+                    data = stream.read(size - self._read_position)
+                for frames, end in decode_messages(data):
+                    self._read_ahead.append(
+                        (frames, self._read_position + end))
+                if self._read_ahead:
+                    return
+                _log.warning('spool segment %s is truncated', path)
+
+            # the older segment was replayed completely
+            self._remove_segment()
+
+        # lost messages of truncated segments
+        self._pending = 0
+
+    def _commit(self):
+        _frames, end = self._read_ahead.popleft()
+        self._read_position = end
+        self._pending -= 1
+
+        if not self._pending:
+            # start from scratch with the next spooled message
+            while self._segments:
+                self._remove_segment()
+
+    def _remove_segment(self):
+        path, size = self._segments.popleft()
+        if not self._segments and self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+        self._size -= size
+        self._read_path = None
+        self._read_ahead.clear()
+        try:
+            os.remove(path)
+        except OSError as error:
+            _log.warning('cannot remove spool segment %s: %s', path, error)
+
+    def close(self):
+        """Closes the spool. The messages which weren't replayed stay in the
+        directory.
+        """
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+            if self._pending:
+                _log.warning('%d messages left in the spool %s',
+                             self._pending, self._directory)
+                return
+
+            try:
+                os.rmdir(self._directory)
+            except OSError:
+                # never created, or other files
+                pass
+
+
+class SpoolReplayer(threading.Thread):
+    """Replays a :py:class:`Spool` in the background whenever messages are
+    spooled, retrying every ``retry_interval`` seconds while the transport is
+    busy.
+    """
+    def __init__(self, spool, send, retry_interval=0.1, *args, **kwargs):
+        super(SpoolReplayer, self).__init__(*args, **kwargs)
+        self.setDaemon(True)
+
+        self._spool = spool
+        self._send = send
+        self._retry_interval = retry_interval
+        self._wakeup = threading.Event()
+        self._running = True
+
+    def run(self):
+        try:
+            while self._running:
+                self._wakeup.clear()
+                if self._spool.replay(self._send):
+                    self._wakeup.wait(1.0)
+                else:
+                    self._wakeup.wait(self._retry_interval)
+        except Exception:
+            _log.warning('exception in %s.run: %s',
+                         self.__class__.__name__, traceback.format_exc())
+
+        _log.info('%s stopped', self.__class__.__name__)
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    def shutdown(self):
+        self._running = False
+        self._wakeup.set()
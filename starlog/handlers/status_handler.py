@@ -29,6 +29,28 @@ Metrics that are collected:
   - ``%(2xx)d``
   - ``%(4xx)d``
 
+- the number of log records dropped by child processes of a
+  :py:class:`starlog.MultiprocessHandler` or :py:class:`starlog.ZmqHandler`
+  in non-blocking mode: ``%(starlog-dropped)d``
+
+- with ``track_delivery`` of these handlers, the number of log records lost
+  on their way to the main process, reordered or received twice:
+  ``%(starlog-lost)d``, ``%(starlog-reordered)d``,
+  ``%(starlog-duplicates)d``
+
+- the latency between sending and receiving a log record in milliseconds as
+  histogram, with ``track_delivery``:
+
+  - ``%(starlog-latency-ms.count)d``
+  - ``%(starlog-latency-ms.p50)d``
+  - ``%(starlog-latency-ms.p90)d``
+  - ``%(starlog-latency-ms.p99)d``
+  - ``%(starlog-latency-ms.max)f``
+
+- with ``reorder_window`` of these handlers, the number of log records which
+  arrived after the window and were forwarded out of order:
+  ``%(starlog-late)d``
+
 
 Use case: write out status logs every some seconds to standard out and sent
 full logs to syslog or a file.
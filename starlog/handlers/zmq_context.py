@@ -0,0 +1,90 @@
+import threading
+
+import zmq
+
+from ..debug import get_debug_logger
+from ..process import current_pid, register_after_fork
+
+
+_log = get_debug_logger('starlog.debug.zmq_context')
+
+
+class ContextRegistry(object):
+    """Shares one :py:class:`zmq.Context` between all starlog sockets of a
+    process, i.e. one set of I/O threads instead of one per socket.
+
+    The context is reference counted. It is terminated when the last socket
+    releases it, which waits until the sockets sent their pending messages
+    according to their ``LINGER`` option. A child process creates its own
+    context, the context of the parent process is unusable after a fork.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._context = None
+        self._users = 0
+
+    def _after_fork(self):
+        # the lock may have been held by a thread of the parent process
+        self._lock = threading.Lock()
+        self._pid = None
+        self._context = None
+        self._users = 0
+
+    def acquire(self, io_threads=1):
+        """Returns the context of the current process and increments its
+        reference count.
+
+        :param int io_threads: number of I/O threads if a new context is
+            created. It can't be changed for an existing context.
+        """
+        with self._lock:
+            pid = current_pid()
+            if self._pid != pid:
+                # forked without fork tracking
+                self._pid = pid
+                self._context = None
+                self._users = 0
+
+            context = self._context
+            if context is None or context.closed:
+                _log.info('creating zmq context with %d io threads',
+                          io_threads)
+                context = self._context = zmq.Context(io_threads)
+                self._users = 0
+            elif io_threads != context.get(zmq.IO_THREADS):
+                _log.warning('zmq context already runs %d io threads',
+                             context.get(zmq.IO_THREADS))
+
+            self._users += 1
+            return context
+
+    def release(self, context):
+        """Decrements the reference count of the context and terminates it if
+        it isn't used any more.
+        """
+        with self._lock:
+            if context is not self._context or self._pid != current_pid():
+                # a context of the parent process or an already terminated one
+                return
+
+            self._users -= 1
+            if self._users > 0:
+                return
+
+            self._context = None
+
+        _log.info('terminating zmq context')
+        context.term()
+
+
+_registry = ContextRegistry()
+register_after_fork(_registry, ContextRegistry._after_fork)
+
+
+def acquire_context(io_threads=1):
+    return _registry.acquire(io_threads)
+
+
+def release_context(context):
+    _registry.release(context)
@@ -2,15 +2,37 @@ import errno
 import os
 import re
 import threading
+import time
 import traceback
-from logging import makeLogRecord
 
+import six
 import zmq
+from zmq.utils.monitor import parse_monitor_message
 
 from ..debug import get_debug_logger
-from ..serializer import record_to_dict
+from ..process import current_pid
+from ..serializer import (
+    CALL_SITE_MAGIC,
+    UnknownCallSite,
+    binary_encode_log_record,
+    decode_control,
+    encode_control,
+    get_decoder,
+    get_serializer,
+    is_control,
+    json_encode_log_record)
 from ..utils import retry, wait_for_event, RetryAbortedByCheck
 from .base_handler import BaseMultiprocessHandler
+from .batching import BatchSender
+from .buffering import (
+    AsyncSender,
+    BoundedBuffer,
+    DROP_NEWEST,
+    TransportBusy,
+    check_overflow_policy)
+from .circuit_breaker import ConnectionSupervisor
+from .spool import Spool, SpoolReplayer
+from .zmq_context import acquire_context, release_context
 
 
 _log = get_debug_logger('starlog.debug.zmq_handler')
@@ -30,6 +52,21 @@ def _requires_random_bind(address):
         return True
 
 
+def shard_address(address, index):
+    """Returns the address of the listener shard ``index``. The first shard
+    uses ``address``. The other shards use the following tcp ports, a random
+    port if ``address`` has no port, or ``address`` with the suffix
+    ``-<index>`` for the other transports.
+    """
+    if index == 0 or _requires_random_bind(address):
+        return address
+
+    match = re.match(r'(tcp://.*):(\d+)$', address)
+    if match:
+        return '%s:%d' % (match.group(1), int(match.group(2)) + index)
+    return '%s-%d' % (address, index)
+
+
 class RobustZmqSocket(object):
     UNRECOVERABLE_ERRORS = [
         # "Permission denied"
@@ -43,11 +80,25 @@ class RobustZmqSocket(object):
     }
 
     def __init__(self, socket_type, address, backoff_factor=2.0, tries=8,
-                 check=None, socket_options=DEFAULT_SOCKET_OPTIONS):
+                 check=None, socket_options=DEFAULT_SOCKET_OPTIONS,
+                 io_threads=1, copy_threshold=None, immediate=False,
+                 linger=1000, monitor_connects=False):
         # default: tries up to 4 minutes 15 seconds to bind / connect to
         # a socket
         self._socket_type = socket_type
         self._address = address
+        self._io_threads = io_threads
+        self._copy_threshold = copy_threshold
+        # queue messages only for completed connections
+        self._immediate = immediate
+        # milliseconds the termination of the context waits for the pending
+        # messages of a socket. The zmq default of -1 waits forever.
+        self._linger = linger
+        # watches the connections of the socket, see reconnected(). The
+        # lock guards the monitor against a reconnect in another thread.
+        self._monitor_connects = monitor_connects
+        self._monitor = None
+        self._monitor_lock = threading.Lock()
 
         self._context = None
         self._socket = None
@@ -68,11 +119,18 @@ class RobustZmqSocket(object):
             retry_log=self._log_bind_attempt)
 
     def _obtain_context(self):
+        # all sockets of a process share a context. A reconnect reuses it.
         if self._context is None:
-            self._context = zmq.Context()
+            self._context = acquire_context(self._io_threads)
 
         return self._context
 
+    def _create_socket(self):
+        context = self._obtain_context()
+        socket = context.socket(self._socket_type)
+        socket.linger = self._linger
+        return socket
+
     def _log_bind_attempt(self, _trial, last_trial=False):
         if last_trial:
             _log.error('bind to %s failed. Aborting.', self._address)
@@ -92,8 +150,7 @@ class RobustZmqSocket(object):
     def _bind(self):
         try:
             self.close_socket()
-            context = self._obtain_context()
-            self._socket = context.socket(self._socket_type)
+            self._socket = self._create_socket()
 
             if _requires_random_bind(self._address):
                 port = self._socket.bind_to_random_port(self._address)
@@ -112,12 +169,46 @@ class RobustZmqSocket(object):
         connect_with_retries = self._retry_connect(self._connect)
         connect_with_retries()
 
+    def connect_once(self):
+        """Connects without retries.
+        """
+        self._connect()
+
     def _connect(self):
-        self.close_socket()
-        context = self._obtain_context()
-        self._socket = context.socket(self._socket_type)
+        # the pending messages of the replaced socket are discarded. They
+        # would block the termination of the context otherwise.
+        self.close_socket(linger=0)
+        self._socket = self._create_socket()
+        if self._copy_threshold is not None:
+            self._socket.copy_threshold = self._copy_threshold
+        if self._immediate:
+            self._socket.immediate = 1
+        if self._monitor_connects:
+            with self._monitor_lock:
+                self._monitor = self._socket.get_monitor_socket(
+                    zmq.EVENT_CONNECTED)
         self._socket.connect(self._address)
 
+    def reconnected(self):
+        """Returns True if the socket connected to the peer since the last
+        call, e.g. zmq reconnected it to a restarted peer. Requires
+        ``monitor_connects``.
+        """
+        with self._monitor_lock:
+            monitor = self._monitor
+            if monitor is None \
+                    or not monitor.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                return False
+
+            connected = False
+            while True:
+                try:
+                    frames = monitor.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    return connected
+                event = parse_monitor_message(frames)['event']
+                connected = connected or event == zmq.EVENT_CONNECTED
+
     def _set_socket_options(self):
         if not self._socket_options:
             return
@@ -125,9 +216,9 @@ class RobustZmqSocket(object):
         for option, value in self._socket_options.items():
             setattr(self._socket, option, value)
 
-    def recv_json(self):
+    def recv_multipart(self, flags=0, copy=True):
         try:
-            return self._socket.recv_json()
+            return self._socket.recv_multipart(flags, copy=copy)
         except zmq.ZMQError as error:
             if error.errno == errno.EAGAIN:
                 # recv timeout
@@ -135,40 +226,86 @@ class RobustZmqSocket(object):
 
             self.bind()
 
-    def send_json(self, data):
+    def send_multipart(self, frames, flags=0, reconnect=True, copy=True,
+                       track=False):
+        """Sends a multipart message.
+
+        :param bool reconnect: if set, then the socket reconnects with retries
+            after an error. Otherwise the error is raised.
+        :param bool copy: if not set, then frames of at least
+            ``copy_threshold`` bytes are sent without copying them.
+        :param bool track: if set, then a :py:class:`zmq.MessageTracker` is
+            returned which tells when zmq released the frames.
+        """
         try:
-            return self._socket.send_json(data)
+            return self._socket.send_multipart(frames, flags, copy=copy,
+                                               track=track)
+        except zmq.Again:
+            # non-blocking send and the high water mark is reached
+            raise
         except zmq.ZMQError:
+            if not reconnect:
+                raise
             self.connect()
-            return self._socket.send_json(data)
+            return self._socket.send_multipart(frames, flags, copy=copy,
+                                               track=track)
 
-    def close(self):
-        """Close the zmq socket and destroy the zmq context.
+    def close(self, linger=None):
+        """Close the zmq socket and release the shared zmq context.
+
+        :param int linger: milliseconds to wait for the pending messages of
+            the socket instead of the ``LINGER`` socket option
         """
-        self.close_socket()
+        self.close_socket(linger)
         self.destroy_context()
 
     def destroy_context(self):
-        """Destroy the zmq context.
+        """Release the shared zmq context. The last socket of the process
+        terminates it, which waits for the pending messages of the sockets.
         """
         if self._context is not None:
-            if not self._context.closed:
-                self._context.destroy()
+            context = self._context
             self._context = None
+            release_context(context)
 
-    def close_socket(self):
+    def close_socket(self, linger=None):
         """Close the zmq socket.
         """
-        if self._socket is not None:
-            if not self._socket.closed:
-                self._socket.close()
-            self._socket = None
+        socket = self._socket
+        if socket is None:
+            return
+
+        self._socket = None
+        with self._monitor_lock:
+            monitor = self._monitor
+            self._monitor = None
+            if monitor is not None:
+                if not socket.closed:
+                    socket.disable_monitor()
+                monitor.close(linger=0)
+
+        if socket.closed:
+            return
+        if linger is None:
+            socket.close()
+        else:
+            socket.close(linger=linger)
 
     @property
     def address(self):
         assert not _requires_random_bind(self._address)
         return self._address
 
+    @property
+    def socket(self):
+        """The underlying zmq socket. It changes on every bind / connect.
+        """
+        return self._socket
+
+    @property
+    def context(self):
+        return self._obtain_context()
+
 
 class ZmqHandler(BaseMultiprocessHandler):
     """The ZmqHandler creates a zmq connection between the main
@@ -190,97 +327,734 @@ class ZmqHandler(BaseMultiprocessHandler):
         will bind the socket to a random port.
     :param str logger: name of the logger where log records are send to in the
         main process.
+    :param str serializer: wire format of the log records: ``json``
+        (default), ``binary`` or ``pickle``. See
+        :py:func:`starlog.serializer.get_serializer`.
+    :param int batch_size: if set, child processes send their log records in
+        batches of up to this number of records as one multipart message.
+    :param int batch_bytes: a batch is sent as soon as its records reach this
+        size in bytes.
+    :param float batch_interval: the maximum number of seconds a log record
+        stays in a batch.
+    :param bool nonblocking: if set, child processes put their log records in
+        a bounded buffer which is sent by a background thread. A log call never
+        waits for the main process then. With ``batch_size`` the background
+        thread sends up to this number of buffered records at once.
+    :param int buffer_size: capacity of the buffer in non-blocking mode.
+    :param str overflow: what to drop in non-blocking mode if the buffer is
+        full: ``drop_newest`` (default), ``drop_oldest`` or
+        ``drop_lowest_level``. The main process counts the dropped records in
+        the metric ``starlog-dropped`` of the
+        :py:class:`starlog.StatusHandler`.
+
+    :param float reconnect_deadline: after a connection error of a child
+        process, a background thread reconnects for up to this number of
+        seconds. Meanwhile log records are buffered in non-blocking mode and
+        dropped otherwise. A log call never waits for a reconnect.
+    :param int dispatch_threads: if set, received log records are forwarded
+        to the ``logger`` by this number of threads instead of the receiving
+        thread. The records of a logger keep their order.
+    :param int dispatch_queue_size: capacity of the queue of each dispatcher
+        thread.
+    :param bool sink_process: if set, a dedicated sink process is forked
+        which receives the log records and forwards them to the ``logger``.
+        The main process sends its own log records to the sink process, too.
+        See :py:class:`starlog.handlers.sink_process.SinkProcess`.
+    :param dict sink_config: a :py:func:`logging.config.dictConfig`
+        configuration applied in the sink process. Implies ``sink_process``.
+    :param bool eager_connect: if set, a child process connects right after
+        the fork instead of on its first log record. Requires python >= 3.7.
+    :param int io_threads: number of I/O threads of the zmq context. All
+        starlog sockets of a process share one context, which is created
+        with the value of the first socket.
+    :param int zero_copy_threshold: serialized log records of at least this
+        size in bytes, e.g. records with long tracebacks, are sent without
+        copying them into zmq messages. ``None`` disables it.
+    :param bool client_only: if set, the handler doesn't bind the
+        ``address``, but all processes including the main process send their
+        log records to an existing listener, e.g. a ``starlog-collector``.
+    :param str publish_address: if set, the listener republishes every
+        received log record on a :py:const:`zmq.PUB` socket bound to this
+        address, with the logger name as topic. See ``starlog-tail``.
+    :param int publish_hwm: the number of log records queued for each
+        subscriber. Records for a subscriber which falls behind are dropped,
+        the sink logger never waits for a subscriber.
+    :param bool level_pushdown: if set, child processes discard log records
+        which the ``logger`` rejects because of its level, before they are
+        serialized. A changed level reaches the children within a second.
+        See :py:class:`starlog.handlers.level_table.LevelTable`.
+    :param bool defer_rendering: if set, child processes send the message
+        template and its args instead of the rendered message if the args are
+        primitive values. The message is rendered in the main process, and
+        only if a handler of the ``logger`` formats it. Rendering a few
+        primitive values is about as cheap as serializing them, so this pays
+        off if the handlers of the ``logger`` discard many records, e.g. by
+        their levels or filters.
+    :param bool call_site_table: if set, child processes send the fixed
+        attributes of a call site, like the logger name, the pathname and the
+        line number, only with the first log record of the call site.
+        A child process sends the call sites again after its socket
+        connected anew, e.g. to a restarted listener. Requires the
+        ``binary`` serializer. See
+        :py:class:`starlog.serializer.CallSiteTable`.
+    :param bool track_delivery: if set, child processes stamp their log
+        records with a sequence number and the send time (the attributes
+        ``starlog_seq`` and ``starlog_sent``). The listener counts lost and
+        reordered records and the latency per child in the metrics of the
+        :py:class:`starlog.StatusHandler`, see
+        :py:class:`starlog.handlers.delivery.DeliveryTracker`. A listener
+        tracks the stamped records of any sender, e.g. a
+        ``starlog-collector`` those of the applications.
+    :param float close_timeout: :py:meth:`close` of the main process waits
+        up to this number of seconds until the child processes which sent
+        log records ended their streams, i.e. sent their buffered records and
+        an end of stream marker. A child ends its stream in :py:meth:`close`
+        and when a :py:mod:`multiprocessing` process exits. The records not
+        forwarded to the ``logger`` at the deadline are counted in
+        ``left_over_records``. Children wait up to this number of seconds
+        until their records are sent before they close their sockets.
+    :param str spool_directory: if set, a child process writes the messages
+        it can't send, e.g. while the listener is unreachable or the
+        connection is saturated, to a spool in a subdirectory of this
+        directory, instead of dropping them or waiting. A background thread
+        sends the spooled messages in order as soon as the connection works
+        again. A spool which wasn't sent on close stays on disk and can be
+        sent or printed with ``starlog-replay``. See
+        :py:class:`starlog.handlers.spool.Spool`.
+    :param int spool_max_bytes: the disk budget of the spool of each child
+        process. Messages which exceed it are dropped.
+    :param int spool_segment_bytes: the size of the segment files of a spool
+    :param float reorder_window: if set, the received log records are
+        forwarded in the order of their creation time. Each record is held
+        back for this number of seconds, e.g. ``0.05``, so the records of
+        other processes created before it can overtake it. Records which
+        arrive later are forwarded immediately and counted in
+        ``late_records`` and in the metric ``starlog-late``. With
+        ``dispatch_threads`` the order is kept per logger. See
+        :py:class:`starlog.handlers.reorder.ReorderStage`.
+    :param int reorder_max_records: the number of records held back per
+        sending process. Further records of the process are dropped and
+        counted in ``dropped_records``.
+    :param int shards: the number of listener sockets. A child process
+        sends to the shard of its pid. See
+        :py:func:`starlog.handlers.zmq_handler.shard_address` for the
+        addresses of the shards and :py:attr:`addresses`. Not supported
+        with a ``publish_address``. With ``sink_process`` or
+        ``sink_config``, every shard runs in its own sink process, which
+        decodes and forwards the records of its shard to the ``logger`` of
+        its logging configuration. So receiving scales across CPU cores,
+        given the handlers of the ``logger`` can be used by several
+        processes, e.g. a file per process or syslog. Otherwise the shards
+        are received by threads of the main process, which overlap waiting
+        for the sockets but don't add CPU parallelism: decoding is bound to
+        one core by the GIL.
+
+    With batching or non-blocking mode enabled, a child process should call
+    :py:meth:`flush` or :py:meth:`close` before it exits. Otherwise the
+    buffered log records may get lost.
     """
 
     def __init__(self, address='tcp://127.0.0.1:5557',
-                 logger='starlog.logsink'):
-        BaseMultiprocessHandler.__init__(self, logger)
+                 logger='starlog.logsink', serializer='json',
+                 batch_size=None, batch_bytes=65536, batch_interval=0.05,
+                 nonblocking=False, buffer_size=10000, overflow=DROP_NEWEST,
+                 reconnect_deadline=60.0, dispatch_threads=0,
+                 dispatch_queue_size=10000, sink_process=False,
+                 sink_config=None, eager_connect=False, io_threads=1,
+                 zero_copy_threshold=65536, client_only=False,
+                 publish_address=None, publish_hwm=1000,
+                 level_pushdown=True, defer_rendering=False,
+                 call_site_table=False, track_delivery=False,
+                 close_timeout=10.0, spool_directory=None,
+                 spool_max_bytes=100 * 1024 * 1024,
+                 spool_segment_bytes=4 * 1024 * 1024,
+                 reorder_window=None, reorder_max_records=10000,
+                 shards=1):
+        if shards < 1:
+            raise ValueError('shards must be at least 1: %r' % (shards, ))
+        if shards > 1 and publish_address is not None:
+            raise ValueError('a publish_address is not supported with '
+                             'shards')
+
+        BaseMultiprocessHandler.__init__(
+            self, logger, dispatch_threads, dispatch_queue_size,
+            sink_process, sink_config, level_pushdown and not client_only,
+            track_delivery, close_timeout, reorder_window,
+            reorder_max_records, sink_processes=shards)
+        check_overflow_policy(overflow)
 
         self._sender_socket_type = zmq.PUSH
         self._receiver_socket_type = zmq.PULL
 
+        self._serializer = serializer
+        if call_site_table:
+            self._create_call_site_table(serializer)
+        self._encode, _decode = get_serializer(
+            serializer, defer_rendering, self._call_sites)
+
+        self._batch_size = batch_size
+        self._batch_bytes = batch_bytes
+        self._batch_interval = batch_interval
+
+        self._nonblocking = nonblocking
+        self._buffer_size = buffer_size
+        self._overflow = overflow
+
+        self._reconnect_deadline = reconnect_deadline
+        # seconds between the checks whether the socket of a child process
+        # reconnected, e.g. to a restarted listener
+        self._reconnect_check_interval = 0.1
+        self._reconnect_check_time = 0
+        self._eager_connect = eager_connect
+        self._io_threads = io_threads
+        self._zero_copy_threshold = zero_copy_threshold
+
+        self._spool_directory = spool_directory
+        self._spool_max_bytes = spool_max_bytes
+        self._spool_segment_bytes = spool_segment_bytes
+
         self._address = address
-        self._async_listener = self._start_listener_thread(address)
+        self._addresses = [shard_address(address, index)
+                           for index in range(shards)]
+        self._publish_address = publish_address
+        self._publish_hwm = publish_hwm
+        self._async_listeners = []
 
         # for children processes
         self._pid = None
+        self._socket = None
+        self._supervisor = None
+        self._batch = None
+        self._async_sender = None
+        # records dropped while the circuit of the connection is open
+        self._dropped = 0
+        # zmq.MessageTracker of the records sent without copying
+        self._trackers = []
+        self._spool = None
+        self._replayer = None
+
+        if client_only:
+            if _requires_random_bind(address):
+                raise ValueError('client_only requires an address with a '
+                                 'port: %s' % address)
+            # the main process sends its log records like a child process
+            self._parent_pid = None
+            self._receiving = True
+        else:
+            self._start_receiving()
+
+    def _start_listener(self):
+        listeners = self._async_listeners
+        for address in list(self._addresses):
+            listeners.append(self._start_listener_thread(address))
+
+        self._addresses = [listener.get_address() for listener in listeners]
+        self._address = self._addresses[0]
+        self._publish_address = listeners[0].get_publish_address()
+
+    def _stop_receiving(self, timeout=None):
+        deadline = self._wait_for_senders(timeout)
+
+        listener_threads = self._async_listeners
+        self._async_listeners = []
+        for listener_thread in listener_threads:
+            listener_thread.shutdown(drain=True, deadline=deadline)
+
+        for listener_thread in listener_threads:
+            # after the deadline the remaining records are only counted
+            listener_thread.join(max(deadline - time.time(), 0) + 1.0)
+            if listener_thread.is_alive():
+                _log.warning('ZmqListenerThread did not shut down')
+
+        self._stop_dispatcher(deadline)
+        self._stop_level_updates()
+
+    @property
+    def address(self):
+        """The address of the listener, of the first shard with ``shards``.
+        A random port of the ``address`` passed to the constructor is
+        resolved.
+        """
+        return self._address
+
+    @property
+    def addresses(self):
+        """The addresses of the listener shards, see ``shards``.
+        """
+        return list(self._addresses)
+
+    @property
+    def publish_address(self):
+        """The address of the :py:const:`zmq.PUB` socket which republishes
+        the received log records. A random port is resolved.
+        """
+        return self._publish_address
+
+    def _get_sender_shard(self):
+        # the records of a process go to one shard and keep their order
+        return current_pid() % len(self._addresses)
+
+    def _after_fork(self):
+        # the socket and buffers belong to the parent process
+        self._pid = None
+        self._socket = None
+        self._supervisor = None
+        self._batch = None
+        self._async_sender = None
+        self._dropped = 0
+        self._trackers = []
+        self._spool = None
+        self._replayer = None
+
+        if self._eager_connect and self._receiving \
+                and not self._is_main_process():
+            self._get_socket()
+
+    def _become_sink_process(self, shard=0):
+        # a socket to the sink process is useless in the sink process
+        self._close_socket()
+        BaseMultiprocessHandler._become_sink_process(self, shard)
+        # the sink process receives its shard only
+        self._addresses = [self._addresses[shard]]
+
+    def _get_listener_address(self):
+        return self._addresses, self._publish_address
+
+    def _set_listener_address(self, address, shard=0):
+        addresses, publish_address = address
+        self._addresses[shard] = addresses[0]
+        self._address = self._addresses[0]
+        if shard == 0:
+            self._publish_address = publish_address
 
     def _start_listener_thread(self, address):
         _log.info('ZmqHandler._start_listener_thread')
 
         event = threading.Event()
         listener = ZmqListenerThread(self._receiver_socket_type, address,
-                                     event, self)
+                                     event, self,
+                                     serializer=self._serializer,
+                                     dispatcher=self._get_dispatcher(),
+                                     io_threads=self._io_threads,
+                                     publish_address=self._publish_address,
+                                     publish_hwm=self._publish_hwm,
+                                     delivery=self._delivery)
         listener.start()
 
         # wait until the socket is bound in the listener
         wait_for_event(event, 60, listener.is_alive)
 
-        self._address = listener.get_address()
-
         return listener
 
     def forward_to_main(self, record):
         socket = self._get_socket()
-        record_dict = record_to_dict(record, self)
-        socket.send_json(record_dict)
+        if self._call_sites is not None:
+            self._check_reconnected(socket)
+        data = self._encode(record, self)
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+
+        if self._async_sender is not None:
+            self._async_sender.add(record.levelno, data)
+        elif self._batch is not None:
+            self._batch.add(data)
+        else:
+            self._send_or_drop([data])
+
+    def _check_reconnected(self, socket):
+        now = time.time()
+        if now - self._reconnect_check_time < self._reconnect_check_interval:
+            return
+
+        self._reconnect_check_time = now
+        if socket.reconnected():
+            # e.g. a restarted listener doesn't know the call sites
+            self._reset_call_sites()
 
     def _get_socket(self):
-        pid = os.getpid()
+        pid = current_pid()
 
         if self._pid != pid:
             # pid is None: new child forked from main
-            # pid != os.getpid(): new child forked from other child
+            # pid != current_pid(): new child forked from other child
+            # without fork tracking
             self._client_connect_to_socket()
             self._pid = pid
 
         return self._socket
 
     def _client_connect_to_socket(self):
-        socket = RobustZmqSocket(self._sender_socket_type, self._address)
-        socket.connect()
-
+        address = self._addresses[self._get_sender_shard()]
+        socket = RobustZmqSocket(self._sender_socket_type, address,
+                                 io_threads=self._io_threads,
+                                 copy_threshold=self._zero_copy_threshold,
+                                 # spool instead of queueing the records
+                                 # while the listener is unreachable
+                                 immediate=self._spool_directory is not None,
+                                 linger=int(self._close_timeout * 1000),
+                                 monitor_connects=self._call_sites is not None)
         self._socket = socket
 
-    def _close_socket(self):
+        # a batch or buffer inherited from the parent process holds records of
+        # the parent. The parent sends them by itself.
+        self._batch = None
+        self._async_sender = None
+        self._dropped = 0
+        self._trackers = []
+        # the listener learns the call sites of a new connection from scratch
+        self._reset_call_sites()
+
+        self._supervisor = ConnectionSupervisor(
+            socket.connect_once, deadline=self._reconnect_deadline)
+        self._supervisor.connect()
+
+        self._spool = None
+        self._replayer = None
+        if self._spool_directory is not None:
+            # unique per process, a pid may be reused
+            directory = os.path.join(self._spool_directory, '%d-%d' % (
+                current_pid(), int(time.time() * 1000)))
+            self._spool = Spool(directory, self._spool_max_bytes,
+                                self._spool_segment_bytes)
+
+        if self._nonblocking:
+            # with a spool the transport is never busy
+            send = self._send_nowait if self._spool is None \
+                else self._send_or_spool
+            self._async_sender = AsyncSender(
+                send,
+                BoundedBuffer(self._buffer_size, self._overflow),
+                on_dropped=self._reset_call_sites,
+                max_records=self._batch_size or 1)
+        elif self._batch_size:
+            self._batch = BatchSender(
+                self._send_or_drop,
+                max_records=self._batch_size,
+                max_bytes=self._batch_bytes,
+                interval=self._batch_interval)
+
+    def _send(self, frames, flags=0):
+        """Sends a message to the main process. Raises
+        :py:exc:`TransportBusy` if the message can't be sent, e.g. the circuit
+        of the connection is open.
+        """
+        supervisor = self._supervisor
+        if not supervisor.allow():
+            raise TransportBusy()
+
         try:
-            socket = self._socket
-        except AttributeError:
+            threshold = self._zero_copy_threshold
+            if threshold is not None \
+                    and max(len(frame) for frame in frames) >= threshold:
+                tracker = self._socket.send_multipart(
+                    frames, flags, reconnect=False, copy=False, track=True)
+                self._track(tracker)
+            else:
+                self._socket.send_multipart(frames, flags, reconnect=False)
+        except zmq.Again:
+            raise TransportBusy()
+        except zmq.ZMQError as error:
+            supervisor.trip(error)
+            raise TransportBusy()
+
+    def _track(self, tracker):
+        # forget the messages zmq has already sent
+        self._trackers = [pending for pending in self._trackers
+                          if not pending.done]
+        self._trackers.append(tracker)
+
+    def _wait_for_sent_frames(self, timeout=5.0):
+        """Waits until zmq sent the frames which were passed without copying.
+        """
+        trackers = self._trackers
+        self._trackers = []
+        for tracker in trackers:
+            try:
+                tracker.wait(timeout)
+            except zmq.NotDone:
+                _log.warning('zmq did not send a log record within %s '
+                             'seconds', timeout)
+                return
+
+    def _send_nowait(self, frames):
+        self._send(frames, zmq.NOBLOCK)
+
+    def _send_or_spool(self, frames):
+        """Sends the message or writes it to the spool if the transport is
+        busy or older messages are spooled.
+        """
+        spool = self._spool
+        spooling = len(spool) > 0
+
+        if self._dropped:
+            control = encode_control(
+                {'pid': self._pid, 'dropped': self._dropped})
+            if spool.send_or_spool([control], self._send_nowait):
+                self._dropped = 0
+
+        if not spool.send_or_spool(frames, self._send_nowait):
+            # the disk budget is exhausted
+            self._dropped += len(frames)
+            self._reset_call_sites()
+        elif not spooling and len(spool):
+            # the spool may be replayed to a new listener or printed offline,
+            # which learn the call sites from the spooled records
+            self._reset_call_sites()
+
+        if len(spool):
+            self._wakeup_replayer()
+
+    def _wakeup_replayer(self):
+        replayer = self._replayer
+        if replayer is None:
+            replayer = self._replayer = SpoolReplayer(
+                self._spool, self._send_nowait)
+            replayer.start()
+        replayer.wakeup()
+
+    def _close_spool(self):
+        """Sends the spooled messages within ``close_timeout`` seconds. The
+        remaining ones stay on disk.
+        """
+        spool = self._spool
+        if spool is None:
+            return
+
+        self._spool = None
+        replayer = self._replayer
+        self._replayer = None
+        if replayer is not None:
+            replayer.shutdown()
+            replayer.join()
+
+        deadline = time.time() + self._close_timeout
+        while not spool.replay(self._send_nowait) \
+                and time.time() < deadline:
+            time.sleep(0.05)
+
+        spool.close()
+
+    def _send_or_drop(self, frames):
+        if self._spool is not None:
+            self._send_or_spool(frames)
+            return
+
+        try:
+            if self._dropped:
+                control = encode_control(
+                    {'pid': self._pid, 'dropped': self._dropped})
+                self._send([control])
+                self._dropped = 0
+
+            self._send(frames)
+        except TransportBusy:
+            self._dropped += len(frames)
+            self._reset_call_sites()
+
+    def _send_end_of_stream(self):
+        if self._pid != current_pid() or self._supervisor is None:
+            return
+
+        unsent = 0
+        async_sender = self._async_sender
+        if async_sender is not None:
+            unsent = async_sender.close(self._close_timeout)
+            self._async_sender = None
+
+        batch = self._batch
+        if batch is not None:
+            batch.close()
+            self._batch = None
+
+        message = self._end_of_stream(self._dropped + unsent)
+        if self._spool is not None:
+            self._dropped = 0
+            self._send_or_spool([encode_control(message)])
             return
-        else:
-            if socket is not None:
-                socket.close()
-                self._socket = None
+
+        try:
+            self._send([encode_control(message)])
+            self._dropped = 0
+        except TransportBusy:
+            _log.warning('cannot end the log stream, dropped %d log records',
+                         self._dropped + unsent)
+
+    def _close_stream(self):
+        self._close_socket()
+
+    def _close_socket(self):
+        if self._pid != current_pid():
+            # socket and batch belong to another process
+            return
+
+        self._end_stream()
+
+        async_sender = self._async_sender
+        if async_sender is not None:
+            async_sender.close()
+            self._async_sender = None
+
+        batch = self._batch
+        if batch is not None:
+            batch.close()
+            self._batch = None
+
+        self._close_spool()
+        self._wait_for_sent_frames()
+
+        supervisor = self._supervisor
+        if supervisor is not None:
+            supervisor.close()
+            self._supervisor = None
+
+        socket = self._socket
+        if socket is not None:
+            # the LINGER option of 0 would discard the pending records
+            socket.close(linger=int(self._close_timeout * 1000))
+            self._socket = None
+
+    def flush(self):
+        """Sends the buffered log records of a child process.
+        """
+        if self._pid != current_pid():
+            return
+
+        async_sender = self._async_sender
+        if async_sender is not None:
+            async_sender.flush()
+
+        batch = self._batch
+        if batch is not None:
+            batch.flush()
+
+        self._wait_for_sent_frames()
 
     def close(self):
         _log.info('ZmqHandler.close for %s', self)
         BaseMultiprocessHandler.close(self)
 
         try:
-            if not self._is_main_process():
-                return
+            if self._is_main_process():
+                self._stop_receiving()
+        finally:
+            self._close_socket()
+
+        # the closed socket sent the pending log records of the main process
+        self._stop_sink_process()
+
+
+class RecordPublisher(object):
+    """Republishes log records on a :py:const:`zmq.PUB` socket. Each
+    message consists of the logger name as topic and the record in the
+    ``binary`` or ``json`` format, which is what
+    :py:func:`starlog.serializer.auto_decode_log_record` decodes.
+
+    zmq filters the topics in the publisher, so a subscriber of a logger
+    prefix only receives the records of these loggers. A subscriber which
+    doesn't keep up loses records as soon as ``hwm`` messages are queued for
+    it. Publishing never blocks.
+
+    The publisher must be used by a single thread.
+
+    :param str address: the address to bind. A ``tcp://`` address without a
+        port binds to a random port.
+    :param int hwm: the send high water mark of each subscriber
+    """
+    def __init__(self, address, hwm=1000, check=None, io_threads=1):
+        socket_options = {'SNDHWM': hwm, 'LINGER': 0}
+        self._zmq_socket = RobustZmqSocket(
+            zmq.PUB, address, check=check, socket_options=socket_options,
+            io_threads=io_threads)
+
+    def bind(self):
+        self._zmq_socket.bind()
+
+    @property
+    def address(self):
+        return self._zmq_socket.address
 
-            listener_thread = self._async_listener
-            if listener_thread is None:
+    def publish(self, record, data=None):
+        """Publishes a record.
+
+        :param record: the :py:class:`logging.LogRecord`
+        :param data: the record as received in the ``binary`` or ``json``
+            format. If not set, then the record is encoded.
+        """
+        if data is None:
+            try:
+                data = _encode_for_publishing(record)
+            except (TypeError, ValueError) as error:
+                _log.warning('cannot publish a log record: %s', error)
                 return
 
-            listener_thread.shutdown()
-            listener_thread.join()
-        finally:
-            self._close_socket()
+        topic = record.name
+        if isinstance(topic, six.text_type):
+            topic = topic.encode('utf-8')
+
+        try:
+            self._zmq_socket.socket.send_multipart([topic, data], zmq.NOBLOCK)
+        except zmq.ZMQError as error:
+            _log.warning('cannot publish a log record: %s', error)
+
+    def close(self):
+        self._zmq_socket.close()
+
+
+def _encode_for_publishing(record):
+    try:
+        return binary_encode_log_record(record)
+    except TypeError:
+        # an attribute the binary format doesn't support
+        return json_encode_log_record(record).encode('utf-8')
 
 
 class ZmqListenerThread(threading.Thread):
-    def __init__(self, socket_type, address, event, handler, *args, **kwargs):
+    """Receives the log records of the child processes and forwards them to
+    the handler.
+
+    The thread waits in :py:meth:`zmq.Poller.poll` for incoming messages and
+    for the shutdown signal on an inproc control socket. After a wakeup it
+    receives all messages which are immediately available before it polls
+    again.
+
+    With a ``publish_address`` the thread republishes the received records
+    with a :py:class:`RecordPublisher`. With a ``delivery`` tracker the thread
+    tracks the sequence numbers of the received records.
+    """
+    def __init__(self, socket_type, address, event, handler,
+                 serializer='json', dispatcher=None, io_threads=1,
+                 publish_address=None, publish_hwm=1000, delivery=None,
+                 *args, **kwargs):
         super(ZmqListenerThread, self).__init__(*args, **kwargs)
         self.setDaemon(True)
 
         self._event = event
         self._handler = handler
+        self._dispatcher = dispatcher
+        self._delivery = delivery
+        self._decode = get_decoder(serializer)
+        # the binary decoder reads directly from the memory of a zmq frame
+        self._decode_buffer = serializer in ('auto', 'binary')
         self._running = True
+        self._drain = False
+        self._deadline = None
 
         self._zmq_socket = RobustZmqSocket(
-            socket_type, address, check=self._not_running)
+            socket_type, address, check=self._not_running,
+            io_threads=io_threads)
+
+        # pickled records are republished in the binary format
+        self._publish_original = serializer != 'pickle'
+        self._publisher = None
+        if publish_address is not None:
+            self._publisher = RecordPublisher(
+                publish_address, hwm=publish_hwm, check=self._not_running,
+                io_threads=io_threads)
+
+        # inproc socket to wake up the poller on shutdown
+        self._control_lock = threading.Lock()
+        self._control_address = None
+        self._control_socket = None
 
     def _not_running(self):
         return not self._running
@@ -288,16 +1062,15 @@ class ZmqListenerThread(threading.Thread):
     def run(self):
         try:
             self._zmq_socket.bind()
+            if self._publisher is not None:
+                self._publisher.bind()
+            self._bind_control_socket()
             self._event.set()
             self._event = None
 
-            while self._running:
-                record_dict = self._zmq_socket.recv_json()
-                if record_dict is None:
-                    # receive timeout
-                    continue
-
-                self._process_record(record_dict)
+            self._poll()
+            if self._drain:
+                self._drain_socket()
         except RetryAbortedByCheck:
             # zmq bind failed and thread stopped running
             pass
@@ -308,19 +1081,160 @@ class ZmqListenerThread(threading.Thread):
         _log.info('%s stopped', self.__class__.__name__)
         self.close()
 
-    def _process_record(self, record_dict):
-        record = makeLogRecord(record_dict)
-        self._handler.forward_to_sink(record)
+    def _bind_control_socket(self):
+        with self._control_lock:
+            address = 'inproc://starlog-listener-%d' % id(self)
+            self._control_socket = self._zmq_socket.context.socket(zmq.PULL)
+            self._control_socket.bind(address)
+            self._control_address = address
+
+    def _poll(self):
+        poller = None
+        socket = None
+
+        while self._running:
+            if socket is not self._zmq_socket.socket:
+                # the socket changed after an error
+                socket = self._zmq_socket.socket
+                poller = zmq.Poller()
+                poller.register(socket, zmq.POLLIN)
+                poller.register(self._control_socket, zmq.POLLIN)
+
+            events = dict(poller.poll())
+            if self._control_socket in events:
+                break
+
+            if socket in events:
+                self._receive_available()
+
+    def _receive_available(self):
+        """Receives messages until no more message is immediately available.
+        """
+        while self._running:
+            if not self._receive_message():
+                return
+
+    def _receive_message(self):
+        """Receives and processes a message without blocking.
+
+        :return: False if no message was available
+        """
+        frames = self._zmq_socket.recv_multipart(zmq.NOBLOCK, copy=False)
+        if frames is None:
+            return False
+
+        deadline = self._deadline
+        if deadline is not None and time.time() > deadline:
+            self._discard_frames(frames)
+            return True
+
+        # a message holds a single record or a batch of records
+        decode_buffer = self._decode_buffer
+        for frame in frames:
+            if decode_buffer:
+                self._process_record(frame.buffer)
+            else:
+                self._process_record(frame.bytes)
+        return True
+
+    def _discard_frames(self, frames):
+        """Counts the records of a message received after the deadline.
+        """
+        left_over = 0
+        for frame in frames:
+            data = frame.bytes
+            if is_control(data):
+                self._handler.handle_control(decode_control(data))
+            else:
+                left_over += 1
+        self._handler.count_left_over(left_over)
+
+    def _drain_socket(self):
+        """Receives the messages which are already queued in the socket.
+        """
+        while self._receive_message():
+            deadline = self._deadline
+            if deadline is not None and time.time() > deadline + 1.0:
+                _log.warning('%s: senders are still sending',
+                             self.__class__.__name__)
+                return
+
+    def _process_record(self, data):
+        if is_control(data):
+            self._handler.handle_control(decode_control(data))
+            return
+
+        try:
+            record = self._decode(data)
+        except UnknownCallSite as error:
+            _log.info('%s', error)
+            self._handler.count_dropped(1)
+            return
+        except Exception as error:
+            # e.g. a message of an unrelated sender
+            _log.warning('cannot decode a message of %d bytes: %s',
+                         len(data), error)
+            return
+
+        if self._delivery is not None:
+            self._delivery.received(record)
+
+        if self._publisher is not None:
+            # a subscriber doesn't know the call sites
+            if self._publish_original and data[0:1] != CALL_SITE_MAGIC:
+                self._publisher.publish(record, data)
+            else:
+                self._publisher.publish(record)
+
+        if self._dispatcher is not None:
+            self._dispatcher.dispatch(record)
+        else:
+            self._handler.forward_to_sink(record)
 
     def get_address(self):
         return self._zmq_socket.address
 
+    def get_publish_address(self):
+        if self._publisher is None:
+            return None
+        return self._publisher.address
+
     def close(self):
         """Close the zmq socket connection.
         """
+        with self._control_lock:
+            self._control_address = None
+            if self._control_socket is not None:
+                self._control_socket.close()
+                self._control_socket = None
+
+        if self._publisher is not None:
+            self._publisher.close()
         self._zmq_socket.close()
 
-    def shutdown(self):
-        """Gracful shutdown.
+    def shutdown(self, drain=False, deadline=None):
+        """Gracful shutdown. Wakes up the thread immediately.
+
+        :param bool drain: if set, the thread receives the messages which are
+            already queued in the socket before it stops.
+        :param float deadline: the :py:func:`time.time` after which the
+            drained records are counted as left over instead of being
+            forwarded
         """
+        self._drain = drain
+        self._deadline = deadline
         self._running = False
+
+        with self._control_lock:
+            if self._control_address is None:
+                return
+
+            socket = self._zmq_socket.context.socket(zmq.PUSH)
+            try:
+                socket.connect(self._control_address)
+                socket.send(b'', zmq.NOBLOCK)
+            except zmq.ZMQError as error:
+                _log.warning('could not wake up %s: %s',
+                             self.__class__.__name__, error)
+            finally:
+                socket.close(linger=1000)
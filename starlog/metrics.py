@@ -1,3 +1,5 @@
+import bisect
+import math
 import threading
 
 import six
@@ -25,10 +27,56 @@ class CounterMetric(object):
         return float(self._value) / float(self._count)
 
 
+class HistogramMetric(object):
+    """Counts values in buckets with fixed upper bounds. Percentiles are
+    estimated by the upper bound of their bucket.
+
+    :param tuple bounds: the ascending upper bounds of the buckets. Larger
+        values go to an overflow bucket.
+    """
+    DEFAULT_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                      10000)
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self._bounds = tuple(bounds)
+        self.reset()
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self._count += 1
+        if value > self._max:
+            self._max = value
+
+    def count(self):
+        return self._count
+
+    def max(self):
+        return self._max
+
+    def percentile(self, percent):
+        if self._count == 0:
+            return 0
+
+        rank = max(1, int(math.ceil(self._count * percent / 100.0)))
+        seen = 0
+        for bound, count in zip(self._bounds, self._counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self._max)
+        # the overflow bucket
+        return self._max
+
+    def reset(self):
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._count = 0
+        self._max = 0
+
+
 class MetricCollection(object):
     def __init__(self):
         self._lock = threading.RLock()
         self._metrics = {}
+        self._histograms = {}
         self._has_metrics = False
 
     def inc(self, metric_key, value=1):
@@ -42,6 +90,18 @@ class MetricCollection(object):
                 self._metrics[metric_key] = metric
             metric.inc(value)
 
+    def observe(self, metric_key, value):
+        """Adds a value to the histogram ``metric_key``.
+        """
+        assert isinstance(metric_key, (six.binary_type, six.text_type))
+        with self._lock:
+            self._has_metrics = True
+            histogram = self._histograms.get(metric_key)
+            if histogram is None:
+                histogram = HistogramMetric()
+                self._histograms[metric_key] = histogram
+            histogram.observe(value)
+
     def has_metrics(self):
         return self._has_metrics
 
@@ -55,4 +115,13 @@ class MetricCollection(object):
 
                 metric.reset()
 
+            for metric_key, histogram in six.iteritems(self._histograms):
+                retval[metric_key + '.count'] = histogram.count()
+                retval[metric_key + '.max'] = histogram.max()
+                for percent in (50, 90, 99):
+                    retval['%s.p%d' % (metric_key, percent)] = \
+                        histogram.percentile(percent)
+
+                histogram.reset()
+
         return retval
@@ -0,0 +1,58 @@
+"""Tracks the identity of the current process across forks.
+
+With :py:func:`os.register_at_fork` (python >= 3.7) the pid is cached and
+updated in the child right after a fork. So :py:func:`current_pid` doesn't
+call :py:func:`os.getpid` for every log record. Older pythons fall back to
+:py:func:`os.getpid`.
+"""
+import itertools
+import os
+import traceback
+import weakref
+
+from .debug import get_debug_logger
+
+
+_log = get_debug_logger('starlog.debug.process')
+
+
+_pid = os.getpid()
+
+_after_fork_registry = weakref.WeakValueDictionary()
+_after_fork_counter = itertools.count()
+
+
+def _after_fork_in_child():
+    global _pid
+
+    _pid = os.getpid()
+
+    items = sorted(_after_fork_registry.items(), key=lambda item: item[0][0])
+    for (_index, _ident, func), obj in items:
+        try:
+            func(obj)
+        except Exception:
+            _log.warning('exception in after fork hook %s: %s',
+                         func, traceback.format_exc())
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+    FORK_TRACKING = True
+
+    def current_pid():
+        """Returns the pid of the current process.
+        """
+        return _pid
+else:
+    FORK_TRACKING = False
+    current_pid = os.getpid
+
+
+def register_after_fork(obj, func):
+    """Calls ``func(obj)`` in the child process right after a fork, as long as
+    ``obj`` is alive. Does nothing without fork tracking, i.e. callers must
+    detect a fork with :py:func:`current_pid` as well.
+    """
+    key = (next(_after_fork_counter), id(obj), func)
+    _after_fork_registry[key] = obj
@@ -0,0 +1,160 @@
+"""Sends or prints the log records a :py:class:`starlog.ZmqHandler` left in
+its spool, e.g. a child process which exited while the listener was
+unreachable::
+
+    starlog-replay --connect tcp://127.0.0.1:5557 /var/spool/app
+    starlog-replay /var/spool/app/1234-1500000000000
+
+A directory is either the spool of one process or a directory of spools,
+the ``spool_directory`` of the handler.
+"""
+import argparse
+import logging
+import os
+import sys
+
+import zmq
+
+from .debug import get_debug_logger
+from .handlers.spool import iter_spool, list_segments
+from .handlers.zmq_context import acquire_context, release_context
+from .serializer import decode_control, get_decoder, is_control
+
+
+_log = get_debug_logger('starlog.debug.replay')
+
+
+DEFAULT_FORMAT = '%(asctime)s [%(name)s-%(process)d] %(levelname)s: ' \
+    '%(message)s'
+
+
+def find_spools(directory):
+    """Returns the spool directories in ``directory``, or ``directory`` if
+    it is a spool itself.
+    """
+    if list_segments(directory):
+        return [directory]
+
+    spools = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path) and list_segments(path):
+            spools.append(path)
+    return spools
+
+
+class Printer(object):
+    """Prints the log records of the spooled messages.
+    """
+    def __init__(self, stream, fmt=DEFAULT_FORMAT):
+        self._handler = logging.StreamHandler(stream)
+        self._handler.setFormatter(logging.Formatter(fmt))
+        self._decode = get_decoder('auto')
+
+    def send(self, frames):
+        for data in frames:
+            if is_control(data):
+                _log.info('control message: %r', decode_control(data))
+                continue
+
+            try:
+                record = self._decode(data)
+            except Exception as error:
+                # e.g. the call site was defined before the spool started
+                _log.warning('cannot decode a message of %d bytes: %s',
+                             len(data), error)
+                continue
+            self._handler.handle(record)
+
+    def close(self):
+        self._handler.close()
+
+
+class Sender(object):
+    """Sends the spooled messages to a listener.
+    """
+    def __init__(self, address):
+        self._context = acquire_context()
+        self._socket = self._context.socket(zmq.PUSH)
+        self._socket.connect(address)
+
+    def send(self, frames):
+        self._socket.send_multipart(frames)
+
+    def close(self):
+        if self._socket is not None:
+            # wait until the messages are sent
+            self._socket.close(linger=-1)
+            self._socket = None
+            release_context(self._context)
+
+
+def replay(directory, target, delete=False):
+    """Passes the messages of a spool in order to ``target.send``.
+
+    :param bool delete: removes the segments which were replayed
+    :return: the number of replayed messages
+    """
+    count = 0
+    segment = None
+    for path, frames in iter_spool(directory):
+        if delete and segment is not None and segment != path:
+            os.remove(segment)
+        segment = path
+
+        target.send(frames)
+        count += 1
+
+    if delete:
+        if segment is not None:
+            os.remove(segment)
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+
+    return count
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='starlog-replay',
+        description='Sends or prints the log records left in the spool of '
+                    'a starlog ZmqHandler.')
+    parser.add_argument(
+        'directories', metavar='DIRECTORY', nargs='+',
+        help='a spool or a directory of spools')
+    parser.add_argument(
+        '--connect', metavar='ADDRESS',
+        help='send the records to the listener at this address instead of '
+             'printing them')
+    parser.add_argument(
+        '--format', default=DEFAULT_FORMAT,
+        help='logging.Formatter format of the printed records')
+    parser.add_argument(
+        '--delete', action='store_true',
+        help='remove the spools which were replayed')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.connect:
+        target = Sender(args.connect)
+    else:
+        target = Printer(sys.stdout, args.format)
+
+    try:
+        for directory in args.directories:
+            for spool in find_spools(directory):
+                count = replay(spool, target, delete=args.delete)
+                sys.stderr.write('%s: %d messages\n' % (spool, count))
+    finally:
+        target.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,11 @@
+import collections
+import functools
 import json
+import logging
+import os
+import struct
+import time
+import traceback
 from logging import makeLogRecord, NullHandler
 try:
     import cPickle as pickle
@@ -6,34 +13,174 @@ except ImportError:
     # python 3
     import pickle
 
+import six
+
+from .process import current_pid
+
 
 null_handler = NullHandler()
 
+_TEXT_TYPES = (six.text_type, str)
+# args of these types are rendered the same way by the receiver
+_PRIMITIVE_TYPES = frozenset(
+    (type(None), bool, float, six.text_type, str) + six.integer_types)
+
+
+def deferrable_args(record):
+    """Returns the ``args`` of the record if the receiver can render its
+    message, i.e. the message is a text and the args are primitive values.
+    Otherwise None is returned and the message must be rendered eagerly.
+    """
+    args = record.args
+    if args.__class__ is tuple:
+        values = args
+    elif args.__class__ is dict:
+        if not all(key.__class__ in _TEXT_TYPES for key in args):
+            return None
+        values = args.values()
+    else:
+        return None
+
+    if not args or record.msg.__class__ not in _TEXT_TYPES:
+        return None
+
+    for value in values:
+        # exact types, e.g. an enum renders differently than its value
+        if value.__class__ not in _PRIMITIVE_TYPES:
+            return None
+
+    return args
+
+
+def _restore_args(d):
+    # json and the binary format transport tuples as lists
+    args = d.get('args')
+    if args.__class__ is list:
+        d['args'] = tuple(args)
+    return d
+
+
+# formatter class + traceback fingerprint -> formatted traceback without the
+# last line, i.e. the exception message
+_TRACEBACK_CACHE_SIZE = 256
+_traceback_cache = {}
+
+
+def _frames(tb):
+    frames = []
+    while tb is not None:
+        # the instruction tells calls on the same line apart, python >= 3.11
+        # shows its columns in the traceback
+        frames.append((tb.tb_frame.f_code, tb.tb_lineno, tb.tb_lasti))
+        tb = tb.tb_next
+    return tuple(frames)
+
+
+def _exception_only(etype, value):
+    text = ''.join(traceback.format_exception_only(etype, value))
+    # like logging.Formatter.formatException
+    if text[-1:] == '\n':
+        text = text[:-1]
+    return text
+
+
+def traceback_fingerprint(exc_info):
+    """Returns a hashable fingerprint of the traceback of ``exc_info``: the
+    chain of code objects, line numbers and instructions of the exception and
+    of its chained exceptions. The messages of the chained exceptions are part
+    of the fingerprint, since they are part of the formatted traceback.
+    """
+    etype, value, tb = exc_info
+    fingerprint = [(etype, _frames(tb))]
+
+    seen = set([id(value)])
+    while True:
+        cause = getattr(value, '__cause__', None)
+        if cause is None and not getattr(value, '__suppress_context__', True):
+            cause = value.__context__
+        if cause is None or id(cause) in seen:
+            break
+
+        seen.add(id(cause))
+        fingerprint.append((cause.__class__, _frames(cause.__traceback__),
+                            _exception_only(cause.__class__, cause)))
+        value = cause
+
+    return tuple(fingerprint)
+
 
-def record_to_dict(record, handler=null_handler):
+def _format_exc_text(record, handler):
+    """Sets ``record.exc_text`` to the formatted traceback. A traceback
+    which was formatted before is taken from a cache, only the exception
+    message is formatted.
+
+    :return: tuple of (fingerprint, traceback without the exception message,
+        exception message) or None if the traceback can't be cached
+    """
+    etype, value, tb = record.exc_info
+    if etype is None or tb is None:
+        # e.g. exc_info=True outside of an except block
+        if not record.exc_text:
+            handler.format(record)
+        return None
+
+    suffix = _exception_only(etype, value)
+    fingerprint = traceback_fingerprint(record.exc_info)
+    formatter = handler.formatter or logging._defaultFormatter
+    key = (formatter.__class__, fingerprint)
+    prefix = _traceback_cache.get(key)
+
+    text = record.exc_text
+    if prefix is None:
+        if not text:
+            # just to get traceback text into record.exc_text ...
+            handler.format(record)
+            text = record.exc_text
+
+        if not text or len(text) < len(suffix) or not text.endswith(suffix):
+            # e.g. a formatter with a custom formatException
+            return None
+
+        prefix = text[:len(text) - len(suffix)]
+        if len(_traceback_cache) >= _TRACEBACK_CACHE_SIZE:
+            _traceback_cache.clear()
+        _traceback_cache[key] = prefix
+    elif not text:
+        record.exc_text = prefix + suffix
+    elif len(text) != len(prefix) + len(suffix) \
+            or not text.startswith(prefix) or not text.endswith(suffix):
+        # formatted by another formatter
+        return None
+
+    return fingerprint, prefix, suffix
+
+
+def record_to_dict(record, handler=null_handler, defer_rendering=False):
     # this function is the core of python's logging.handler.SocketHandler
     # method ``makePickle``
 
     ei = record.exc_info
     if ei:
-        # just to get traceback text into record.exc_text ...
-        handler.format(record)
+        _format_exc_text(record, handler)
     # See issue #14436: If msg or args are objects, they may not be
     # available on the receiving end. So we convert the msg % args
     # to a string, save it as msg and zap the args.
     d = dict(record.__dict__)
-    d['msg'] = record.getMessage()
-    d['args'] = None
+    args = deferrable_args(record) if defer_rendering else None
+    if args is None:
+        d['msg'] = record.getMessage()
+    d['args'] = args
     d['exc_info'] = None
     # Issue #25685: delete 'message' if present: redundant with 'msg'
     d.pop('message', None)
     return d
 
 
-def pickle_log_record(record, handler=null_handler):
+def pickle_log_record(record, handler=null_handler, defer_rendering=False):
     """Pickles the record in binary format with a length prefix.
     """
-    d = record_to_dict(record, handler=handler)
+    d = record_to_dict(record, handler=handler,
+                       defer_rendering=defer_rendering)
     s = pickle.dumps(d, 1)
     return s
 
@@ -49,11 +196,764 @@ def unpickle_log_record(data):
     return makeLogRecord(unpickled)
 
 
-def json_encode_log_record(record, handler=null_handler):
-    d = record_to_dict(record, handler=null_handler)
+def json_encode_log_record(record, handler=null_handler,
+                           defer_rendering=False):
+    d = record_to_dict(record, handler=handler,
+                       defer_rendering=defer_rendering)
     return json.dumps(d)
 
 
 def json_decode_log_record(data):
     d = json.loads(data)
-    return makeLogRecord(d)
+    return makeLogRecord(_restore_args(d))
+
+
+# -- compact binary format ---------------------------------------------------
+#
+# A binary frame starts with ``BINARY_MAGIC`` followed by a varint bitmap of
+# the standard LogRecord attributes which are present and of the expected
+# type. These attributes follow in a fixed order without any key names:
+#
+# - texts as varint length + utf-8
+# - non-negative integers as varints
+# - floats as 8 byte doubles
+#
+# All remaining attributes (e.g. the ``extra`` of a log call) are appended as
+# a typed side-map: varint count + (key, tag, value) entries.
+
+BINARY_MAGIC = b'\xb1'
+
+# attributes which are the same for every record of a call site. Their
+# encoding is cached.
+_STATIC_TEXT_FIELDS = (
+    'name',
+    'levelname',
+    'pathname',
+    'filename',
+    'module',
+    'funcName',
+    'threadName',
+    'processName',
+)
+_STATIC_UINT_FIELDS = (
+    'levelno',
+    'lineno',
+    'thread',
+    'process',
+)
+_STATIC_FIELDS = _STATIC_TEXT_FIELDS + _STATIC_UINT_FIELDS
+
+_DYNAMIC_TEXT_FIELDS = (
+    'msg',
+    'exc_text',
+    'stack_info',
+)
+_FLOAT_FIELDS = (
+    'created',
+    'msecs',
+    'relativeCreated',
+)
+
+_FIXED_FIELD_NAMES = frozenset(
+    _STATIC_FIELDS + _DYNAMIC_TEXT_FIELDS + _FLOAT_FIELDS)
+
+# attributes which are not transferred as they are. ``exc_info`` is always
+# None after ``record_to_dict``. ``args`` are either rendered into ``msg`` or
+# written to the side-map.
+_SKIPPED_FIELDS = frozenset(['args', 'exc_info', 'message'])
+
+_KNOWN_FIELDS = _FIXED_FIELD_NAMES | _SKIPPED_FIELDS
+
+# tags of the typed values in the side-map
+_T_NONE = 0
+_T_FALSE = 1
+_T_TRUE = 2
+_T_INT = 3
+_T_FLOAT = 4
+_T_TEXT = 5
+_T_BYTES = 6
+_T_LIST = 7
+_T_DICT = 8
+
+_double = struct.Struct('<d')
+_three_doubles = struct.Struct('<ddd')
+
+_SMALL_VARINTS = [six.int2byte(i) for i in range(0x80)]
+
+# caches of encoded call sites and side-map keys
+_CACHE_SIZE = 1024
+_static_cache = {}
+_key_cache = {}
+
+
+def _varint(value):
+    if value < 0x80:
+        return _SMALL_VARINTS[value]
+
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _read_varint(buf, pos):
+    byte = buf[pos]
+    if byte < 0x80:
+        return byte, pos + 1
+
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _encode_text(value, parts):
+    if isinstance(value, six.text_type):
+        value = value.encode('utf-8')
+    parts.append(_varint(len(value)))
+    parts.append(value)
+
+
+def _encode_key(key, parts):
+    encoded = _key_cache.get(key)
+    if encoded is None:
+        encoded = []
+        _encode_text(key, encoded)
+        encoded = b''.join(encoded)
+
+        if len(_key_cache) >= _CACHE_SIZE:
+            _key_cache.clear()
+        _key_cache[key] = encoded
+
+    parts.append(encoded)
+
+
+def _read_text(buf, pos):
+    length, pos = _read_varint(buf, pos)
+    end = pos + length
+    return six.text_type(buf[pos:end], 'utf-8'), end
+
+
+def _encode_value(value, parts):
+    """Appends ``value`` with a type tag. Raises a :py:exc:`TypeError` if the
+    type of the value is not supported - like :py:func:`json.dumps` does.
+    """
+    if value is None:
+        parts.append(_SMALL_VARINTS[_T_NONE])
+    elif value is True:
+        parts.append(_SMALL_VARINTS[_T_TRUE])
+    elif value is False:
+        parts.append(_SMALL_VARINTS[_T_FALSE])
+    elif isinstance(value, six.integer_types):
+        parts.append(_SMALL_VARINTS[_T_INT])
+        # zigzag encoding of negative numbers
+        parts.append(_varint(value * 2 if value >= 0 else -value * 2 - 1))
+    elif isinstance(value, float):
+        parts.append(_SMALL_VARINTS[_T_FLOAT])
+        parts.append(_double.pack(value))
+    elif isinstance(value, six.text_type):
+        parts.append(_SMALL_VARINTS[_T_TEXT])
+        _encode_text(value, parts)
+    elif isinstance(value, six.binary_type):
+        parts.append(_SMALL_VARINTS[_T_BYTES])
+        parts.append(_varint(len(value)))
+        parts.append(value)
+    elif isinstance(value, (list, tuple)):
+        parts.append(_SMALL_VARINTS[_T_LIST])
+        parts.append(_varint(len(value)))
+        for item in value:
+            _encode_value(item, parts)
+    elif isinstance(value, dict):
+        parts.append(_SMALL_VARINTS[_T_DICT])
+        parts.append(_varint(len(value)))
+        for key, item in six.iteritems(value):
+            if not isinstance(key, six.string_types):
+                raise TypeError('keys must be strings, got %r' % (key,))
+            _encode_key(key, parts)
+            _encode_value(item, parts)
+    else:
+        raise TypeError('%r is not serializable' % (value,))
+
+
+def _read_value(buf, pos):
+    tag = buf[pos]
+    pos += 1
+
+    if tag == _T_NONE:
+        return None, pos
+    elif tag == _T_TRUE:
+        return True, pos
+    elif tag == _T_FALSE:
+        return False, pos
+    elif tag == _T_INT:
+        value, pos = _read_varint(buf, pos)
+        return (value >> 1) ^ -(value & 1), pos
+    elif tag == _T_FLOAT:
+        return _double.unpack_from(buf, pos)[0], pos + 8
+    elif tag == _T_TEXT:
+        return _read_text(buf, pos)
+    elif tag == _T_BYTES:
+        length, pos = _read_varint(buf, pos)
+        return bytes(buf[pos:pos + length]), pos + length
+    elif tag == _T_LIST:
+        count, pos = _read_varint(buf, pos)
+        items = []
+        for _ in range(count):
+            item, pos = _read_value(buf, pos)
+            items.append(item)
+        return items, pos
+    elif tag == _T_DICT:
+        count, pos = _read_varint(buf, pos)
+        dic = {}
+        for _ in range(count):
+            key, pos = _read_text(buf, pos)
+            dic[key], pos = _read_value(buf, pos)
+        return dic, pos
+
+    raise ValueError('unknown type tag %d at position %d' % (tag, pos - 1))
+
+
+def _encode_static_fields(values):
+    """Encodes the values of ``_STATIC_FIELDS``.
+
+    :return: tuple of (bitmap, encoded values, side-map entries of values with
+        an unexpected type)
+    """
+    parts = []
+    side_map = []
+    bitmap = 0
+    bit = 1
+
+    for name, value in zip(_STATIC_TEXT_FIELDS, values):
+        if value.__class__ in _TEXT_TYPES:
+            _encode_text(value, parts)
+            bitmap |= bit
+        elif value is not None:
+            side_map.append((name, value))
+        bit <<= 1
+
+    for name, value in zip(_STATIC_UINT_FIELDS,
+                           values[len(_STATIC_TEXT_FIELDS):]):
+        if value.__class__ in six.integer_types and value >= 0:
+            parts.append(_varint(value))
+            bitmap |= bit
+        elif value is not None:
+            side_map.append((name, value))
+        bit <<= 1
+
+    return bitmap, b''.join(parts), tuple(side_map)
+
+
+def binary_encode_log_record(record, handler=null_handler,
+                             defer_rendering=False, call_sites=None):
+    """Serializes the record into the compact binary format.
+
+    Standard LogRecord attributes are written in a fixed order without key
+    names, integers as varints. Any other attributes of the record are
+    written to a typed side-map.
+
+    :param bool defer_rendering: if set, the message template is written and
+        the args go to the side-map, see :py:func:`deferrable_args`.
+    :param CallSiteTable call_sites: if set, the attributes of the call site
+        are written only with the first record of the call site. Afterwards
+        a reference is written.
+
+    :return: bytes starting with ``BINARY_MAGIC`` or ``CALL_SITE_MAGIC``
+    """
+    exc_text = None
+    if record.exc_info:
+        exc_text = _format_exc_text(record, handler)
+
+    attrs = record.__dict__
+    get = attrs.get
+
+    static_values = tuple(map(get, _STATIC_FIELDS))
+    try:
+        static = _static_cache.get(static_values)
+    except TypeError:
+        # an unhashable value
+        static = _encode_static_fields(static_values)
+        call_sites = None
+    else:
+        if static is None:
+            static = _encode_static_fields(static_values)
+            if len(_static_cache) >= _CACHE_SIZE:
+                _static_cache.clear()
+            _static_cache[static_values] = static
+
+    bitmap, encoded, side_map = static
+    if side_map:
+        # the call site table holds the fixed fields only
+        call_sites = None
+    if call_sites is None:
+        exc_text = None
+    side_map = list(side_map)
+    parts = [BINARY_MAGIC, None, encoded]
+    bit = 1 << len(_STATIC_FIELDS)
+
+    args = deferrable_args(record) if defer_rendering else None
+    if args is not None:
+        side_map.append(('args', args))
+
+    for name in _DYNAMIC_TEXT_FIELDS:
+        if name == 'msg':
+            value = record.getMessage() if args is None else record.msg
+        elif name == 'exc_text' and exc_text is not None:
+            # the traceback goes to the call site table
+            value = exc_text[2]
+        else:
+            value = get(name)
+
+        if value.__class__ in _TEXT_TYPES:
+            _encode_text(value, parts)
+            bitmap |= bit
+        elif value is not None:
+            side_map.append((name, value))
+        bit <<= 1
+
+    floats = tuple(map(get, _FLOAT_FIELDS))
+    if all(value.__class__ is float for value in floats):
+        parts.append(_three_doubles.pack(*floats))
+        bitmap |= bit * 7
+    else:
+        for name, value in zip(_FLOAT_FIELDS, floats):
+            if value.__class__ is float:
+                parts.append(_double.pack(value))
+                bitmap |= bit
+            elif value is not None:
+                side_map.append((name, value))
+            bit <<= 1
+
+    for name in six.viewkeys(attrs) - _KNOWN_FIELDS:
+        side_map.append((name, attrs[name]))
+
+    count_index = len(parts)
+    parts.append(None)
+    for name, value in side_map:
+        _encode_key(name, parts)
+        _encode_value(value, parts)
+
+    if call_sites is None:
+        parts[1] = _varint(bitmap)
+        parts[count_index] = _varint(len(side_map))
+    else:
+        # the call site is looked up after the record was encoded
+        # successfully, so its definition is never lost
+        header, traceback_entry = call_sites.encode(
+            static_values, static, exc_text)
+        parts[0] = header
+        parts[1] = _varint(bitmap >> len(_STATIC_FIELDS))
+        parts[2] = b''
+
+        if traceback_entry is None:
+            parts[count_index] = _varint(len(side_map))
+        else:
+            parts[count_index] = _varint(len(side_map) + 1)
+            parts.append(traceback_entry)
+
+    return b''.join(parts)
+
+
+def _read_static_fields(buf, pos, bitmap, d):
+    bit = 1
+
+    for name in _STATIC_TEXT_FIELDS:
+        if bitmap & bit:
+            d[name], pos = _read_text(buf, pos)
+        else:
+            d[name] = None
+        bit <<= 1
+
+    for name in _STATIC_UINT_FIELDS:
+        if bitmap & bit:
+            d[name], pos = _read_varint(buf, pos)
+        else:
+            d[name] = None
+        bit <<= 1
+
+    return pos
+
+
+def _read_call_site(buf, call_sites):
+    if call_sites is None:
+        raise ValueError('a record with a call site reference requires a '
+                         'CallSiteRegistry')
+
+    session, pos = _read_varint(buf, 1)
+    site, pos = _read_varint(buf, pos)
+    site_id = site >> 1
+
+    if site & 1:
+        # the first record of the call site
+        static_bitmap, pos = _read_varint(buf, pos)
+        fields = {}
+        pos = _read_static_fields(buf, pos, static_bitmap, fields)
+        call_sites.define(session, site_id, fields)
+    else:
+        fields = call_sites.get(session, site_id)
+
+    d = dict(fields)
+    bitmap, pos = _read_varint(buf, pos)
+    return session, d, bitmap << len(_STATIC_FIELDS), pos
+
+
+def binary_decode(data, call_sites=None):
+    """Decodes a binary frame created by ``binary_encode_log_record`` into a
+    dict suitable for :py:func:`logging.makeLogRecord`.
+
+    :param data: bytes or any other buffer, e.g. a :py:class:`memoryview`
+    :param CallSiteRegistry call_sites: the call sites of the senders.
+        Required for frames starting with ``CALL_SITE_MAGIC``.
+    """
+    buf = bytearray(data) if six.PY2 else data
+
+    magic = buf[0:1]
+    session = None
+    if magic == BINARY_MAGIC:
+        bitmap, pos = _read_varint(buf, 1)
+        d = {}
+        pos = _read_static_fields(buf, pos, bitmap, d)
+    elif magic == CALL_SITE_MAGIC:
+        session, d, bitmap, pos = _read_call_site(buf, call_sites)
+    else:
+        raise ValueError('not a binary log record')
+
+    d['args'] = None
+    d['exc_info'] = None
+    bit = 1 << len(_STATIC_FIELDS)
+
+    for name in _DYNAMIC_TEXT_FIELDS:
+        if bitmap & bit:
+            d[name], pos = _read_text(buf, pos)
+        else:
+            d[name] = None
+        bit <<= 1
+
+    for name in _FLOAT_FIELDS:
+        if bitmap & bit:
+            d[name] = _double.unpack_from(buf, pos)[0]
+            pos += 8
+        else:
+            d[name] = None
+        bit <<= 1
+
+    count, pos = _read_varint(buf, pos)
+    for _ in range(count):
+        name, pos = _read_text(buf, pos)
+        d[name], pos = _read_value(buf, pos)
+
+    if session is not None and _TRACEBACK_KEY in d:
+        entry = d.pop(_TRACEBACK_KEY)
+        if len(entry) > 1:
+            call_sites.define_traceback(session, entry[0], entry[1])
+            prefix = entry[1]
+        else:
+            prefix = call_sites.get_traceback(session, entry[0])
+        d['exc_text'] = prefix + (d['exc_text'] or u'')
+
+    return _restore_args(d)
+
+
+def binary_decode_log_record(data, call_sites=None):
+    """Creates a LogRecord from a binary frame created by
+    ``binary_encode_log_record``.
+    """
+    return makeLogRecord(binary_decode(data, call_sites))
+
+
+# -- call site tables --------------------------------------------------------
+#
+# The fixed attributes of the records of a call site, i.e. ``_STATIC_FIELDS``
+# like the logger name, the pathname and the line number, are sent once per
+# sender session:
+#
+# - ``CALL_SITE_MAGIC`` + varint session + varint (site id << 1 | 1) +
+#   varint bitmap of the fixed attributes + the fixed attributes
+# - ``CALL_SITE_MAGIC`` + varint session + varint (site id << 1)
+#
+# followed by the varint bitmap of the remaining attributes and the remaining
+# attributes like in a ``BINARY_MAGIC`` frame.
+#
+# Likewise a formatted traceback is sent once per session. ``exc_text`` holds
+# the exception message only and the side-map entry ``_TRACEBACK_KEY`` holds
+# [traceback id, traceback text] the first time and [traceback id] later.
+#
+# The records of a sender arrive in order. A sender starts a new session if a
+# record may have been lost, so a lost definition doesn't break the records
+# which follow.
+
+CALL_SITE_MAGIC = b'\xb2'
+
+# not a valid attribute name
+_TRACEBACK_KEY = u'\x00traceback'
+
+
+class UnknownCallSite(ValueError):
+    """A record refers to a call site whose definition was lost.
+    """
+
+
+class CallSiteTable(object):
+    """The call sites and the formatted tracebacks of a sender.
+
+    A new session starts in a forked child process, after ``max_sites`` call
+    sites or tracebacks, every ``max_age`` seconds, e.g. for a restarted
+    receiver, and with :py:meth:`reset`.
+
+    :param int max_sites: maximum number of call sites of a session
+    :param float max_age: maximum age of a session in seconds
+    """
+    def __init__(self, max_sites=_CACHE_SIZE, max_age=30.0):
+        self._max_sites = max_sites
+        self._max_age = max_age
+        self.reset()
+
+    def reset(self):
+        """Starts a new session. The next record of each call site contains
+        its definition again.
+        """
+        session = struct.unpack('=I', os.urandom(4))[0] >> 1
+        # replaced at once, a reset may happen in another thread
+        self._state = (CALL_SITE_MAGIC + _varint(session), {}, {})
+        self._pid = current_pid()
+        self._expires = time.time() + self._max_age
+
+    def encode(self, static_values, static, exc_text=None):
+        """Returns the header of a frame of a call site and the side-map
+        entry of the traceback.
+
+        :param tuple static_values: the values of the fixed attributes
+        :param tuple static: the encoded fixed attributes
+        :param tuple exc_text: the fingerprint, the traceback and the
+            exception message returned by ``_format_exc_text``
+        :return: tuple of (header, side-map entry or None)
+        """
+        if self._pid != current_pid() or time.time() >= self._expires:
+            self.reset()
+
+        prefix, sites, tracebacks = self._state
+        if len(sites) >= self._max_sites \
+                or len(tracebacks) >= self._max_sites:
+            self.reset()
+            prefix, sites, tracebacks = self._state
+
+        header = sites.get(static_values)
+        if header is None:
+            site_id = len(sites)
+            sites[static_values] = prefix + _varint(site_id << 1)
+
+            bitmap, encoded, _side_map = static
+            header = b''.join(
+                [prefix, _varint(site_id << 1 | 1), _varint(bitmap), encoded])
+
+        if exc_text is None:
+            return header, None
+
+        fingerprint, text, _message = exc_text
+        entry = tracebacks.get(fingerprint)
+        if entry is None:
+            traceback_id = len(tracebacks)
+            tracebacks[fingerprint] = _traceback_entry([traceback_id])
+            entry = _traceback_entry([traceback_id, text])
+
+        return header, entry
+
+
+def _traceback_entry(value):
+    parts = []
+    _encode_key(_TRACEBACK_KEY, parts)
+    _encode_value(value, parts)
+    return b''.join(parts)
+
+
+class CallSiteRegistry(object):
+    """The call sites and the tracebacks of all senders of a receiver.
+
+    :param int max_sessions: the sessions which were used least recently are
+        forgotten beyond this number
+    """
+    def __init__(self, max_sessions=1024):
+        self._max_sessions = max_sessions
+        self._sessions = collections.OrderedDict()
+
+    def _session(self, session):
+        sites = self._sessions.pop(session, None)
+        if sites is None:
+            sites = {}
+            if len(self._sessions) >= self._max_sessions:
+                self._sessions.popitem(last=False)
+        self._sessions[session] = sites
+        return sites
+
+    def define(self, session, site_id, fields):
+        self._session(session)[site_id] = fields
+
+    def get(self, session, site_id):
+        """Returns the fixed attributes of a call site. Raises
+        :py:exc:`UnknownCallSite` if the call site is unknown.
+        """
+        try:
+            return self._sessions[session][site_id]
+        except KeyError:
+            raise UnknownCallSite(
+                'unknown call site %d of session %d' % (site_id, session))
+
+    def define_traceback(self, session, traceback_id, text):
+        self._session(session)[('traceback', traceback_id)] = text
+
+    def get_traceback(self, session, traceback_id):
+        """Returns a formatted traceback. Raises :py:exc:`UnknownCallSite` if
+        the traceback is unknown.
+        """
+        try:
+            return self._sessions[session][('traceback', traceback_id)]
+        except KeyError:
+            raise UnknownCallSite('unknown traceback %d of session %d' % (
+                traceback_id, session))
+
+
+# -- control messages --------------------------------------------------------
+#
+# Control messages are exchanged between the processes besides the log
+# records, e.g. the number of records a child process had to drop. They are
+# typed dicts prefixed with ``CONTROL_MAGIC``, which can't be the first byte
+# of a record of any serializer.
+
+CONTROL_MAGIC = b'\xc0'
+
+
+def encode_control(message):
+    """Serializes the dict ``message`` as control message.
+    """
+    parts = [CONTROL_MAGIC]
+    _encode_value(message, parts)
+    return b''.join(parts)
+
+
+def is_control(data):
+    """Returns True if ``data`` is a serialized control message.
+    """
+    return isinstance(data, (six.binary_type, memoryview)) \
+        and data[0:1] == CONTROL_MAGIC
+
+
+def decode_control(data):
+    """Decodes a control message created by ``encode_control``.
+    """
+    buf = bytearray(data) if six.PY2 else data
+    message, _pos = _read_value(buf, 1)
+    return message
+
+
+# -- length prefixed messages ------------------------------------------------
+#
+# A message of one or more frames, e.g. a batch of serialized records, is
+# stored as varint frame count + (varint length + bytes) per frame. See
+# :py:class:`starlog.handlers.spool.Spool`.
+
+
+def encode_message(frames):
+    """Serializes a message of one or more frames with length prefixes.
+    """
+    parts = [_varint(len(frames))]
+    for frame in frames:
+        parts.append(_varint(len(frame)))
+        parts.append(bytes(frame))
+    return b''.join(parts)
+
+
+def decode_messages(data, pos=0):
+    """Yields ``(frames, end)`` for the messages in ``data`` which were
+    created by :py:func:`encode_message`, where ``end`` is the position after
+    the message. A truncated message at the end is ignored.
+    """
+    buf = bytearray(data) if six.PY2 else data
+    size = len(buf)
+    while pos < size:
+        try:
+            count, end = _read_varint(buf, pos)
+            frames = []
+            for _ in range(count):
+                length, end = _read_varint(buf, end)
+                if end + length > size:
+                    return
+                frames.append(bytes(buf[end:end + length]))
+                end += length
+        except IndexError:
+            # truncated varint
+            return
+
+        yield frames, end
+        pos = end
+
+
+def auto_decode_log_record(data, call_sites=None):
+    """Creates a LogRecord from a record of the binary or the json
+    serializer. Pickled records are not accepted, unpickling data of unknown
+    senders is unsafe.
+    """
+    magic = data[0:1]
+    if magic == BINARY_MAGIC or magic == CALL_SITE_MAGIC:
+        return binary_decode_log_record(data, call_sites)
+
+    if data[0:1] == b'{':
+        if not isinstance(data, six.binary_type):
+            data = bytes(data)
+        return json_decode_log_record(data.decode('utf-8'))
+
+    raise ValueError('neither a binary nor a json log record')
+
+
+SERIALIZERS = {
+    'auto': (binary_encode_log_record, auto_decode_log_record),
+    'binary': (binary_encode_log_record, binary_decode_log_record),
+    'json': (json_encode_log_record, json_decode_log_record),
+    'pickle': (pickle_log_record, unpickle_log_record),
+}
+
+
+def get_serializer(name, defer_rendering=False, call_sites=None):
+    """Returns the tuple ``(encode, decode)`` of the serializer ``name``.
+
+    :param str name: one of ``binary``, ``json`` or ``pickle``. ``auto``
+        encodes like ``binary`` and decodes ``binary`` and ``json`` records.
+    :param bool defer_rendering: if set, ``encode`` sends the message
+        template and its args instead of the rendered message where
+        possible. The message is rendered when a handler of the receiver
+        formats the record.
+    :param CallSiteTable call_sites: the call site table of the sender.
+        Supported by ``binary`` and ``auto``. The receiver must decode with
+        :py:func:`get_decoder`.
+    """
+    try:
+        encode, decode = SERIALIZERS[name]
+    except KeyError:
+        raise ValueError('unknown serializer %r. Choose one of: %s' % (
+            name, ', '.join(sorted(SERIALIZERS))))
+
+    if call_sites is not None:
+        if encode is not binary_encode_log_record:
+            raise ValueError('serializer %r does not support a call site '
+                             'table' % name)
+        encode = functools.partial(encode, call_sites=call_sites)
+
+    if defer_rendering:
+        encode = functools.partial(encode, defer_rendering=True)
+    return encode, decode
+
+
+def get_decoder(name):
+    """Returns the decode function of the serializer ``name`` for a single
+    receiver. It keeps the call sites of the senders of ``binary`` records.
+    """
+    _encode, decode = get_serializer(name)
+    if name in ('auto', 'binary'):
+        decode = functools.partial(decode, call_sites=CallSiteRegistry())
+    return decode
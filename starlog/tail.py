@@ -0,0 +1,165 @@
+"""Prints the log records which a listener republishes, e.g. a
+:py:class:`starlog.ZmqHandler` or a ``starlog-collector`` with a publish
+address::
+
+    starlog-tail --connect tcp://127.0.0.1:5558 --level WARNING app.db
+
+Only the records of the given logger prefixes are sent to ``starlog-tail``,
+the other records don't leave the publisher.
+"""
+import argparse
+import logging
+import signal
+import sys
+import threading
+
+import six
+import zmq
+
+from .debug import get_debug_logger
+from .handlers.zmq_context import acquire_context, release_context
+from .serializer import auto_decode_log_record
+
+
+_log = get_debug_logger('starlog.debug.tail')
+
+
+DEFAULT_ADDRESS = 'tcp://127.0.0.1:5558'
+DEFAULT_FORMAT = '%(asctime)s [%(name)s-%(process)d] %(levelname)s: ' \
+    '%(message)s'
+
+
+def _matches(name, prefixes):
+    # a subscription of "app.db" receives "app.dbx" as well
+    for prefix in prefixes:
+        if name == prefix or name.startswith(prefix + '.'):
+            return True
+    return False
+
+
+class Subscriber(object):
+    """Subscribes to the log records of one or more publishers.
+
+    :param list addresses: the addresses of the publishers
+    :param list prefixes: logger names. The records of these loggers and of
+        their children are received. Receives all records if empty.
+    :param int level: the minimum level of the received records
+    :param int hwm: the number of records queued for the subscriber. The
+        publisher drops records if the subscriber falls behind.
+    """
+    def __init__(self, addresses, prefixes=None, level=logging.NOTSET,
+                 hwm=1000):
+        self._prefixes = list(prefixes or [])
+        self._level = level
+
+        self._context = acquire_context()
+        self._socket = self._context.socket(zmq.SUB)
+        self._socket.linger = 0
+        self._socket.rcvhwm = hwm
+
+        for prefix in self._prefixes or ['']:
+            if isinstance(prefix, six.text_type):
+                prefix = prefix.encode('utf-8')
+            self._socket.setsockopt(zmq.SUBSCRIBE, prefix)
+
+        for address in addresses:
+            self._socket.connect(address)
+
+    def receive(self, timeout=None):
+        """Returns the next matching log record or None after ``timeout``
+        seconds.
+        """
+        poll_timeout = None if timeout is None else int(timeout * 1000)
+        while self._socket.poll(poll_timeout):
+            frames = self._socket.recv_multipart()
+            if len(frames) != 2:
+                continue
+
+            try:
+                record = auto_decode_log_record(frames[1])
+            except Exception as error:
+                _log.warning('cannot decode a message of %d bytes: %s',
+                             len(frames[1]), error)
+                continue
+
+            if record.levelno < self._level:
+                continue
+            if self._prefixes and not _matches(record.name, self._prefixes):
+                continue
+            return record
+
+        return None
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            release_context(self._context)
+
+
+def _parse_level(value):
+    if value.isdigit():
+        return int(value)
+
+    level = logging.getLevelName(value.upper())
+    if not isinstance(level, int):
+        raise argparse.ArgumentTypeError('unknown level: %s' % value)
+    return level
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='starlog-tail',
+        description='Prints the log records republished by a starlog '
+                    'listener.')
+    parser.add_argument(
+        'prefixes', metavar='LOGGER', nargs='*',
+        help='print the records of these loggers and their children '
+             '(default: all loggers)')
+    parser.add_argument(
+        '--connect', metavar='ADDRESS', action='append', dest='addresses',
+        help='publish address of the listener, can be given multiple times '
+             '(default: %s)' % DEFAULT_ADDRESS)
+    parser.add_argument(
+        '--level', type=_parse_level, default=logging.NOTSET,
+        help='minimum level of the printed records, e.g. WARNING')
+    parser.add_argument(
+        '--format', default=DEFAULT_FORMAT,
+        help='logging.Formatter format of the printed records')
+
+    args = parser.parse_args(argv)
+    if not args.addresses:
+        args.addresses = [DEFAULT_ADDRESS]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(args.format))
+
+    subscriber = Subscriber(args.addresses, args.prefixes, args.level)
+
+    stopped = threading.Event()
+
+    def stop(_signum, _frame):
+        stopped.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    try:
+        while not stopped.is_set():
+            record = subscriber.receive(timeout=1.0)
+            if record is not None:
+                handler.handle(record)
+    finally:
+        subscriber.close()
+        handler.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
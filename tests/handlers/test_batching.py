@@ -0,0 +1,56 @@
+import time
+
+import pytest
+
+from starlog.handlers.batching import BatchSender
+
+
+@pytest.fixture(scope='function')
+def batches():
+    return list()
+
+
+@pytest.fixture(scope='function')
+def sender(request, batches):
+    sender = BatchSender(batches.append, max_records=3, max_bytes=10,
+                         interval=0.05)
+    request.addfinalizer(sender.close)
+    return sender
+
+
+def test_flush_on_max_records(sender, batches):
+    for frame in [b'a', b'b', b'c', b'd']:
+        sender.add(frame)
+
+    assert batches == [[b'a', b'b', b'c']]
+
+
+def test_flush_on_max_bytes(sender, batches):
+    sender.add(b'12345')
+    sender.add(b'67890')
+
+    assert batches == [[b'12345', b'67890']]
+
+
+def test_flush_on_interval(sender, batches):
+    sender.add(b'a')
+    assert batches == []
+
+    deadline = time.time() + 3
+    while not batches and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert batches == [[b'a']]
+
+
+def test_close_sends_remaining_records(sender, batches):
+    sender.add(b'a')
+    sender.close()
+
+    assert batches == [[b'a']]
+
+
+def test_flush_empty_batch(sender, batches):
+    sender.flush()
+
+    assert batches == []
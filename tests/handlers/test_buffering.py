@@ -0,0 +1,106 @@
+import logging
+import os
+
+import pytest
+
+from starlog.handlers.buffering import (
+    AsyncSender,
+    BoundedBuffer,
+    DROP_LOWEST_LEVEL,
+    DROP_NEWEST,
+    DROP_OLDEST,
+    TransportBusy)
+from starlog.serializer import decode_control, is_control
+
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+ERROR = logging.ERROR
+
+
+def _fill(buffer, entries):
+    for levelno, item in entries:
+        buffer.put(levelno, item)
+
+
+def test_buffer_fifo():
+    buffer = BoundedBuffer(5)
+    _fill(buffer, [(INFO, 'a'), (ERROR, 'b'), (DEBUG, 'c')])
+
+    assert buffer.take(2) == ['a', 'b']
+    assert buffer.take(2) == ['c']
+    assert buffer.take(2) == []
+
+
+@pytest.mark.parametrize('overflow, expectation', [
+    (DROP_NEWEST, ['a', 'b', 'c']),
+    (DROP_OLDEST, ['b', 'c', 'd']),
+    (DROP_LOWEST_LEVEL, ['b', 'c', 'd']),
+    ])
+def test_buffer_overflow(overflow, expectation):
+    buffer = BoundedBuffer(3, overflow=overflow)
+    _fill(buffer, [(DEBUG, 'a'), (ERROR, 'b'), (INFO, 'c'), (ERROR, 'd')])
+
+    assert buffer.take(10) == expectation
+    assert buffer.pop_dropped() == 1
+    assert buffer.pop_dropped() == 0
+
+
+def test_buffer_drop_lowest_level_keeps_errors():
+    buffer = BoundedBuffer(3, overflow=DROP_LOWEST_LEVEL)
+    _fill(buffer, [(ERROR, 'a'), (INFO, 'b'), (ERROR, 'c'), (DEBUG, 'd'),
+                   (INFO, 'e'), (ERROR, 'f')])
+
+    assert buffer.take(10) == ['a', 'c', 'f']
+    assert buffer.pop_dropped() == 3
+
+
+def test_buffer_unknown_overflow_policy():
+    with pytest.raises(ValueError):
+        BoundedBuffer(3, overflow='drop_all')
+
+
+class BusyTransport(object):
+    def __init__(self):
+        self.busy = False
+        self.messages = []
+
+    def send(self, frames):
+        if self.busy:
+            raise TransportBusy()
+        self.messages.append(frames)
+
+
+@pytest.fixture(scope='function')
+def transport():
+    return BusyTransport()
+
+
+def test_async_sender(transport):
+    sender = AsyncSender(transport.send, BoundedBuffer(10), max_records=2)
+    for item in [b'a', b'b', b'c']:
+        sender.add(INFO, item)
+
+    assert sender.flush(3)
+    sender.close()
+
+    assert [b'a', b'b', b'c'] == [
+        frame for frames in transport.messages for frame in frames]
+
+
+def test_async_sender_reports_dropped_records(transport):
+    transport.busy = True
+    sender = AsyncSender(transport.send, BoundedBuffer(2), max_records=10)
+    for item in [b'a', b'b', b'c', b'd']:
+        sender.add(INFO, item)
+
+    assert not sender.flush(0.1)
+
+    transport.busy = False
+    assert sender.flush(3)
+    sender.close()
+
+    control = [frames[0] for frames in transport.messages
+               if is_control(frames[0])]
+    assert len(control) == 1
+    assert decode_control(control[0]) == {'pid': os.getpid(), 'dropped': 2}
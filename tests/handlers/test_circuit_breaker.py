@@ -0,0 +1,85 @@
+import time
+
+import pytest
+
+from starlog.handlers.circuit_breaker import ConnectionSupervisor
+
+
+class FlakyConnect(object):
+    def __init__(self, failures):
+        self.failures = failures
+        self.attempts = 0
+
+    def __call__(self):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise IOError('connection refused')
+
+
+def _wait_for(condition, timeout=3):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+@pytest.fixture(scope='function')
+def make_supervisor(request):
+    def make(connect, **kwargs):
+        supervisor = ConnectionSupervisor(
+            connect, backoff_factor=0.001, max_backoff=0.01, **kwargs)
+        request.addfinalizer(supervisor.close)
+        return supervisor
+    return make
+
+
+def test_connect_success(make_supervisor):
+    supervisor = make_supervisor(FlakyConnect(0))
+
+    assert supervisor.connect()
+    assert supervisor.allow()
+
+
+def test_reconnect_in_background(make_supervisor):
+    connect = FlakyConnect(3)
+    supervisor = make_supervisor(connect)
+
+    started = time.time()
+    assert not supervisor.connect()
+    assert time.time() - started < 0.1
+    assert supervisor.is_open
+
+    _wait_for(lambda: not supervisor.is_open)
+
+    assert supervisor.allow()
+    assert connect.attempts == 4
+
+
+def test_trip_opens_circuit(make_supervisor):
+    connect = FlakyConnect(0)
+    supervisor = make_supervisor(connect)
+    supervisor.connect()
+
+    connect.failures = 2
+    supervisor.trip(IOError('broken pipe'))
+    assert not supervisor.allow()
+
+    _wait_for(supervisor.allow)
+    assert supervisor.allow()
+
+
+def test_give_up_after_deadline(make_supervisor):
+    connect = FlakyConnect(1000)
+    supervisor = make_supervisor(connect, deadline=0.05, retry_after=0.05)
+
+    supervisor.connect()
+    _wait_for(lambda: supervisor._gave_up_at is not None)
+
+    attempts = connect.attempts
+    time.sleep(0.1)
+    assert connect.attempts == attempts
+
+    # the next log call restarts the reconnect
+    connect.failures = 0
+    assert not supervisor.allow()
+    _wait_for(supervisor.allow)
+    assert supervisor.allow()
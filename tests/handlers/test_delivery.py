@@ -0,0 +1,180 @@
+import logging
+import threading
+import time
+from multiprocessing import Process
+
+import pytest
+
+from starlog.handlers.delivery import DeliveryTracker
+from starlog.handlers.status_handler import metric_collection
+
+
+@pytest.fixture(scope='function')
+def metrics():
+    metric_collection.get_all_and_reset()
+    return metric_collection
+
+
+def _record(sequence, pid=100, sent=None):
+    return logging.makeLogRecord({
+        'process': pid, 'starlog_seq': sequence, 'starlog_sent': sent})
+
+
+def _receive(tracker, sequences, now=0.0, pid=100):
+    for sequence in sequences:
+        tracker.received(_record(sequence, pid), now=now)
+
+
+def test_delivery_tracker_in_order(metrics):
+    tracker = DeliveryTracker()
+    _receive(tracker, [1, 2, 3])
+
+    stats = tracker.stats()[100]
+    assert stats['received'] == 3
+    assert stats['lost'] == stats['pending'] == stats['reordered'] == 0
+    assert metrics.get_all_and_reset().get('starlog-lost', 0) == 0
+
+
+def test_delivery_tracker_ignores_unstamped_records():
+    tracker = DeliveryTracker()
+    tracker.received(logging.makeLogRecord({'process': 100}))
+
+    assert tracker.stats() == {}
+
+
+def test_delivery_tracker_reordered(metrics):
+    tracker = DeliveryTracker(reorder_window=1.0)
+    _receive(tracker, [2, 1, 3, 6, 5, 4])
+    tracker.sweep(now=10.0)
+
+    stats = tracker.stats()[100]
+    assert stats['received'] == 6
+    assert stats['reordered'] == 3
+    assert stats['lost'] == stats['pending'] == 0
+    assert metrics.get_all_and_reset()['starlog-reordered'] == 3
+
+
+def test_delivery_tracker_lost_after_reorder_window(metrics):
+    tracker = DeliveryTracker(reorder_window=1.0)
+    _receive(tracker, [1, 2, 6, 4])
+
+    assert tracker.stats()[100]['pending'] == 2
+
+    # the sweep runs with the next record after the reorder window
+    _receive(tracker, [7], now=1.5)
+    _receive(tracker, [3], now=1.5)
+
+    stats = tracker.stats()[100]
+    assert stats['lost'] == 2
+    assert stats['reordered'] == 1
+    assert stats['duplicates'] == 1
+    metric_values = metrics.get_all_and_reset()
+    assert metric_values['starlog-lost'] == 2
+    assert metric_values['starlog-duplicates'] == 1
+
+
+def test_delivery_tracker_reported_drops_are_not_lost(metrics):
+    tracker = DeliveryTracker(reorder_window=1.0)
+    _receive(tracker, [1, 5])
+    tracker.handle_control({'pid': 100, 'dropped': 2}, now=0.0)
+    tracker.sweep(now=1.0)
+
+    assert tracker.stats()[100]['lost'] == 1
+    assert metrics.get_all_and_reset()['starlog-lost'] == 1
+
+
+def test_delivery_tracker_final_sequence(metrics):
+    tracker = DeliveryTracker()
+    _receive(tracker, [1, 2])
+    tracker.handle_control({'pid': 100, 'sequence': 5, 'dropped': 1},
+                           now=0.0)
+
+    stats = tracker.stats()[100]
+    assert stats['lost'] == 2
+    assert stats['pending'] == 0
+    assert stats['closed']
+
+
+def test_delivery_tracker_reused_pid(metrics):
+    tracker = DeliveryTracker()
+    _receive(tracker, [1, 2, 3])
+    _receive(tracker, [1, 2])
+
+    stats = tracker.stats()[100]
+    assert stats['received'] == 2
+    assert stats['duplicates'] == 0
+
+
+def test_delivery_tracker_per_process():
+    tracker = DeliveryTracker()
+    _receive(tracker, [1, 2], pid=100)
+    _receive(tracker, [1], pid=200)
+
+    stats = tracker.stats()
+    assert stats[100]['received'] == 2
+    assert stats[200]['received'] == 1
+
+
+def test_delivery_tracker_max_processes():
+    tracker = DeliveryTracker(max_processes=2)
+    for pid in (100, 200, 300):
+        _receive(tracker, [1], pid=pid)
+
+    assert sorted(tracker.stats()) == [200, 300]
+
+
+def test_delivery_tracker_latency(metrics):
+    tracker = DeliveryTracker()
+    tracker.received(_record(1, sent=10.0), now=10.004)
+    tracker.received(_record(2, sent=10.0), now=10.3)
+
+    stats = tracker.stats()[100]
+    assert stats['latency_p50'] == 5
+    assert stats['latency_max'] == pytest.approx(300.0)
+
+    metric_values = metrics.get_all_and_reset()
+    assert metric_values['starlog-latency-ms.count'] == 2
+    assert metric_values['starlog-latency-ms.p99'] == \
+        pytest.approx(300.0)
+
+
+def test_delivery_tracker_wait_for_senders():
+    tracker = DeliveryTracker()
+    process = Process(target=time.sleep, args=(5, ))
+    process.start()
+
+    try:
+        tracker.received(logging.makeLogRecord({'process': process.pid}))
+        # a process which exited without ending its stream
+        tracker.received(logging.makeLogRecord({'process': 2 ** 22 + 1}))
+
+        deadline = time.time() + 0.2
+        assert tracker.wait_for_senders(deadline) == set([process.pid])
+        assert time.time() >= deadline
+
+        ender = threading.Timer(0.1, tracker.handle_control,
+                                args=({'pid': process.pid, 'eos': True}, ))
+        ender.start()
+        assert tracker.wait_for_senders(time.time() + 5) == set()
+        ender.join()
+    finally:
+        process.terminate()
+        process.join()
+
+
+def test_delivery_tracker_expect_sender():
+    tracker = DeliveryTracker()
+    process = Process(target=time.sleep, args=(5, ))
+    process.start()
+
+    try:
+        # no log record of the process arrived yet
+        tracker.expect_sender(process.pid)
+        assert tracker.wait_for_senders(time.time() + 0.1) == \
+            set([process.pid])
+
+        tracker.forget_sender(process.pid)
+        assert tracker.wait_for_senders(time.time() + 5) == set()
+    finally:
+        process.terminate()
+        process.join()
@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+
+from starlog.handlers.dispatcher import SinkDispatcher
+
+
+def _record(name, msg):
+    return logging.makeLogRecord({'name': name, 'msg': msg})
+
+
+def test_keeps_order_per_logger():
+    forwarded = []
+    dispatcher = SinkDispatcher(forwarded.append, threads=3)
+
+    for i in range(100):
+        dispatcher.dispatch(_record('logger-%d' % (i % 5), i))
+    dispatcher.close()
+
+    assert len(forwarded) == 100
+    for n in range(5):
+        name = 'logger-%d' % n
+        msgs = [record.msg for record in forwarded if record.name == name]
+        assert msgs == sorted(msgs)
+
+
+def test_depth():
+    release = threading.Event()
+
+    def forward(record):
+        release.wait(5)
+
+    dispatcher = SinkDispatcher(forward, threads=1)
+    for i in range(3):
+        dispatcher.dispatch(_record('a', i))
+
+    # the first record may already be in forward()
+    assert dispatcher.depth in (2, 3)
+
+    release.set()
+    dispatcher.close()
+    assert dispatcher.depth == 0
+
+
+def test_exception_in_forward_does_not_stop_thread():
+    forwarded = []
+
+    def forward(record):
+        if record.msg == 'bad':
+            raise ValueError(record.msg)
+        forwarded.append(record.msg)
+
+    dispatcher = SinkDispatcher(forward, threads=1)
+    dispatcher.dispatch(_record('a', 'bad'))
+    dispatcher.dispatch(_record('a', 'good'))
+    dispatcher.close()
+
+    assert forwarded == ['good']
+
+
+def test_close_deadline_counts_left_over():
+    entered = threading.Event()
+    release = threading.Event()
+    forwarded = []
+
+    def forward(record):
+        entered.set()
+        release.wait(5)
+        forwarded.append(record)
+
+    dispatcher = SinkDispatcher(forward, threads=1)
+    for i in range(3):
+        dispatcher.dispatch(_record('a', i))
+    assert entered.wait(5)
+
+    closing = threading.Thread(
+        target=lambda: forwarded.append(dispatcher.close(time.time() - 1)))
+    closing.start()
+    # the deadline is set before the first record leaves forward()
+    thread = dispatcher._threads[0]
+    deadline = time.time() + 5
+    while thread.deadline is None and time.time() < deadline:
+        time.sleep(0.001)
+    release.set()
+    closing.join()
+
+    # the first record was in forward() already
+    assert len(forwarded) == 2
+    assert forwarded[-1] == 2
+
+
+def test_close_deadline_with_full_queue():
+    entered = threading.Event()
+    release = threading.Event()
+    forwarded = []
+
+    def forward(record):
+        entered.set()
+        release.wait(10)
+        forwarded.append(record)
+
+    dispatcher = SinkDispatcher(forward, threads=1, queue_size=1)
+    dispatcher.dispatch(_record('a', 0))
+    assert entered.wait(5)
+    # the thread is stuck in forward() and the queue is full
+    dispatcher.dispatch(_record('a', 1))
+
+    try:
+        start = time.time()
+        assert dispatcher.close(time.time() + 0.2) == 1
+        # the put of the stop item doesn't block past the deadline
+        assert time.time() - start < 3
+    finally:
+        release.set()
+
+    thread = dispatcher._threads[0]
+    thread.join(5)
+    assert not thread.is_alive()
+    assert [record.msg for record in forwarded] == [0]
@@ -0,0 +1,132 @@
+import logging
+from multiprocessing import Pipe, Process
+
+import flexmock
+import pytest
+
+from starlog import MultiprocessHandler
+from starlog.handlers.level_table import LevelTable
+from starlog.handlers.ring_buffer import RingBufferQueue
+
+
+@pytest.fixture(scope='function')
+def sink_loggers(request):
+    loggers = {}
+    for name in ['test.levels', 'test.levels.app', 'test.levels.app.db']:
+        loggers[name] = logging.getLogger(name)
+
+    def reset():
+        for logger in loggers.values():
+            logger.setLevel(logging.NOTSET)
+
+    request.addfinalizer(reset)
+    return loggers
+
+
+def test_level_table_not_written():
+    table = LevelTable('test.levels')
+
+    assert table.threshold('app') is None
+    assert table.is_enabled('app', logging.DEBUG)
+
+
+def test_level_table(sink_loggers):
+    sink_loggers['test.levels'].setLevel(logging.ERROR)
+    sink_loggers['test.levels.app'].setLevel(logging.WARNING)
+    sink_loggers['test.levels.app.db'].setLevel(logging.DEBUG)
+
+    table = LevelTable('test.levels')
+    table.update()
+
+    assert table.threshold('web') == logging.ERROR
+    assert table.threshold('') == logging.ERROR
+    assert table.threshold('app') == logging.WARNING
+    assert table.threshold('app.web') == logging.WARNING
+    assert table.threshold('app.db.pool') == logging.DEBUG
+    assert not table.is_enabled('app', logging.INFO)
+    assert table.is_enabled('app.db', logging.INFO)
+
+
+def test_level_table_update(sink_loggers):
+    sink_loggers['test.levels'].setLevel(logging.ERROR)
+
+    table = LevelTable('test.levels')
+    table.update()
+    assert table.threshold('app') == logging.ERROR
+
+    sink_loggers['test.levels.app'].setLevel(logging.INFO)
+    table.update()
+    assert table.threshold('app') == logging.INFO
+
+    # nothing changed, nothing written
+    flexmock.flexmock(table).should_receive('_load').never()
+    table.update()
+    assert table.threshold('app') == logging.INFO
+
+
+def test_level_table_disabled(sink_loggers):
+    sink_loggers['test.levels'].setLevel(logging.DEBUG)
+
+    logging.disable(logging.WARNING)
+    try:
+        table = LevelTable('test.levels')
+        table.update()
+    finally:
+        logging.disable(logging.NOTSET)
+
+    assert not table.is_enabled('app', logging.WARNING)
+    assert table.is_enabled('app', logging.ERROR)
+
+
+def test_level_table_shared_with_child(sink_loggers):
+    sink_loggers['test.levels'].setLevel(logging.ERROR)
+    table = LevelTable('test.levels')
+    table.update()
+
+    connection, child_connection = Pipe()
+
+    def child():
+        child_connection.send(table.threshold('app'))
+        # wait for the update of the parent
+        child_connection.recv()
+        child_connection.send(table.threshold('app'))
+
+    process = Process(target=child)
+    process.start()
+
+    try:
+        assert connection.recv() == logging.ERROR
+        sink_loggers['test.levels.app'].setLevel(logging.INFO)
+        table.update()
+        connection.send(None)
+        assert connection.recv() == logging.INFO
+    finally:
+        process.join()
+
+
+def test_multiprocess_handler_level_pushdown(sink_logger):
+    sink_logger.setLevel(logging.WARNING)
+    queue = RingBufferQueue()
+    mph = MultiprocessHandler(queue)
+    connection, child_connection = Pipe()
+
+    def emitter():
+        forwarded = []
+        flexmock.flexmock(mph).should_receive('forward_to_main') \
+            .replace_with(lambda record: forwarded.append(record.levelno))
+        logger = logging.getLogger('app')
+        for level in (logging.INFO, logging.WARNING):
+            mph.emit(logger.makeRecord('app', level, __file__, 1, 'msg', (),
+                                       None))
+        child_connection.send(forwarded)
+
+    process = Process(target=emitter)
+    process.start()
+
+    try:
+        # the record of the info level is discarded before it is sent
+        assert connection.recv() == [logging.WARNING]
+    finally:
+        process.join()
+        mph.close()
+        queue.close()
@@ -0,0 +1,134 @@
+import logging
+import time
+
+import pytest
+
+from starlog.handlers.reorder import ReorderStage
+from starlog.handlers.status_handler import metric_collection
+
+
+def _record(created, pid=100, msg=None):
+    record = logging.makeLogRecord({'process': pid, 'msg': msg})
+    record.created = created
+    return record
+
+
+def _created(records):
+    return [record.created for record in records]
+
+
+def test_reorder_merges_senders():
+    forwarded = []
+    stage = ReorderStage(forwarded.append, window=0.2)
+
+    now = time.time()
+    # two senders, each in order, interleaved on arrival
+    for offset in (0.03, 0.01, 0.04, 0.02):
+        stage.dispatch(_record(now + offset, pid=100))
+    for offset in (0.005, 0.025):
+        stage.dispatch(_record(now + offset, pid=200))
+
+    assert forwarded == []
+    assert stage.depth == 6
+
+    deadline = time.time() + 3
+    while len(forwarded) < 6 and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert _created(forwarded) == sorted(_created(forwarded))
+    assert stage.close() == 0
+    assert stage.late == 0
+
+
+def test_reorder_forwards_stragglers():
+    metric_collection.get_all_and_reset()
+    forwarded = []
+    stage = ReorderStage(forwarded.append, window=0.01)
+
+    now = time.time()
+    stage.dispatch(_record(now))
+    deadline = time.time() + 3
+    while not forwarded and time.time() < deadline:
+        time.sleep(0.01)
+
+    stage.dispatch(_record(now - 1.0, msg='late'))
+    stage.close()
+
+    assert [record.msg for record in forwarded] == [None, 'late']
+    assert stage.late == 1
+    assert metric_collection.get_all_and_reset()['starlog-late'] == 1
+
+
+def test_reorder_max_records_per_sender():
+    forwarded = []
+    dropped = []
+    stage = ReorderStage(forwarded.append, window=60, max_records=3,
+                         on_dropped=dropped.append)
+
+    now = time.time()
+    stage.dispatch(_record(now, pid=200))
+    for i in range(5):
+        stage.dispatch(_record(now + 1 + i, pid=100))
+
+    # the newest records of the sender beyond the limit are dropped
+    assert stage.depth == 4
+    assert stage.dropped == 2
+    assert dropped == [1, 1]
+
+    stage.close()
+    assert _created(forwarded) == [now, now + 1, now + 2, now + 3]
+
+
+def test_reorder_sender_clock_ahead():
+    forwarded = []
+    stage = ReorderStage(forwarded.append, window=0.05)
+
+    now = time.time()
+    # the clock of this sender runs an hour ahead
+    stage.dispatch(_record(now + 3600, pid=200))
+
+    deadline = time.time() + 3
+    while not forwarded and time.time() < deadline:
+        time.sleep(0.01)
+
+    # records of the other senders within the window aren't late
+    stage.dispatch(_record(time.time(), pid=100))
+    stage.close()
+
+    assert len(forwarded) == 2
+    assert stage.late == 0
+
+
+def test_reorder_close_flushes_in_order():
+    forwarded = []
+    stage = ReorderStage(forwarded.append, window=60)
+
+    now = time.time()
+    for offset in (3, 1, 2):
+        stage.dispatch(_record(now + offset))
+
+    assert stage.close() == 0
+    assert _created(forwarded) == [now + 1, now + 2, now + 3]
+
+
+@pytest.mark.parametrize('blocked', [True, False])
+def test_reorder_close_deadline(blocked):
+    forwarded = []
+
+    def forward(record):
+        if blocked:
+            time.sleep(0.3)
+        forwarded.append(record)
+
+    stage = ReorderStage(forward, window=60)
+    for i in range(3):
+        stage.dispatch(_record(time.time() + i))
+
+    left_over = stage.close(deadline=time.time() + 0.1)
+
+    if blocked:
+        # the first record blocked the stage beyond the deadline
+        assert left_over == 2
+    else:
+        assert left_over == 0
+        assert len(forwarded) == 3
@@ -0,0 +1,185 @@
+import logging
+import os
+import signal
+import threading
+import time
+from multiprocessing import Event, Process
+
+import flexmock
+import pytest
+from six.moves import queue as Queue
+
+from starlog import MultiprocessHandler
+from starlog.handlers.ring_buffer import RingBufferQueue
+
+
+@pytest.fixture(scope='function')
+def ring(request):
+    ring = RingBufferQueue(64)
+    request.addfinalizer(ring.close)
+    return ring
+
+
+def test_put_get(ring):
+    ring.put(b'frame')
+    ring.put({'a': 1})
+    ring.put(None)
+
+    assert ring.qsize() == 3
+    assert ring.get() == b'frame'
+    assert ring.get() == {'a': 1}
+    assert ring.get() is None
+    assert ring.empty()
+
+
+def test_wrap_around(ring):
+    for i in range(20):
+        ring.put_nowait(b'%020d' % i)
+        assert ring.get_nowait() == b'%020d' % i
+
+
+def test_full(ring):
+    ring.put_nowait(b'x' * 30)
+    with pytest.raises(Queue.Full):
+        ring.put_nowait(b'x' * 30)
+
+    ring.get()
+    ring.put_nowait(b'x' * 30)
+
+
+def test_item_exceeds_size(ring):
+    with pytest.raises(ValueError):
+        ring.put_nowait(b'x' * 100)
+
+
+def test_lock_of_killed_process(ring):
+    locked = Event()
+
+    def hold_lock():
+        ring._acquire()
+        locked.set()
+        time.sleep(10)
+
+    process = Process(target=hold_lock)
+    process.start()
+    try:
+        assert locked.wait(5)
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+
+        # the lock died with its holder
+        start = time.time()
+        ring.put_nowait(b'frame')
+        assert ring.get(timeout=1) == b'frame'
+        assert time.time() - start < 0.5
+    finally:
+        if process.is_alive():
+            process.terminate()
+            process.join()
+
+
+def test_lock_is_not_inherited(ring):
+    # the lock holder forks a child
+    ring._acquire()
+    try:
+        process = Process(target=ring.put_nowait, args=(b'frame', ))
+        process.start()
+        time.sleep(0.1)
+        assert ring.empty()
+    finally:
+        ring._release()
+
+    process.join(5)
+    assert ring.get(timeout=1) == b'frame'
+
+
+def test_get_timeout(ring):
+    with pytest.raises(Queue.Empty):
+        ring.get(timeout=0.01)
+
+    with pytest.raises(Queue.Empty):
+        ring.get_nowait()
+
+
+def test_wakeup_from_child_process(ring):
+    def producer():
+        time.sleep(0.1)
+        for i in range(10):
+            ring.put(b'%d' % i)
+
+    process = Process(target=producer)
+    process.start()
+
+    received = [ring.get(timeout=5) for _ in range(10)]
+    process.join()
+
+    assert received == [b'%d' % i for i in range(10)]
+
+
+@pytest.mark.parametrize('serializer', [None, 'binary'])
+def test_multiprocess_handler(sink_logger, logged_records, serializer):
+    def emitter():
+        for i in range(50):
+            logging.getLogger('example.pkg').info('message %d', i)
+
+    mph = MultiprocessHandler(RingBufferQueue(), serializer=serializer)
+
+    logger = logging.getLogger('example')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(mph)
+
+    process = Process(target=emitter)
+    process.start()
+    process.join()
+
+    # cleanup
+    mph.close()
+    logger.removeHandler(mph)
+
+    assert [record.getMessage() for record in logged_records] == [
+        'message %d' % i for i in range(50)]
+
+
+def test_multiprocess_handler_counts_dropped_records(sink_logger,
+                                                     target_handler,
+                                                     logged_records):
+    release = threading.Event()
+    # the listener blocks in the first record until the queue overflowed
+    blocking_filter = flexmock(
+        filter=lambda record: release.wait(0.5) or True)
+    target_handler.addFilter(blocking_filter)
+
+    def emitter():
+        logger = logging.getLogger('example.pkg')
+        for i in range(100):
+            logger.info('message %d', i)
+        mph.close()
+
+    mph = MultiprocessHandler(RingBufferQueue(1024), serializer='binary')
+
+    logger = logging.getLogger('example')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(mph)
+
+    process = Process(target=emitter)
+    process.start()
+    process.join()
+    release.set()
+
+    # cleanup
+    mph.close()
+    logger.removeHandler(mph)
+
+    assert mph.dropped_records > 0
+    assert len(logged_records) + mph.dropped_records == 100
+
+
+def test_get_many(ring):
+    for i in range(5):
+        ring.put(b'%d' % i)
+
+    assert ring.get_many(3) == [b'0', b'1', b'2']
+    assert ring.get_many(3) == [b'3', b'4']
+    assert ring.qsize() == 0
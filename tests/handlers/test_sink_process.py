@@ -0,0 +1,156 @@
+import logging
+import multiprocessing
+import os
+from multiprocessing import Process
+
+import pytest
+
+from starlog import MultiprocessHandler, ZmqHandler
+from starlog.handlers.sink_process import SinkProcessError
+
+
+def _sink_config(path):
+    return {
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {
+            'plain': {'format': '%(process)d %(message)s'},
+        },
+        'handlers': {
+            'file': {
+                'class': 'logging.FileHandler',
+                'filename': path,
+                'formatter': 'plain',
+            },
+        },
+        'loggers': {
+            'starlog.logsink': {
+                'handlers': ['file'],
+                'level': 'DEBUG',
+                'propagate': False,
+            },
+        },
+    }
+
+
+def _log_from_main_and_child(handler):
+    logger = logging.getLogger('example')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(handler)
+
+    def emitter():
+        logger.info('from child')
+        handler.close()
+
+    try:
+        process = Process(target=emitter)
+        process.start()
+        process.join()
+
+        logger.info('from main')
+    finally:
+        handler.close()
+        logger.removeHandler(handler)
+
+
+@pytest.mark.parametrize('create_handler', [
+    lambda config: MultiprocessHandler(manager_queue=False,
+                                       sink_config=config),
+    lambda config: ZmqHandler('tcp://127.0.0.1', serializer='binary',
+                              sink_config=config),
+    ])
+def test_sink_process(tmpdir, create_handler):
+    path = str(tmpdir.join('sink.log'))
+    handler = create_handler(_sink_config(path))
+
+    sink_pid = handler.sink_pid
+    assert sink_pid != os.getpid()
+
+    _log_from_main_and_child(handler)
+
+    with open(path) as stream:
+        lines = stream.read().splitlines()
+
+    assert lines[0].split(' ', 1)[1] == 'from child'
+    assert lines[1] == '%d from main' % os.getpid()
+    # the sink process is stopped
+    with pytest.raises(OSError):
+        os.kill(sink_pid, 0)
+
+
+@pytest.mark.skipif(not hasattr(multiprocessing, 'get_start_method'),
+                    reason='python 2 always forks')
+@pytest.mark.parametrize('start_method', ['spawn', 'forkserver'])
+def test_sink_process_ignores_start_method(tmpdir, start_method):
+    original = multiprocessing.get_start_method(allow_none=True)
+    multiprocessing.set_start_method(start_method, force=True)
+    try:
+        path = str(tmpdir.join('sink.log'))
+        handler = ZmqHandler('tcp://127.0.0.1', serializer='binary',
+                             sink_config=_sink_config(path))
+        assert handler.sink_pid != os.getpid()
+
+        logger = logging.getLogger('example')
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            logger.info('from main')
+        finally:
+            handler.close()
+            logger.removeHandler(handler)
+    finally:
+        multiprocessing.set_start_method(original, force=True)
+
+    with open(path) as stream:
+        assert stream.read() == '%d from main\n' % os.getpid()
+
+
+def test_sink_process_per_shard(tmpdir):
+    path = str(tmpdir.join('sink.log'))
+    handler = ZmqHandler('tcp://127.0.0.1', serializer='binary', shards=3,
+                         sink_config=_sink_config(path))
+
+    sink_pids = handler.sink_pids
+    assert len(set(sink_pids)) == 3
+    assert os.getpid() not in sink_pids
+    assert len(set(handler.addresses)) == 3
+
+    logger = logging.getLogger('example')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(handler)
+
+    def emitter():
+        for i in range(10):
+            logger.info('record %d', i)
+        handler.close()
+
+    try:
+        processes = [Process(target=emitter) for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    finally:
+        handler.close()
+        logger.removeHandler(handler)
+
+    with open(path) as stream:
+        lines = stream.read().splitlines()
+
+    # every shard forwards the records of its processes in order
+    for process in processes:
+        assert [line.split(' ', 1)[1] for line in lines
+                if line.startswith('%d ' % process.pid)] == \
+            ['record %d' % i for i in range(10)]
+    for sink_pid in sink_pids:
+        with pytest.raises(OSError):
+            os.kill(sink_pid, 0)
+
+
+def test_sink_process_invalid_config():
+    with pytest.raises(SinkProcessError):
+        MultiprocessHandler(manager_queue=False,
+                            sink_config={'version': 'invalid'})
@@ -0,0 +1,129 @@
+import os
+
+import pytest
+
+from starlog.handlers.buffering import TransportBusy
+from starlog.handlers.spool import Spool, iter_spool, list_segments
+
+
+class Transport(object):
+    def __init__(self, busy=False):
+        self.busy = busy
+        self.sent = []
+
+    def send(self, frames):
+        if self.busy:
+            raise TransportBusy()
+        self.sent.append(frames)
+
+
+@pytest.fixture(scope='function')
+def directory(tmpdir):
+    return str(tmpdir.join('spool'))
+
+
+def _messages(count):
+    return [[('message %d' % i).encode('utf-8')] for i in range(count)]
+
+
+def test_spool_sends_while_transport_works(directory):
+    spool = Spool(directory)
+    transport = Transport()
+
+    assert spool.send_or_spool([b'a'], transport.send)
+
+    assert transport.sent == [[b'a']]
+    assert len(spool) == 0
+    assert not os.path.exists(directory)
+
+
+def test_spool_replays_in_order(directory):
+    spool = Spool(directory, segment_bytes=50)
+    transport = Transport(busy=True)
+
+    messages = _messages(10)
+    for frames in messages:
+        assert spool.send_or_spool(frames, transport.send)
+
+    assert len(spool) == 10
+    assert len(list_segments(directory)) > 1
+    assert not spool.replay(transport.send)
+
+    # the order is kept while older messages are spooled
+    transport.busy = False
+    spool.send_or_spool([b'last'], transport.send)
+    assert transport.sent == []
+
+    assert spool.replay(transport.send)
+    assert transport.sent == messages + [[b'last']]
+    assert len(spool) == 0
+    assert list_segments(directory) == []
+
+    spool.close()
+    assert not os.path.exists(directory)
+
+
+def test_spool_keeps_multiple_frames(directory):
+    spool = Spool(directory)
+    spool.append([b'first', b'', b'\x00' * 300])
+
+    transport = Transport()
+    spool.replay(transport.send)
+    assert transport.sent == [[b'first', b'', b'\x00' * 300]]
+
+
+def test_spool_replay_stops_when_busy(directory):
+    spool = Spool(directory)
+    for frames in _messages(3):
+        spool.append(frames)
+
+    sent = []
+
+    def send(frames):
+        if sent:
+            raise TransportBusy()
+        sent.append(frames)
+
+    assert not spool.replay(send)
+    assert len(spool) == 2
+
+    transport = Transport()
+    assert spool.replay(transport.send)
+    assert sent + transport.sent == _messages(3)
+
+
+def test_spool_disk_budget(directory):
+    spool = Spool(directory, max_bytes=100)
+
+    results = [spool.append(frames) for frames in _messages(10)]
+    assert results[0]
+    assert not results[-1]
+    assert len(spool) == results.count(True)
+
+    # replayed messages free the budget
+    spool.replay(Transport().send)
+    assert spool.append([b'again'])
+
+
+def test_spool_left_on_close(directory):
+    spool = Spool(directory, segment_bytes=50)
+    for frames in _messages(5):
+        spool.append(frames)
+    spool.close()
+
+    assert [frames for _path, frames in iter_spool(directory)] == \
+        _messages(5)
+
+
+def test_spool_truncated_segment(directory):
+    spool = Spool(directory)
+    for frames in _messages(2):
+        spool.append(frames)
+
+    # e.g. the disk was full
+    path = list_segments(directory)[0]
+    with open(path, 'rb+') as stream:
+        stream.truncate(os.path.getsize(path) - 3)
+
+    assert [frames for _path, frames in iter_spool(directory)] == \
+        _messages(1)
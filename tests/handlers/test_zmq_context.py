@@ -0,0 +1,78 @@
+import threading
+from multiprocessing import Pipe, Process
+
+import pytest
+
+zmq = pytest.importorskip('zmq')
+
+from starlog.handlers.zmq_context import (  # noqa: E402
+    acquire_context, release_context)
+from starlog.handlers.zmq_handler import RobustZmqSocket  # noqa: E402
+
+
+def test_sockets_share_a_context():
+    sender = RobustZmqSocket(zmq.PUSH, 'tcp://127.0.0.1:34783')
+    receiver = RobustZmqSocket(zmq.PULL, 'tcp://127.0.0.1:34783')
+
+    context = sender.context
+    assert receiver.context is context
+
+    sender.close()
+    assert not context.closed
+
+    receiver.close()
+    assert context.closed
+
+
+def test_reconnect_reuses_the_context():
+    sender = RobustZmqSocket(zmq.PUSH, 'tcp://127.0.0.1:34783')
+    try:
+        sender.connect_once()
+        context = sender.context
+        sender.connect_once()
+        assert sender.context is context
+    finally:
+        sender.close()
+
+
+def test_reconnect_discards_the_pending_messages():
+    # nobody listens, the messages stay pending
+    sender = RobustZmqSocket(zmq.PUSH, 'tcp://127.0.0.1:34783', linger=200)
+    sender.connect_once()
+    context = sender.context
+    replaced = sender.socket
+    assert replaced.linger == 200
+    replaced.send(b'pending')
+
+    sender.connect_once()
+    assert replaced.closed
+    assert sender.socket.linger == 200
+    sender.socket.send(b'pending')
+
+    # terminating the context waits for the linger of the new socket only
+    closing = threading.Thread(target=sender.close)
+    closing.daemon = True
+    closing.start()
+    closing.join(5)
+    assert not closing.is_alive()
+    assert context.closed
+
+
+def test_child_process_gets_its_own_context():
+    context = acquire_context()
+    parent_connection, child_connection = Pipe()
+
+    def run():
+        child_context = acquire_context()
+        child_connection.send(child_context is not context)
+        release_context(child_context)
+
+    try:
+        process = Process(target=run)
+        process.start()
+        assert parent_connection.recv()
+        process.join()
+    finally:
+        release_context(context)
+
+    assert context.closed
@@ -0,0 +1,161 @@
+import json
+import logging
+import os
+import socket
+import time
+
+import pytest
+
+pytest.importorskip('zmq')
+
+from starlog import ZmqHandler  # noqa: E402
+from starlog.collector import (  # noqa: E402
+    Collector, DEFAULT_ADDRESS, load_config, parse_args)
+
+
+def _wait_for(condition, timeout=3):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+@pytest.fixture(scope='function')
+def collector(request):
+    collector = Collector(['tcp://127.0.0.1', 'tcp://127.0.0.1'])
+    request.addfinalizer(collector.close)
+    return collector
+
+
+@pytest.mark.parametrize('serializer', ['binary', 'json'])
+def test_collector_receives_from_clients(collector, sink_logger,
+                                         logged_records, serializer):
+    clients = [ZmqHandler(address, serializer=serializer, client_only=True)
+               for address in collector.addresses]
+
+    try:
+        for i, client in enumerate(clients):
+            client.emit(logging.makeLogRecord(
+                {'name': 'app', 'levelno': logging.INFO, 'msg': str(i)}))
+        _wait_for(lambda: len(logged_records) == 2)
+    finally:
+        for client in clients:
+            client.close()
+
+    assert sorted(record.msg for record in logged_records) == ['0', '1']
+
+
+def _free_address():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return 'tcp://127.0.0.1:%d' % port
+
+
+def test_client_spools_until_collector_starts(sink_logger, logged_records,
+                                              tmpdir):
+    address = _free_address()
+    client = ZmqHandler(address, client_only=True,
+                        spool_directory=str(tmpdir), serializer='binary',
+                        call_site_table=True)
+    collector = None
+
+    try:
+        for i in range(100):
+            client.emit(logging.makeLogRecord(
+                {'name': 'app', 'levelno': logging.INFO, 'msg': str(i)}))
+        # nobody listens
+        assert len(client._spool) == 100
+        assert len(os.listdir(str(tmpdir))) == 1
+
+        collector = Collector([address])
+        _wait_for(lambda: len(logged_records) == 100, timeout=10)
+    finally:
+        client.close()
+        if collector is not None:
+            collector.close()
+
+    assert [record.msg for record in logged_records] == \
+        [str(i) for i in range(100)]
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_client_call_sites_after_collector_restart(sink_logger,
+                                                  logged_records):
+    address = _free_address()
+    client = ZmqHandler(address, client_only=True, serializer='binary',
+                        call_site_table=True)
+    collector = Collector([address])
+
+    def emit(msg):
+        client.emit(logging.makeLogRecord(
+            {'name': 'app', 'levelno': logging.INFO, 'msg': msg}))
+
+    try:
+        emit('before')
+        _wait_for(lambda: logged_records)
+        collector.close()
+
+        # zmq reconnects the socket of the client to the new collector,
+        # which learns the call site from scratch
+        collector = Collector([address])
+        deadline = time.time() + 5
+        while len(logged_records) < 2 and time.time() < deadline:
+            emit('after')
+            time.sleep(0.05)
+    finally:
+        client.close()
+        collector.close()
+
+    assert [record.msg for record in logged_records[:2]] == \
+        ['before', 'after']
+
+
+def test_collector_ignores_garbage(collector, sink_logger, logged_records):
+    client = ZmqHandler(collector.addresses[0], client_only=True)
+    client._get_socket()
+
+    try:
+        client._send([b'garbage'])
+        client.emit(logging.makeLogRecord(
+            {'name': 'app', 'levelno': logging.INFO, 'msg': 'valid'}))
+        _wait_for(lambda: logged_records)
+    finally:
+        client.close()
+
+    assert logged_records[0].msg == 'valid'
+
+
+def test_client_only_requires_a_port():
+    with pytest.raises(ValueError):
+        ZmqHandler('tcp://127.0.0.1', client_only=True)
+
+
+def test_parse_args():
+    assert parse_args([]).addresses == [DEFAULT_ADDRESS]
+
+    args = parse_args(['--bind', 'tcp://127.0.0.1:1', '--bind',
+                       'ipc:///tmp/log.sock', '--dispatch-threads', '2'])
+    assert args.addresses == ['tcp://127.0.0.1:1', 'ipc:///tmp/log.sock']
+    assert args.dispatch_threads == 2
+
+    # the collector doesn't unpickle the records of untrusted processes
+    with pytest.raises(SystemExit):
+        parse_args(['--serializer', 'pickle'])
+
+
+def test_load_config(tmpdir):
+    path = tmpdir.join('logging.json')
+    path.write(json.dumps({'version': 1}))
+
+    assert load_config(str(path)) == {'version': 1}
+
+
+def test_parse_args_publish():
+    args = parse_args(['--bind', 'tcp://127.0.0.1:1',
+                       '--publish', 'tcp://127.0.0.1:2'])
+    assert args.publish_addresses == ['tcp://127.0.0.1:2']
+
+    with pytest.raises(SystemExit):
+        parse_args(['--publish', 'tcp://127.0.0.1:2',
+                    '--publish', 'tcp://127.0.0.1:3'])
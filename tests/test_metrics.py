@@ -1,4 +1,4 @@
-from starlog.metrics import CounterMetric, MetricCollection
+from starlog.metrics import CounterMetric, HistogramMetric, MetricCollection
 
 
 def test_counter_metric_inc():
@@ -68,3 +68,35 @@ def test_metric_collection_inc_multiple_counter():
     result = coll.get_all_and_reset()
     assert result == {'reqs': 0, 'reqs.avg': 0,
                       'users': 0, 'users.avg': 0}
+
+
+def test_histogram_metric_percentiles():
+    histogram = HistogramMetric(bounds=(1, 10, 100))
+
+    assert histogram.percentile(50) == 0
+
+    for value in [0.5, 5, 5, 50, 500]:
+        histogram.observe(value)
+
+    assert histogram.count() == 5
+    assert histogram.max() == 500
+    assert histogram.percentile(20) == 1
+    assert histogram.percentile(50) == 10
+    assert histogram.percentile(80) == 100
+    # the overflow bucket
+    assert histogram.percentile(99) == 500
+
+
+def test_metric_collection_observe():
+    coll = MetricCollection()
+
+    coll.observe('latency', 3)
+    coll.observe('latency', 40)
+
+    result = coll.get_all_and_reset()
+    assert result == {'latency.count': 2, 'latency.max': 40,
+                      'latency.p50': 5, 'latency.p90': 40,
+                      'latency.p99': 40}
+
+    result = coll.get_all_and_reset()
+    assert result['latency.count'] == 0
@@ -1,13 +1,18 @@
 import logging
 import logging.handlers
+import threading
+import time
 import warnings
-from multiprocessing import Process, Queue
+from multiprocessing import Event, Process, Queue
 
 import flexmock
 import pytest
+from six.moves import queue as thread_queue
 
 from starlog.handlers.multiprocess_handler import QueueListenerThread
+from starlog.handlers.ring_buffer import RingBufferQueue
 from starlog import MultiprocessHandler
+from starlog.serializer import CallSiteTable, binary_encode_log_record
 from .records import plain_record
 
 
@@ -33,7 +38,7 @@ def test_queue_listener_with_a_closed_queue(queue, listener):
 
 def test_queue_listener_forward_log_message(queue, listener, dummy_mp_handler):
     dummy_mp_handler \
-        .should_receive('forward_to_sink') \
+        .should_receive('forward_batch_to_sink') \
         .once()
 
     listener.start()
@@ -42,6 +47,54 @@ def test_queue_listener_forward_log_message(queue, listener, dummy_mp_handler):
     listener.join()
 
 
+def test_queue_listener_drains_in_batches(dummy_mp_handler):
+    batches = []
+    dummy_mp_handler \
+        .should_receive('forward_batch_to_sink') \
+        .replace_with(batches.append)
+
+    queue = thread_queue.Queue()
+    for i in range(5):
+        queue.put(logging.makeLogRecord({'msg': i}))
+    queue.put(None)
+
+    QueueListenerThread(queue, dummy_mp_handler, batch_size=3).run()
+
+    assert [[record.msg for record in batch] for batch in batches] == [
+        [0, 1, 2], [3, 4]]
+
+
+def test_queue_listener_batches_queues_with_get_many(dummy_mp_handler):
+    # a queue without get_many() hands out one record per call
+    assert QueueListenerThread(
+        thread_queue.Queue(), dummy_mp_handler)._batch_size == 1
+
+    ring = RingBufferQueue(64)
+    try:
+        assert QueueListenerThread(ring, dummy_mp_handler)._batch_size == 100
+    finally:
+        ring.close()
+
+
+def test_queue_listener_skips_undecodable_items(dummy_mp_handler):
+    batches = []
+    dummy_mp_handler \
+        .should_receive('forward_batch_to_sink') \
+        .replace_with(batches.append)
+    dummy_mp_handler.should_receive('count_dropped').with_args(1).twice()
+
+    queue = thread_queue.Queue()
+    queue.put(b'\xb1truncated')
+    queue.put(binary_encode_log_record(logging.makeLogRecord({'msg': 'ok'})))
+    queue.put(b'garbage')
+    queue.put(None)
+
+    QueueListenerThread(queue, dummy_mp_handler, serializer='binary').run()
+
+    assert [[record.msg for record in batch] for batch in batches] == [
+        ['ok']]
+
+
 def test_multiprocess_handler_forward_to_sink(queue, sink_logger,
                                               logged_records):
     mph = MultiprocessHandler(queue)
@@ -88,3 +141,420 @@ def test_multiprocess_handler_with_a_subprocess(queue, sink_logger,
     mph.close()
 
     assert len(logged_records) == 1
+
+
+def test_multiprocess_handler_with_a_serializer(queue, sink_logger,
+                                                logged_records):
+    def emitter():
+        logging.getLogger('example.pkg').info('sample %s', 'message')
+
+    mph = MultiprocessHandler(queue, serializer='binary')
+
+    logger = logging.getLogger('example')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(mph)
+
+    process = Process(target=emitter)
+    process.start()
+    process.join()
+
+    # cleanup
+    mph.close()
+    logger.removeHandler(mph)
+
+    assert len(logged_records) == 1
+    assert logged_records[0].getMessage() == 'sample message'
+
+
+def test_multiprocess_handler_defer_rendering(queue, sink_logger,
+                                             logged_records):
+    def emitter():
+        logging.getLogger('example.pkg').info('sample %s', 'message')
+
+    mph = MultiprocessHandler(queue, defer_rendering=True)
+
+    logger = logging.getLogger('example')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(mph)
+
+    process = Process(target=emitter)
+    process.start()
+    process.join()
+
+    # cleanup
+    mph.close()
+    logger.removeHandler(mph)
+
+    assert len(logged_records) == 1
+    assert logged_records[0].msg == 'sample %s'
+    assert logged_records[0].getMessage() == 'sample message'
+
+
+def test_multiprocess_handler_call_site_table(queue, sink_logger,
+                                              logged_records):
+    def emitter():
+        for i in range(3):
+            logging.getLogger('example.pkg').info('record %d', i)
+
+    mph = MultiprocessHandler(queue, call_site_table=True)
+
+    logger = logging.getLogger('example')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(mph)
+
+    process = Process(target=emitter)
+    process.start()
+    process.join()
+
+    # a reference to a call site the listener doesn't know is dropped
+    table = CallSiteTable()
+    binary_encode_log_record(logging.makeLogRecord({}), call_sites=table)
+    queue.put(binary_encode_log_record(logging.makeLogRecord({}),
+                                       call_sites=table))
+
+    # cleanup
+    mph.close()
+    logger.removeHandler(mph)
+
+    assert [record.getMessage() for record in logged_records] == [
+        'record 0', 'record 1', 'record 2']
+    assert set(record.funcName for record in logged_records) == \
+        set(['emitter'])
+    assert mph.dropped_records == 1
+
+
+def test_multiprocess_handler_nonblocking(queue, sink_logger,
+                                          logged_records):
+    def emitter():
+        logging.getLogger('example.pkg').info('sample message')
+        mph.close()
+
+    mph = MultiprocessHandler(queue, serializer='binary', nonblocking=True)
+
+    logger = logging.getLogger('example')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(mph)
+
+    process = Process(target=emitter)
+    process.start()
+    process.join()
+
+    # cleanup
+    mph.close()
+    logger.removeHandler(mph)
+
+    assert len(logged_records) == 1
+
+
+def test_multiprocess_handler_dropped_records(queue):
+    mph = MultiprocessHandler(queue)
+
+    mph.handle_control({'pid': 123, 'dropped': 5})
+    mph.close()
+
+    assert mph.dropped_records == 5
+
+
+def test_multiprocess_handler_track_delivery(queue, sink_logger,
+                                            logged_records):
+    def emitter():
+        for i in range(3):
+            logging.getLogger('example.pkg').info('record %d', i)
+        mph.close()
+
+    mph = MultiprocessHandler(queue, track_delivery=True)
+
+    logger = logging.getLogger('example')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(mph)
+
+    process = Process(target=emitter)
+    process.start()
+    process.join()
+
+    # cleanup
+    mph.close()
+    logger.removeHandler(mph)
+
+    assert [record.starlog_seq for record in logged_records] == [1, 2, 3]
+    stats = mph.delivery_stats()[process.pid]
+    assert stats['received'] == 3
+    assert stats['lost'] == 0
+    assert stats['closed']
+
+
+def test_multiprocess_handler_reorder_window(queue, sink_logger,
+                                             logged_records):
+    def emitter():
+        start = time.time()
+
+        class Backdate(logging.Filter):
+            # records which were created in reverse order
+            def filter(self, record):
+                record.created = start - int(record.msg) * 0.01
+                return True
+
+        mph.addFilter(Backdate())
+        for i in range(5):
+            logging.getLogger('example.pkg').info(str(i))
+        mph.close()
+
+    mph = MultiprocessHandler(queue, reorder_window=0.5)
+
+    logger = logging.getLogger('example')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(mph)
+
+    process = Process(target=emitter)
+    process.start()
+    process.join()
+
+    # cleanup
+    mph.close()
+    logger.removeHandler(mph)
+
+    assert [record.msg for record in logged_records] == \
+        ['4', '3', '2', '1', '0']
+    assert mph.late_records == 0
+
+
+def _wait_for(condition, timeout=3):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_multiprocess_handler_close_waits_for_children(queue, sink_logger,
+                                                     logged_records):
+    started = Event()
+
+    def emitter():
+        logger = logging.getLogger('example.pkg')
+        logger.info('first')
+        started.set()
+        time.sleep(0.3)
+        logger.info('last')
+        # the stream ends when the process exits
+
+    mph = MultiprocessHandler(queue, nonblocking=True)
+
+    logger = logging.getLogger('example')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(mph)
+
+    process = Process(target=emitter)
+    process.start()
+    started.wait(5)
+    # the main process knows the child after its first record
+    _wait_for(lambda: logged_records)
+
+    # cleanup
+    mph.close()
+    logger.removeHandler(mph)
+    process.join()
+
+    assert [record.msg for record in logged_records] == ['first', 'last']
+    assert mph.left_over_records == 0
+
+
+def test_multiprocess_handler_close_deadline(queue, sink_logger,
+                                             logged_records):
+    started = Event()
+
+    def emitter():
+        logging.getLogger('example.pkg').info('first')
+        started.set()
+        time.sleep(5)
+
+    mph = MultiprocessHandler(queue, close_timeout=0.2)
+
+    logger = logging.getLogger('example')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(mph)
+
+    process = Process(target=emitter)
+    process.start()
+    started.wait(5)
+    # the main process knows the child after its first record
+    _wait_for(lambda: logged_records)
+
+    try:
+        closing = time.time()
+        mph.close()
+        assert time.time() - closing < 2
+    finally:
+        logger.removeHandler(mph)
+        process.terminate()
+        process.join()
+
+    assert [record.msg for record in logged_records] == ['first']
+
+
+def test_multiprocess_handler_close_with_manager_queue(sink_logger,
+                                                      logged_records):
+    def emitter():
+        for i in range(3):
+            logging.getLogger('example.pkg').info(str(i))
+        mph.close()
+
+    # the default queue of a multiprocessing.Manager
+    mph = MultiprocessHandler(close_timeout=1.0)
+
+    logger = logging.getLogger('example')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(mph)
+
+    try:
+        process = Process(target=emitter)
+        process.start()
+        process.join()
+        _wait_for(lambda: len(logged_records) == 3)
+    finally:
+        closing = threading.Thread(target=mph.close)
+        closing.setDaemon(True)
+        closing.start()
+        closing.join(10)
+        logger.removeHandler(mph)
+
+    assert not closing.is_alive()
+    assert [record.msg for record in logged_records] == ['0', '1', '2']
+
+
+def test_multiprocess_handler_dispatch_threads(queue, sink_logger,
+                                               logged_records):
+    def emitter():
+        for i in range(10):
+            logging.getLogger('example.pkg').info('message %d', i)
+
+    mph = MultiprocessHandler(queue, dispatch_threads=2)
+
+    logger = logging.getLogger('example')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(mph)
+
+    process = Process(target=emitter)
+    process.start()
+    process.join()
+
+    # cleanup
+    mph.close()
+    logger.removeHandler(mph)
+
+    assert [record.getMessage() for record in logged_records] == [
+        'message %d' % i for i in range(10)]
+    assert mph.dispatch_queue_depth() == 0
+
+
+def test_multiprocess_handler_unsupported_attribute(queue, sink_logger,
+                                                    logged_records):
+    def emitter():
+        logging.getLogger('example.pkg').info(
+            'sample message', extra={'point': complex(1, 2)})
+
+    mph = MultiprocessHandler(queue)
+
+    logger = logging.getLogger('example')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(mph)
+
+    process = Process(target=emitter)
+    process.start()
+    process.join()
+
+    # cleanup
+    mph.close()
+    logger.removeHandler(mph)
+
+    assert len(logged_records) == 1
+    assert logged_records[0].point == complex(1, 2)
+
+
+def test_multiprocess_handler_routing_cache(queue, sink_logger,
+                                            logged_records):
+    mph = MultiprocessHandler(queue)
+    # check the levels on every call
+    mph._route_check_interval = 0
+    module_logger = logging.getLogger('starlog.logsink.example.module')
+
+    def forward(levelno):
+        mph.forward_to_sink(logging.makeLogRecord(
+            {'name': 'example.module', 'levelno': levelno}))
+
+    try:
+        forward(logging.DEBUG)
+        assert len(logged_records) == 1
+
+        # changing the level invalidates the cache
+        module_logger.setLevel(logging.INFO)
+        forward(logging.DEBUG)
+        forward(logging.INFO)
+        assert len(logged_records) == 2
+
+        logging.disable(logging.INFO)
+        forward(logging.INFO)
+        assert len(logged_records) == 2
+        logging.disable(logging.NOTSET)
+
+        # a parent logger created after the route was cached
+        module_logger.setLevel(logging.NOTSET)
+        forward(logging.DEBUG)
+        assert len(logged_records) == 3
+        parent_logger = logging.getLogger('starlog.logsink.example')
+        parent_logger.setLevel(logging.WARNING)
+        forward(logging.INFO)
+        assert len(logged_records) == 3
+
+        # the level caches of the logging module are left alone
+        assert not any(not isinstance(key, int)
+                       for key in getattr(logging.root, '_cache', {}))
+    finally:
+        logging.disable(logging.NOTSET)
+        module_logger.setLevel(logging.NOTSET)
+        logging.getLogger('starlog.logsink.example').setLevel(logging.NOTSET)
+        mph.close()
+
+    forward(logging.DEBUG)
+    assert len(logged_records) == 4
+
+
+def test_multiprocess_handler_routing_check_interval(queue, sink_logger,
+                                                     logged_records):
+    mph = MultiprocessHandler(queue)
+    module_logger = logging.getLogger('starlog.logsink.example.module')
+
+    def forward(levelno):
+        mph.forward_to_sink(logging.makeLogRecord(
+            {'name': 'example.module', 'levelno': levelno}))
+
+    try:
+        forward(logging.DEBUG)
+        assert len(logged_records) == 1
+
+        # the levels are checked once per interval
+        module_logger.setLevel(logging.INFO)
+        forward(logging.DEBUG)
+        assert len(logged_records) == 2
+
+        mph._route_check_time -= mph._route_check_interval
+        forward(logging.DEBUG)
+        assert len(logged_records) == 2
+
+        # logging.disable() applies at once
+        logging.disable(logging.INFO)
+        forward(logging.INFO)
+        assert len(logged_records) == 2
+    finally:
+        logging.disable(logging.NOTSET)
+        module_logger.setLevel(logging.NOTSET)
+        mph.close()
@@ -0,0 +1,58 @@
+import os
+from multiprocessing import Pipe, Process
+
+import pytest
+
+from starlog import process
+from starlog.process import current_pid, register_after_fork
+
+
+pytestmark = pytest.mark.skipif(not process.FORK_TRACKING,
+                                reason='requires os.register_at_fork')
+
+
+class Tracked(object):
+    def __init__(self):
+        self.forked = False
+
+
+def _mark_forked(obj):
+    obj.forked = True
+
+
+def _run_in_child(target):
+    parent_connection, child_connection = Pipe()
+
+    def run():
+        child_connection.send(target())
+
+    child = Process(target=run)
+    child.start()
+    result = parent_connection.recv()
+    child.join()
+    return result
+
+
+def test_current_pid():
+    assert current_pid() == os.getpid()
+    assert _run_in_child(lambda: current_pid() == os.getpid())
+
+
+def test_register_after_fork():
+    tracked = Tracked()
+    register_after_fork(tracked, _mark_forked)
+
+    assert _run_in_child(lambda: tracked.forked)
+    assert not tracked.forked
+
+
+def test_zmq_handler_eager_connect():
+    zmq_handler = pytest.importorskip('starlog.handlers.zmq_handler')
+    handler = zmq_handler.ZmqHandler('tcp://127.0.0.1', eager_connect=True)
+
+    try:
+        assert handler._socket is None
+        assert _run_in_child(lambda: handler._socket is not None
+                             and handler._pid == os.getpid())
+    finally:
+        handler.close()
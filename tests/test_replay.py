@@ -0,0 +1,61 @@
+import logging
+import os
+
+import pytest
+
+pytest.importorskip('zmq')
+
+from starlog.handlers.spool import Spool  # noqa: E402
+from starlog.replay import find_spools, main, parse_args  # noqa: E402
+from starlog.serializer import (  # noqa: E402
+    CallSiteTable,
+    binary_encode_log_record,
+    encode_control,
+    json_encode_log_record,
+)
+
+
+def _record(msg):
+    return logging.makeLogRecord(
+        {'name': 'app', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+         'msg': msg, 'process': 1234})
+
+
+def _spool(directory, count):
+    table = CallSiteTable()
+    spool = Spool(directory, segment_bytes=100)
+    for i in range(count):
+        spool.append([binary_encode_log_record(_record('binary %d' % i),
+                                               call_sites=table)])
+    spool.append([json_encode_log_record(_record('json')).encode('utf-8'),
+                  encode_control({'pid': 1234, 'eos': True})])
+    spool.close()
+
+
+def test_replay_prints_spools(tmpdir, capsys):
+    _spool(str(tmpdir.join('1234-1')), 5)
+    _spool(str(tmpdir.join('1234-2')), 1)
+
+    assert main([str(tmpdir), '--format', '%(levelname)s %(message)s']) == 0
+
+    lines = capsys.readouterr().out.splitlines()
+    assert lines == ['WARNING binary %d' % i for i in range(5)] + \
+        ['WARNING json', 'WARNING binary 0', 'WARNING json']
+    assert len(find_spools(str(tmpdir))) == 2
+
+
+def test_replay_deletes_spools(tmpdir, capsys):
+    directory = str(tmpdir.join('1234-1'))
+    _spool(directory, 5)
+
+    main([directory, '--delete'])
+
+    assert 'binary 4' in capsys.readouterr().out
+    assert not os.path.exists(directory)
+
+
+def test_parse_args():
+    args = parse_args(['spool'])
+    assert args.directories == ['spool']
+    assert args.connect is None
+    assert not args.delete
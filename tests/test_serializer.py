@@ -1,12 +1,30 @@
+import logging
+import sys
+
+import flexmock
 import pytest
 import six
 from logging import LogRecord
 
 from starlog.serializer import (
+    BINARY_MAGIC,
+    CALL_SITE_MAGIC,
+    CallSiteRegistry,
+    CallSiteTable,
+    UnknownCallSite,
+    auto_decode_log_record,
+    binary_decode_log_record,
+    binary_encode_log_record,
+    decode_messages,
+    deferrable_args,
+    encode_message,
+    get_decoder,
+    get_serializer,
     json_decode_log_record,
     json_encode_log_record,
     pickle_log_record,
     record_to_dict,
+    traceback_fingerprint,
     unpickle_log_record)
 from . import records
 
@@ -70,3 +88,333 @@ def test_json_decode_log_record(record):
     expectation = record_to_dict(record)
 
     assert decoded.__dict__ == expectation
+
+
+@pytest.mark.parametrize('record', records.all_records)
+def test_binary_encode_log_record(record):
+    data = binary_encode_log_record(record)
+
+    assert isinstance(data, six.binary_type)
+    assert data.startswith(BINARY_MAGIC)
+    # at least 3 times smaller than json
+    assert len(data) * 3 < len(json_encode_log_record(record))
+
+
+@pytest.mark.parametrize('record', records.all_records)
+def test_binary_decode_log_record(record):
+    data = binary_encode_log_record(record)
+    decoded = binary_decode_log_record(data)
+
+    assert isinstance(decoded, LogRecord)
+    expectation = record_to_dict(record)
+
+    assert decoded.__dict__ == expectation
+
+
+def test_binary_decode_log_record_from_memoryview():
+    data = binary_encode_log_record(records.complex_record)
+    decoded = binary_decode_log_record(memoryview(data))
+
+    assert decoded.__dict__ == record_to_dict(records.complex_record)
+
+
+def test_binary_typed_side_map():
+    extra = {
+        'none': None,
+        'flag': True,
+        'negative': -300,
+        'big': 2 ** 70,
+        'ratio': 0.25,
+        'text': u'caf\xe9',
+        'raw': b'\x00\xff',
+        'items': [1, u'two', [3.0]],
+        'nested': {u'a': {u'b': False}},
+    }
+    record = records.makeLogRecord(extra)
+    # a standard attribute of an unexpected type
+    record.lineno = -1
+
+    decoded = binary_decode_log_record(binary_encode_log_record(record))
+
+    for key, value in extra.items():
+        assert getattr(decoded, key) == value
+    assert decoded.lineno == -1
+
+
+def test_binary_encode_unsupported_type():
+    record = records.makeLogRecord({'obj': object()})
+
+    with pytest.raises(TypeError):
+        binary_encode_log_record(record)
+
+
+@pytest.mark.parametrize('record', records.all_records)
+def test_auto_decode_log_record(record):
+    expectation = record_to_dict(record)
+
+    decoded = auto_decode_log_record(binary_encode_log_record(record))
+    assert decoded.__dict__ == expectation
+
+    data = json_encode_log_record(record).encode('utf-8')
+    decoded = auto_decode_log_record(data)
+    assert decoded.__dict__ == expectation
+
+    with pytest.raises(ValueError):
+        auto_decode_log_record(pickle_log_record(record))
+
+
+@pytest.mark.parametrize('name', ['binary', 'json', 'pickle'])
+def test_defer_rendering(name):
+    encode, decode = get_serializer(name, defer_rendering=True)
+
+    record = records.makeLogRecord({}, msg='%s of %d at %.1f: %r',
+                                   args=(u'job', 3, 0.5, None))
+    data = encode(record)
+    if isinstance(data, six.text_type):
+        data = data.encode('utf-8')
+    decoded = decode(data)
+
+    assert decoded.msg == '%s of %d at %.1f: %r'
+    assert decoded.args == (u'job', 3, 0.5, None)
+    assert decoded.getMessage() == 'job of 3 at 0.5: None'
+
+
+@pytest.mark.parametrize('name', ['binary', 'json', 'pickle'])
+def test_defer_rendering_mapping(name):
+    encode, decode = get_serializer(name, defer_rendering=True)
+
+    record = records.makeLogRecord({}, msg='%(user)s', args=({'user': 'joe'},))
+    assert record.args == {'user': 'joe'}
+    data = encode(record)
+    if isinstance(data, six.text_type):
+        data = data.encode('utf-8')
+
+    assert decode(data).getMessage() == 'joe'
+
+
+def test_deferrable_args():
+    class Text(str):
+        pass
+
+    def args_of(msg, *args):
+        return deferrable_args(records.makeLogRecord({}, msg=msg, args=args))
+
+    assert args_of('%s %s', 1, True) == (1, True)
+    assert args_of('no args') is None
+    assert args_of('%s', object()) is None
+    assert args_of('%s', Text('subclass')) is None
+    assert args_of('%s', [1]) is None
+    assert args_of(ValueError('%s'), 1) is None
+
+
+def test_binary_defer_rendering_fallback():
+    record = records.makeLogRecord({}, msg='%s', args=(object(),))
+    decoded = binary_decode_log_record(
+        binary_encode_log_record(record, defer_rendering=True))
+
+    assert decoded.msg.startswith('<object object at')
+    assert decoded.args is None
+
+
+@pytest.mark.parametrize('record', records.all_records)
+def test_binary_call_site_table(record):
+    table = CallSiteTable()
+    registry = CallSiteRegistry()
+    expectation = record_to_dict(record)
+
+    first = binary_encode_log_record(record, call_sites=table)
+    second = binary_encode_log_record(record, call_sites=table)
+
+    assert first[0:1] == CALL_SITE_MAGIC
+    assert len(second) < len(first)
+    for data in (first, second):
+        decoded = binary_decode_log_record(data, call_sites=registry)
+        assert decoded.__dict__ == expectation
+
+
+def test_binary_call_site_unknown():
+    table = CallSiteTable()
+    registry = CallSiteRegistry()
+    record = records.complex_record
+
+    binary_encode_log_record(record, call_sites=table)
+    reference = binary_encode_log_record(record, call_sites=table)
+
+    with pytest.raises(UnknownCallSite):
+        binary_decode_log_record(reference, call_sites=registry)
+
+    with pytest.raises(ValueError):
+        binary_decode_log_record(reference)
+
+    # a new session sends the definition again
+    table.reset()
+    data = binary_encode_log_record(record, call_sites=table)
+    assert binary_decode_log_record(data, call_sites=registry).__dict__ == \
+        record_to_dict(record)
+
+
+def test_binary_call_site_table_sessions():
+    table = CallSiteTable(max_sites=1, max_age=60)
+    registry = CallSiteRegistry(max_sessions=1)
+
+    first = binary_encode_log_record(records.plain_record, call_sites=table)
+    binary_decode_log_record(first, call_sites=registry)
+    # a second call site starts a new session
+    other = records.makeLogRecord({}, lineno=2)
+    second = binary_encode_log_record(other, call_sites=table)
+    binary_decode_log_record(second, call_sites=registry)
+
+    reference = binary_encode_log_record(other, call_sites=table)
+    assert binary_decode_log_record(reference, call_sites=registry).lineno == 2
+
+    # the registry forgot the first session
+    table = CallSiteTable()
+    binary_encode_log_record(records.plain_record, call_sites=table)
+    with pytest.raises(UnknownCallSite):
+        binary_decode_log_record(
+            binary_encode_log_record(records.plain_record, call_sites=table),
+            call_sites=registry)
+
+
+def test_binary_call_site_unsupported_type():
+    table = CallSiteTable()
+    record = records.makeLogRecord({'obj': object()})
+
+    with pytest.raises(TypeError):
+        binary_encode_log_record(record, call_sites=table)
+
+    # the call site was not registered by the failed record
+    data = binary_encode_log_record(records.makeLogRecord({}),
+                                    call_sites=table)
+    assert binary_decode_log_record(data, call_sites=CallSiteRegistry())
+
+
+def test_get_decoder():
+    encode, _decode = get_serializer('binary', call_sites=CallSiteTable())
+    decode = get_decoder('auto')
+    record = records.complex_record
+
+    for _ in range(2):
+        assert decode(encode(record)).__dict__ == record_to_dict(record)
+
+    with pytest.raises(ValueError):
+        get_serializer('json', call_sites=CallSiteTable())
+
+
+def _fail(message, cause=None):
+    try:
+        try:
+            raise ValueError(cause or message)
+        except ValueError:
+            if cause:
+                raise KeyError(message)
+            raise
+    except Exception:
+        return records.makeLogRecord({}, exc_info=sys.exc_info())
+
+
+@pytest.mark.parametrize('cause', [None, 'cause'])
+def test_traceback_cache(cause):
+    formatter = logging.Formatter()
+    handler = logging.Handler()
+
+    first = _fail('first', cause)
+    record_to_dict(first, handler)
+    assert first.exc_text == formatter.formatException(first.exc_info)
+
+    # the traceback of the second record is taken from the cache
+    flexmock.flexmock(handler).should_receive('format').never()
+    second = _fail('second', cause)
+    record_to_dict(second, handler)
+    assert second.exc_text == formatter.formatException(second.exc_info)
+
+
+def _divide(value):
+    return 1 / value
+
+
+def _fail_on_same_line(first, second):
+    try:
+        return _divide(first) + _divide(second)
+    except ZeroDivisionError:
+        return records.makeLogRecord({}, exc_info=sys.exc_info())
+
+
+def test_traceback_cache_same_line():
+    formatter = logging.Formatter()
+    handler = logging.Handler()
+
+    # python >= 3.11 marks the failing call of the line in the traceback
+    failures = [_fail_on_same_line(0, 1), _fail_on_same_line(1, 0)]
+    assert traceback_fingerprint(failures[0].exc_info) != \
+        traceback_fingerprint(failures[1].exc_info)
+
+    for record in failures:
+        record_to_dict(record, handler)
+        assert record.exc_text == formatter.formatException(record.exc_info)
+
+
+def test_traceback_fingerprint():
+    first = traceback_fingerprint(_fail('first').exc_info)
+    assert first == traceback_fingerprint(_fail('second').exc_info)
+    assert first != traceback_fingerprint(_fail('first', 'cause').exc_info)
+    # the messages of chained exceptions are part of the traceback text
+    assert traceback_fingerprint(_fail('first', 'cause').exc_info) != \
+        traceback_fingerprint(_fail('first', 'other').exc_info)
+
+
+@pytest.mark.parametrize('encode', [
+    binary_encode_log_record, json_encode_log_record, pickle_log_record])
+def test_traceback_custom_formatter(encode):
+    class Formatter(logging.Formatter):
+        def formatException(self, exc_info):
+            return 'custom'
+
+    handler = logging.Handler()
+    handler.setFormatter(Formatter())
+
+    for message in ('first', 'second'):
+        record = _fail(message)
+        encode(record, handler)
+        assert record.exc_text == 'custom'
+
+
+def test_binary_call_site_table_traceback():
+    formatter = logging.Formatter()
+    table = CallSiteTable()
+    registry = CallSiteRegistry()
+
+    failures = [_fail(message) for message in ('first', 'second')]
+    data = [binary_encode_log_record(record, call_sites=table)
+            for record in failures]
+
+    # the traceback is sent once
+    assert len(data[1]) < len(data[0]) - 100
+    for record, frame in zip(failures, data):
+        decoded = binary_decode_log_record(frame, call_sites=registry)
+        assert decoded.exc_text == formatter.formatException(record.exc_info)
+
+    with pytest.raises(UnknownCallSite):
+        binary_decode_log_record(data[1], call_sites=CallSiteRegistry())
+
+
+def test_get_serializer():
+    assert get_serializer('binary') == (
+        binary_encode_log_record, binary_decode_log_record)
+
+    with pytest.raises(ValueError):
+        get_serializer('xml')
+
+
+def test_encode_message():
+    messages = [[b'one'], [b'', b'x' * 200], [b'\xc0control', b'two']]
+    data = b''.join(encode_message(frames) for frames in messages)
+
+    decoded = list(decode_messages(data))
+    assert [frames for frames, _end in decoded] == messages
+    assert decoded[-1][1] == len(data)
+
+    # a truncated message is ignored
+    assert [frames for frames, _end in decode_messages(data[:-1])] == \
+        messages[:2]
+    assert list(decode_messages(data, decoded[1][1])) == [decoded[2]]
@@ -0,0 +1,78 @@
+import logging
+import time
+
+import pytest
+
+pytest.importorskip('zmq')
+
+from starlog import ZmqHandler  # noqa: E402
+from starlog.tail import Subscriber, parse_args  # noqa: E402
+
+
+def _record(name, level, msg):
+    return logging.makeLogRecord(
+        {'name': name, 'levelno': level, 'levelname':
+         logging.getLevelName(level), 'msg': msg})
+
+
+@pytest.mark.parametrize('serializer', ['binary', 'json', 'pickle'])
+def test_tail_subscribes_to_logger_prefix(sink_logger, logged_records,
+                                          serializer):
+    handler = ZmqHandler('tcp://127.0.0.1', serializer=serializer,
+                         publish_address='tcp://127.0.0.1')
+    client = ZmqHandler(handler.address, serializer=serializer,
+                        client_only=True)
+    subscriber = Subscriber([handler.publish_address], ['app.db'],
+                            logging.WARNING)
+
+    try:
+        received = None
+        deadline = time.time() + 5
+        # a subscription takes a moment to reach the publisher
+        while received is None and time.time() < deadline:
+            client.emit(_record('app.dbx', logging.ERROR, 'other logger'))
+            client.emit(_record('app', logging.ERROR, 'parent logger'))
+            client.emit(_record('app.db', logging.INFO, 'low level'))
+            client.emit(_record('app.db.pool', logging.WARNING, 'match'))
+            received = subscriber.receive(timeout=0.1)
+    finally:
+        subscriber.close()
+        client.close()
+        handler.close()
+
+    assert received.name == 'app.db.pool'
+    assert received.getMessage() == 'match'
+    # the sink logger still receives all records
+    assert set(record.name for record in logged_records) == set(
+        ['app', 'app.db', 'app.dbx', 'app.db.pool'])
+
+
+def test_publisher_without_subscribers(sink_logger, logged_records):
+    handler = ZmqHandler('tcp://127.0.0.1', publish_address='tcp://127.0.0.1',
+                         publish_hwm=1)
+    client = ZmqHandler(handler.address, client_only=True)
+
+    try:
+        for i in range(100):
+            client.emit(_record('app', logging.INFO, str(i)))
+
+        deadline = time.time() + 3
+        while len(logged_records) < 100 and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        client.close()
+        handler.close()
+
+    assert len(logged_records) == 100
+
+
+def test_parse_args():
+    args = parse_args(['--connect', 'tcp://127.0.0.1:1', '--level',
+                       'warning', 'app.db', 'web'])
+
+    assert args.addresses == ['tcp://127.0.0.1:1']
+    assert args.level == logging.WARNING
+    assert args.prefixes == ['app.db', 'web']
+
+    with pytest.raises(SystemExit):
+        parse_args(['--level', 'LOUD'])
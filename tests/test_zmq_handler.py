@@ -1,13 +1,19 @@
 import errno
+import logging
 import threading
+import time
+from logging import LogRecord
+from multiprocessing import Process
 
 import flexmock
 import pytest
 import zmq
 
 from starlog.handlers.zmq_handler import (
-    BindFailedError, RobustZmqSocket, ZmqListenerThread)
-from starlog.serializer import record_to_dict
+    BindFailedError, RobustZmqSocket, ZmqHandler, ZmqListenerThread,
+    shard_address)
+from starlog.serializer import (
+    binary_encode_log_record, json_encode_log_record, record_to_dict)
 from starlog import utils
 from .records import plain_record
 
@@ -39,8 +45,24 @@ def receiver_socket(request):
 
 
 @pytest.fixture(scope='function')
-def sender_socket():
-    return RobustZmqSocket(zmq.PUSH, address)
+def sender_socket(request):
+    socket = RobustZmqSocket(zmq.PUSH, address)
+
+    def close():
+        # do not block on undelivered messages
+        if socket._socket is not None:
+            socket._socket.setsockopt(zmq.LINGER, 0)
+        socket.close()
+
+    request.addfinalizer(close)
+
+    return socket
+
+
+def _wait_for(condition, timeout=3):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
 
 
 def test_robust_zmq_socket_bind_success_on_first_trial(receiver_socket):
@@ -99,8 +121,10 @@ def test_robust_zmq_socket_bind_success_after_retries(receiver_socket):
 
 def test_zmq_listener_forward_log_message(listener, event, sender_socket,
                                           dummy_zmq_handler):
+    forwarded = []
     dummy_zmq_handler \
         .should_receive('forward_to_sink') \
+        .replace_with(forwarded.append) \
         .once()
 
     listener.start()
@@ -108,7 +132,183 @@ def test_zmq_listener_forward_log_message(listener, event, sender_socket,
 
     sender_socket.connect()
     record = record_to_dict(plain_record)
-    sender_socket.send_json(record)
+    sender_socket.socket.send_json(record)
+    # the listener shuts down immediately, so wait for the message
+    _wait_for(lambda: forwarded)
+
+    listener.shutdown()
+    listener.join()
+
+
+def test_zmq_listener_binary_serializer(event, sender_socket,
+                                        dummy_zmq_handler):
+    listener = ZmqListenerThread(zmq.PULL, address, event, dummy_zmq_handler,
+                                 serializer='binary')
+    forwarded = []
+    dummy_zmq_handler \
+        .should_receive('forward_to_sink') \
+        .with_args(LogRecord) \
+        .replace_with(forwarded.append) \
+        .once()
+
+    listener.start()
+    utils.wait_for_event(event, 3, listener.is_alive)
+
+    sender_socket.connect()
+    sender_socket.socket.send(binary_encode_log_record(plain_record))
+    _wait_for(lambda: forwarded)
 
     listener.shutdown()
     listener.join()
+
+
+def test_zmq_listener_forward_batch(listener, event, sender_socket,
+                                    dummy_zmq_handler):
+    forwarded = []
+    dummy_zmq_handler \
+        .should_receive('forward_to_sink') \
+        .replace_with(forwarded.append) \
+        .times(2)
+
+    listener.start()
+    utils.wait_for_event(event, 3, listener.is_alive)
+
+    sender_socket.connect()
+    data = json_encode_log_record(plain_record).encode('utf-8')
+    sender_socket.send_multipart([data, data])
+    _wait_for(lambda: len(forwarded) == 2)
+
+    listener.shutdown()
+    listener.join()
+
+
+def test_zmq_listener_fast_shutdown(listener, event):
+    listener.start()
+    utils.wait_for_event(event, 3, listener.is_alive)
+
+    started = time.time()
+    listener.shutdown()
+    listener.join(3)
+
+    assert not listener.is_alive()
+    assert time.time() - started < 0.5
+
+
+def test_zmq_handler_zero_copy(sink_logger, logged_records):
+    handler = ZmqHandler('tcp://127.0.0.1', serializer='binary',
+                         zero_copy_threshold=1024)
+    message = 'x' * 100000
+
+    def emitter():
+        handler.emit(logging.makeLogRecord(
+            {'name': 'example', 'levelno': logging.INFO, 'msg': message}))
+        assert handler._trackers
+        handler.close()
+        assert not handler._trackers
+
+    try:
+        process = Process(target=emitter)
+        process.start()
+        process.join()
+        _wait_for(lambda: logged_records)
+    finally:
+        handler.close()
+
+    assert process.exitcode == 0
+    assert logged_records[0].msg == message
+
+
+def test_zmq_handler_track_delivery(sink_logger, logged_records):
+    handler = ZmqHandler('tcp://127.0.0.1', serializer='binary',
+                         track_delivery=True)
+
+    def emitter():
+        for i in range(3):
+            handler.emit(logging.makeLogRecord(
+                {'name': 'example', 'levelno': logging.INFO,
+                 'msg': 'record %d' % i}))
+        handler.close()
+
+    try:
+        process = Process(target=emitter)
+        process.start()
+        process.join()
+        _wait_for(lambda: process.pid in handler.delivery_stats()
+                  and handler.delivery_stats()[process.pid]['closed'])
+    finally:
+        handler.close()
+
+    stats = handler.delivery_stats()[process.pid]
+    assert stats['received'] == 3
+    assert stats['lost'] == 0
+    assert [record.starlog_seq for record in logged_records] == [1, 2, 3]
+
+
+def test_zmq_handler_close_drains_children(sink_logger, logged_records):
+    handler = ZmqHandler('tcp://127.0.0.1', serializer='binary',
+                         nonblocking=True, batch_size=50)
+
+    def emitter():
+        for i in range(1000):
+            handler.emit(logging.makeLogRecord(
+                {'name': 'example', 'levelno': logging.INFO, 'msg': str(i)}))
+        # the stream ends when the process exits
+
+    process = Process(target=emitter)
+    process.start()
+    # the main process knows the child after its first record
+    _wait_for(lambda: logged_records)
+
+    handler.close()
+    process.join()
+
+    assert process.exitcode == 0
+    assert [record.msg for record in logged_records] == \
+        [str(i) for i in range(1000)]
+    assert handler.left_over_records == 0
+
+
+def test_shard_address():
+    assert shard_address('tcp://127.0.0.1:5557', 0) == 'tcp://127.0.0.1:5557'
+    assert shard_address('tcp://127.0.0.1:5557', 2) == 'tcp://127.0.0.1:5559'
+    assert shard_address('tcp://127.0.0.1', 2) == 'tcp://127.0.0.1'
+    assert shard_address('ipc:///tmp/log', 1) == 'ipc:///tmp/log-1'
+
+
+def test_zmq_handler_shards(sink_logger, logged_records):
+    handler = ZmqHandler('tcp://127.0.0.1', serializer='binary', shards=3)
+
+    def emitter():
+        for i in range(100):
+            handler.emit(logging.makeLogRecord(
+                {'name': 'example', 'levelno': logging.INFO, 'msg': str(i)}))
+        handler.close()
+
+    try:
+        assert len(set(handler.addresses)) == 3
+        assert handler.address == handler.addresses[0]
+
+        processes = [Process(target=emitter) for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        _wait_for(lambda: len(logged_records) == 400)
+    finally:
+        handler.close()
+
+    # the records of a process keep their order
+    for process in processes:
+        assert [record.msg for record in logged_records
+                if record.process == process.pid] == \
+            [str(i) for i in range(100)]
+
+
+def test_zmq_handler_shards_client_only():
+    handler = ZmqHandler('tcp://127.0.0.1:5557', client_only=True, shards=2)
+    assert handler.addresses == ['tcp://127.0.0.1:5557',
+                                 'tcp://127.0.0.1:5558']
+
+    with pytest.raises(ValueError):
+        ZmqHandler('tcp://127.0.0.1', shards=2,
+                   publish_address='tcp://127.0.0.1')